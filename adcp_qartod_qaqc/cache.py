@@ -0,0 +1,180 @@
+# Cache.py - On-disk cache of per-test flag arrays
+#
+# Flags are stored as .npy files named by a hash of the data they were
+# computed from, the test name and the test's keyword arguments.
+# Rerunning QC on the same ensembles after changing one threshold only
+# recomputes that test.  The cache is bounded in bytes and evicts the
+# least recently used entries first (hits refresh a file's mtime).
+
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+from adcp_qartod_qaqc.result import QCResult, WorstFlag
+
+# Bump when a test changes so that stale flags are never reused
+CACHE_VERSION = 1
+
+
+def content_key(*parts):
+    """
+    Hashes bytes-like objects and arrays into a hex key for the data a
+    set of flags was computed from
+    """
+
+    digest = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            digest.update(str(part.dtype).encode('ascii'))
+            digest.update(str(part.shape).encode('ascii'))
+            part = np.ascontiguousarray(part)
+        digest.update(memoryview(part))
+    return digest.hexdigest()
+
+
+def pd0_key(pd0_data):
+    """
+    Content key of the bytes of the ensembles decoded by a PD0Data
+    """
+
+    if not pd0_data.n_ensembles:
+        return content_key(b'')
+    start = pd0_data.offsets[0]
+    stop = pd0_data.offsets[-1] + pd0_data.lengths[-1] + 2
+    return content_key(pd0_data.buffer[start:stop])
+
+
+class FlagCache(object):
+    """
+    Directory of cached flag arrays holding at most max_bytes
+    """
+
+    def __init__(self, directory, max_bytes=1 << 30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        # bytes in the cache, rescanned whenever it may exceed max_bytes
+        self.total_bytes = None
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    @staticmethod
+    def key(data_key, test_name, params=None):
+        """
+        Cache key of one test's flags for the data with data_key run
+        with keyword arguments params
+        """
+        return content_key(json.dumps(
+            [CACHE_VERSION, data_key, test_name, params or {}],
+            sort_keys=True
+        ).encode('utf-8'))
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.npy')
+
+    def get(self, key):
+        """
+        Returns the cached flags for key or None
+        """
+        path = self.path(key)
+        try:
+            flags = np.load(path)
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return flags
+
+    def put(self, key, flags):
+        """
+        Stores flags under key, then evicts least recently used
+        entries until the cache fits in max_bytes
+        """
+        handle, temporary = tempfile.mkstemp(dir=self.directory,
+                                             suffix='.tmp')
+        with os.fdopen(handle, 'wb') as temporary_file:
+            np.save(temporary_file, np.asarray(flags))
+        path = self.path(key)
+        if self.total_bytes is not None:
+            # an entry replaced by the rename no longer counts
+            try:
+                self.total_bytes -= os.path.getsize(path)
+            except OSError:
+                pass
+        os.rename(temporary, path)
+
+        if self.total_bytes is None:
+            self.total_bytes = self.size()
+        else:
+            self.total_bytes += os.path.getsize(path)
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def entries(self):
+        """
+        Returns (mtime, bytes, path) of every cached entry
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.npy'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+        self.total_bytes = total
+
+    def clear(self):
+        for _, _, path in self.entries():
+            os.remove(path)
+        self.total_bytes = 0
+
+
+def run_cached(qaqc, cache, data_key, params=None):
+    """
+    Like TRDIDeploymentQAQC.run_all, taking the flags of every test
+    whose data, transducer depth and keyword arguments are unchanged
+    from cache.  data_key identifies the ensembles (see pd0_key).
+    Returns the QCResult and the worst flag rollup.
+    """
+
+    params = params or {}
+    data_key = content_key(data_key.encode('ascii'),
+                           np.asarray(qaqc.transducer_depth))
+    result = QCResult.empty(qaqc.n_ensembles, qaqc.n_bins)
+    worst = WorstFlag(result.shape)
+    for name, test in qaqc.test_methods().items():
+        kwargs = params.get(name, {})
+        key = cache.key(data_key, name, kwargs)
+        flags = cache.get(key)
+        if flags is None or flags.shape != result.shape:
+            test(out=result[name], **kwargs)
+            cache.put(key, result[name])
+        else:
+            result[name] = flags
+        worst.add(result[name])
+
+    return result, worst.flags
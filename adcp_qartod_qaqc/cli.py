@@ -0,0 +1,327 @@
+# Cli.py - Batch QA/QC of PD0 files from the command line
+#
+#   adcp-qartod data/ 'archive/*.000' --profile wfs.json \
+#       --format netcdf --output-dir qc/ --workers 4
+#
+# Inputs are files, directories (scanned for PD0 files) or glob
+# patterns.  Each file is QA/QC'd in a worker process, chunk_size
+# ensembles at a time, and written to one output file per input.  A
+# state file in the output directory records the size, mtime and hash
+# of every file processed so unchanged files are skipped on the next
+# run.  A file that fails is reported and retried on the next run
+# without stopping the others.  Throughput is reported as files finish,
+# followed by a per-file timing summary.
+
+from __future__ import print_function
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+import sys
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from adcp_qartod_qaqc import writers
+from adcp_qartod_qaqc.config import compile_profile, load_profile
+from adcp_qartod_qaqc.pd0 import PD0File
+from adcp_qartod_qaqc.tests import QARTOD_TESTS
+
+
+PD0_PATTERNS = ('*.pd0', '*.PD0', '*.[0-9][0-9][0-9]')
+
+FORMATS = OrderedDict((
+    ('netcdf', '.nc'),
+    ('parquet', '.parquet')
+))
+
+STATE_FILE = '.adcp_qartod_state.json'
+
+
+def scan_inputs(inputs, patterns=PD0_PATTERNS):
+    """
+    Expands files, directories and glob patterns into a sorted list of
+    unique absolute file paths
+    """
+
+    paths = set()
+    for entry in inputs:
+        if os.path.isdir(entry):
+            for root, _, names in os.walk(entry):
+                for pattern in patterns:
+                    for path in glob.glob(os.path.join(root, pattern)):
+                        paths.add(os.path.abspath(path))
+        elif os.path.isfile(entry):
+            paths.add(os.path.abspath(entry))
+        else:
+            paths.update(os.path.abspath(path)
+                         for path in glob.glob(entry)
+                         if os.path.isfile(path))
+
+    return sorted(paths)
+
+
+def file_digest(path, block_size=1 << 20):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as pd0_file:
+        for block in iter(lambda: pd0_file.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class RunState(object):
+    """
+    Size, mtime and hash of the files QA/QC'd by earlier runs along
+    with the settings they were run with, kept in a JSON file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path) as state_file:
+                self.files = json.load(state_file)
+        except (IOError, OSError, ValueError):
+            self.files = {}
+
+    def unchanged(self, path, settings):
+        """
+        True when path, its output and the run settings match the last
+        run.  Files whose mtime changed are hashed before deciding.
+        """
+        entry = self.files.get(path)
+        if (entry is None or entry['settings'] != settings or
+                not os.path.exists(entry['output'])):
+            return False
+
+        stat = os.stat(path)
+        if stat.st_size != entry['size']:
+            return False
+        if stat.st_mtime == entry['mtime']:
+            return True
+        if file_digest(path) != entry['sha1']:
+            return False
+        entry['mtime'] = stat.st_mtime
+        return True
+
+    def record(self, path, output, settings):
+        stat = os.stat(path)
+        self.files[path] = {
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'sha1': file_digest(path),
+            'output': output,
+            'settings': settings
+        }
+
+    def save(self):
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w') as state_file:
+            json.dump(self.files, state_file, indent=1, sort_keys=True)
+        os.rename(temporary, self.path)
+
+
+def output_path(path, output_dir, output_format):
+    name = os.path.splitext(os.path.basename(path))[0]
+    extension = os.path.splitext(path)[1].lstrip('.')
+    if extension.isdigit():
+        name += '_' + extension
+    return os.path.join(output_dir, name + FORMATS[output_format])
+
+
+def qc_file(path, output, output_format='netcdf', chunk_size=1000,
+            transducer_depth=None, plan=None):
+    """
+    QA/QCs one PD0 file into output.  Returns the file's ensembles,
+    bytes and seconds taken.
+    """
+
+    started = time.time()
+    names = plan.names if plan is not None else QARTOD_TESTS
+    if output_format == 'netcdf':
+        with PD0File(path) as pd0:
+            n_bins = pd0.n_bins
+        writer = writers.NetCDFWriter(output, n_bins, names,
+                                      chunk_size=chunk_size)
+    else:
+        writer = writers.ParquetWriter(output, names)
+    with writer:
+        n_ensembles = writers.export_pd0(path, writer, chunk_size,
+                                         transducer_depth, plan)
+
+    return {
+        'path': path,
+        'output': output,
+        'n_ensembles': n_ensembles,
+        'bytes': os.path.getsize(path),
+        'seconds': time.time() - started
+    }
+
+
+def _qc_file(arguments):
+    return qc_file(*arguments)
+
+
+def _rate(amount, seconds):
+    return amount / seconds if seconds > 0 else float('nan')
+
+
+def format_summary(results):
+    """
+    Per-file timing table of qc_file results, skipped and failed files
+    included
+    """
+
+    lines = ['%-40s %10s %9s %9s %12s %8s' % (
+        'file', 'ensembles', 'MB', 'seconds', 'ensembles/s', 'MB/s'
+    )]
+    for result in results:
+        name = os.path.basename(result['path'])
+        if result.get('skipped'):
+            lines.append('%-40s %10s' % (name, 'unchanged'))
+            continue
+        if 'error' in result:
+            lines.append('%-40s %10s %s' % (name, 'failed',
+                                            result['error']))
+            continue
+        lines.append('%-40s %10d %9.2f %9.2f %12.0f %8.2f' % (
+            name, result['n_ensembles'], result['bytes'] / 1e6,
+            result['seconds'],
+            _rate(result['n_ensembles'], result['seconds']),
+            _rate(result['bytes'] / 1e6, result['seconds'])
+        ))
+    return '\n'.join(lines)
+
+
+def run(paths, output_dir, output_format='netcdf', workers=None,
+        chunk_size=1000, transducer_depth=None, plan=None, force=False,
+        progress=sys.stderr):
+    """
+    QA/QCs the PD0 files in paths that changed since the last run into
+    output_dir.  Returns a list of qc_file results in path order;
+    unchanged files are marked 'skipped' and files that raised carry
+    the 'error' instead of timings.  Failed files are not recorded in
+    the state file, so they are QA/QC'd again on the next run.
+    """
+
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    state = RunState(os.path.join(output_dir, STATE_FILE))
+    settings = {
+        'format': output_format,
+        'chunk_size': chunk_size,
+        'transducer_depth': transducer_depth,
+        'tests': plan.tests if plan is not None else None
+    }
+    # round trip so settings compare equal to those read back from JSON
+    settings = json.loads(json.dumps(settings))
+
+    results = OrderedDict()
+    pending = []
+    for path in paths:
+        output = output_path(path, output_dir, output_format)
+        if not force and state.unchanged(path, settings):
+            results[path] = {'path': path, 'output': output,
+                             'skipped': True}
+        else:
+            results[path] = None
+            pending.append((path, output, output_format, chunk_size,
+                            transducer_depth, plan))
+
+    started = time.time()
+    totals = {'n_ensembles': 0, 'bytes': 0}
+
+    def report(result):
+        results[result['path']] = result
+        done = sum(1 for item in results.values()
+                   if item is not None and not item.get('skipped'))
+        name = os.path.basename(result['path'])
+        if 'error' in result:
+            if progress is not None:
+                print('[%d/%d] %s: failed: %s' % (
+                    done, len(pending), name, result['error']
+                ), file=progress)
+            return
+
+        state.record(result['path'], result['output'], settings)
+        totals['n_ensembles'] += result['n_ensembles']
+        totals['bytes'] += result['bytes']
+        elapsed = time.time() - started
+        if progress is not None:
+            print('[%d/%d] %s: %d ensembles, %.0f ensembles/s, '
+                  '%.2f MB/s' % (done, len(pending), name,
+                                 totals['n_ensembles'],
+                                 _rate(totals['n_ensembles'], elapsed),
+                                 _rate(totals['bytes'] / 1e6, elapsed)),
+                  file=progress)
+
+    def failed(arguments, error):
+        return {'path': arguments[0], 'output': arguments[1],
+                'error': '%s: %s' % (type(error).__name__, error)}
+
+    try:
+        if workers == 1:
+            for arguments in pending:
+                try:
+                    result = _qc_file(arguments)
+                except Exception as error:
+                    result = failed(arguments, error)
+                report(result)
+        elif pending:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = dict((executor.submit(_qc_file, arguments),
+                                arguments) for arguments in pending)
+                for future in as_completed(futures):
+                    try:
+                        result = future.result()
+                    except Exception as error:
+                        result = failed(futures[future], error)
+                    report(result)
+    finally:
+        state.save()
+
+    return list(results.values())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='QARTOD QA/QC of PD0 files'
+    )
+    parser.add_argument('inputs', nargs='+',
+                        help='PD0 files, directories or glob patterns')
+    parser.add_argument('--output-dir', default='.',
+                        help='Directory for the QC results')
+    parser.add_argument('--format', choices=list(FORMATS),
+                        default='netcdf', help='Output file format')
+    parser.add_argument('--profile',
+                        help='JSON or YAML threshold profile')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Worker processes (default: one per CPU)')
+    parser.add_argument('--chunk-size', type=int, default=1000,
+                        help='Ensembles QC\'d and written at a time')
+    parser.add_argument('--transducer-depth', type=float, default=None,
+                        help='Depth of ADCP transducer')
+    parser.add_argument('--force', action='store_true',
+                        help='QA/QC files even when unchanged')
+    args = parser.parse_args(argv)
+
+    paths = scan_inputs(args.inputs)
+    if not paths:
+        parser.error('no PD0 files found')
+    outputs = [output_path(path, args.output_dir, args.format)
+               for path in paths]
+    if len(set(outputs)) != len(outputs):
+        parser.error('input files must have distinct names')
+
+    plan = (load_profile(args.profile) if args.profile
+            else compile_profile({}))
+    results = run(paths, args.output_dir, args.format, args.workers,
+                  args.chunk_size, args.transducer_depth, plan, args.force)
+    print(format_summary(results))
+
+    return 1 if any('error' in result for result in results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,128 @@
+# Config.py - Site and instrument threshold profiles
+#
+# A profile lists the tests to run and their limits, e.g. in JSON:
+#
+#   {
+#     "name": "West Florida Shelf",
+#     "order": ["current_speed", "correlation_magnitude"],
+#     "tests": {
+#       "current_speed": {"max_speed": 150},
+#       "correlation_magnitude": {"good_tolerance": 115,
+#                                 "questionable_tolerance": 64},
+#       "battery": false
+#     }
+#   }
+#
+# Tests missing from "tests" run with their default limits and tests set
+# to false are skipped.  "order" moves tests to the front; the others
+# keep their QARTOD_TESTS order.  YAML profiles need PyYAML.
+#
+# compile_profile checks a profile once against the TRDIDeploymentQAQC
+# test methods and returns a TestPlan that runs the enabled tests in a
+# single pass over every chunk it is given.
+
+import inspect
+import json
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+from adcp_qartod_qaqc.result import QCResult, WorstFlag
+from adcp_qartod_qaqc.tests import QARTOD_TESTS
+from adcp_qartod_qaqc.trdi import TRDIDeploymentQAQC
+
+
+def _test_arguments(name):
+    """
+    Keyword arguments accepted by the TRDIDeploymentQAQC method of a test
+    """
+    method = getattr(TRDIDeploymentQAQC,
+                     TRDIDeploymentQAQC.TEST_METHODS[name])
+    method = getattr(method, '__wrapped__', method)
+    try:
+        arguments = inspect.getfullargspec(method).args
+    except AttributeError:
+        arguments = inspect.getargspec(method).args
+    return set(arguments) - set(['self', 'out'])
+
+
+class TestPlan(object):
+    """
+    Compiled profile: the enabled tests in run order with their
+    keyword arguments
+    """
+
+    def __init__(self, tests, name=None):
+        self.tests = tuple((test, dict(kwargs)) for test, kwargs in tests)
+        self.names = tuple(test for test, _ in self.tests)
+        self.name = name
+
+    def kwargs(self, test):
+        """
+        Keyword arguments the plan passes to a test
+        """
+        return dict(self.tests)[test]
+
+    def run(self, qaqc, methods=None):
+        """
+        Runs the plan's tests on a TRDIDeploymentQAQC in one pass.
+        methods optionally replaces some of qaqc.test_methods(), e.g.
+        with stateful versions of a test.  Returns a QCResult holding
+        only the enabled tests and the worst flag rollup of those tests.
+        """
+
+        result = QCResult.empty(qaqc.n_ensembles, qaqc.n_bins, self.names)
+        worst = WorstFlag(result.shape)
+        methods = dict(qaqc.test_methods(), **(methods or {}))
+        for test, kwargs in self.tests:
+            worst.add(methods[test](out=result[test], **kwargs))
+
+        return result, worst.flags
+
+
+def compile_profile(profile):
+    """
+    Validates a profile dictionary and compiles it into a TestPlan.
+    Raises ValueError for unknown tests or arguments.
+    """
+
+    settings = profile.get('tests', {})
+    order = list(profile.get('order', []))
+    for test in list(settings) + order:
+        if test not in QARTOD_TESTS:
+            raise ValueError('Unknown test %r in profile' % (test,))
+    if len(set(order)) != len(order):
+        raise ValueError('Tests repeated in profile order')
+
+    tests = []
+    for test in order + [t for t in QARTOD_TESTS if t not in order]:
+        kwargs = settings.get(test, {})
+        if kwargs is False:
+            continue
+        if kwargs is True or kwargs is None:
+            kwargs = {}
+        unknown = set(kwargs) - _test_arguments(test)
+        if unknown:
+            raise ValueError('Unknown arguments %s for test %r' %
+                             (', '.join(sorted(unknown)), test))
+        tests.append((test, kwargs))
+
+    return TestPlan(tests, profile.get('name'))
+
+
+def load_profile(path):
+    """
+    Reads a JSON or (with PyYAML) YAML profile and compiles it
+    """
+
+    with open(path) as profile_file:
+        if path.endswith(('.yaml', '.yml')):
+            if yaml is None:
+                raise ImportError('YAML profiles require PyYAML')
+            profile = yaml.safe_load(profile_file)
+        else:
+            profile = json.load(profile_file)
+
+    return compile_profile(profile)
@@ -0,0 +1,78 @@
+# Fields.py - Quantities derived from the ADCP velocity components
+#
+# Current speed and direction are computed with NumPy over whole
+# (ensemble, bin) arrays.  Masked arrays stay masked: a bin masked in u
+# or v is masked in the derived fields too.  Each field is computed on
+# first access and cached, so QC runs that never look at direction never
+# pay for arctan2.
+
+import numpy as np
+
+
+def current_speed(u, v):
+    """
+    Horizontal current speed, in the units of u and v
+    """
+    return np.hypot(u, v)
+
+
+def current_direction(u, v):
+    """
+    Compass direction the current flows towards, in degrees clockwise
+    from north in [0, 360)
+    """
+    direction = np.degrees(np.arctan2(u, v))
+    direction = np.where(direction < 0, direction + 360, direction)
+    # tiny negative angles round to exactly 360 when shifted
+    direction = np.where(direction >= 360, 0.0, direction)
+    if np.ma.isMaskedArray(u) or np.ma.isMaskedArray(v):
+        direction = np.ma.masked_array(
+            direction, np.ma.mask_or(np.ma.getmask(u), np.ma.getmask(v))
+        )
+    return direction
+
+
+class _cached(object):
+    """
+    Computes a VelocityFields attribute on first access and stores it
+    on the instance so later accesses are plain attribute lookups
+    """
+
+    def __init__(self, method):
+        self.method = method
+        self.__name__ = method.__name__
+        self.__doc__ = method.__doc__
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        value = self.method(instance)
+        instance.__dict__[self.__name__] = value
+        return value
+
+
+class VelocityFields(object):
+    """
+    Lazily derived fields of east (u) and north (v) velocities shaped
+    (ensemble, bin) or (bin,).  Plain and masked arrays are both
+    accepted.
+    """
+
+    def __init__(self, u, v):
+        self.u = u
+        self.v = v
+
+    @_cached
+    def speed(self):
+        return current_speed(self.u, self.v)
+
+    @_cached
+    def direction(self):
+        return current_direction(self.u, self.v)
+
+    def computed(self):
+        """
+        Names of the fields computed so far
+        """
+        return sorted(name for name in ('speed', 'direction')
+                      if name in self.__dict__)
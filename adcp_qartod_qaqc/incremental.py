@@ -0,0 +1,294 @@
+# Incremental.py - Stateful QARTOD tests for real time ensemble feeds
+#
+# Each checker keeps a bounded amount of history and is updated with
+# one ensemble (update) or a block of consecutive ensembles
+# (update_many) at a time.  Updates cost O(1) per value regardless of
+# how many ensembles have been seen or how long a test's window is.
+
+import numpy as np
+
+from adcp_qartod_qaqc import vectorized
+from adcp_qartod_qaqc.tests import ADCP_FLAGS
+
+
+class StuckSensorTest(object):
+    """
+    QARTOD Test #15 Strongly Recommended
+    stuck sensor test on echo intensity.
+
+    Keeps a ring buffer of the last tolerance + 1 echo intensity
+    ensembles and the current run length of identical values for every
+    bin and beam.  A bin is bad when any of its beams has repeated the
+    same value more than tolerance ensembles in a row.
+    """
+
+    def __init__(self, tolerance=4):
+        self.tolerance = tolerance
+        self.history_size = tolerance + 1
+        self.reset()
+
+    def reset(self):
+        self.history = None
+        self.position = 0
+        self.count = 0
+        self.run_length = None
+
+    @property
+    def recent(self):
+        """
+        Echo intensities held in the ring buffer, oldest first
+        """
+        if self.history is None:
+            return None
+        kept = min(self.count, self.history_size)
+        order = (self.position - kept + np.arange(kept)) % self.history_size
+        return self.history[order]
+
+    def update(self, echo_intensities):
+        """
+        Adds one (n_bins, n_beams) ensemble and returns its bin flags
+        """
+        return self.update_many(np.asarray(echo_intensities)[np.newaxis])[0]
+
+    def update_many(self, echo_intensities):
+        """
+        Adds consecutive (n_ensembles, n_bins, n_beams) ensembles and
+        returns their (n_ensembles, n_bins) flags
+        """
+        echo_intensities = np.asarray(echo_intensities)
+        if len(echo_intensities) == 0:
+            return np.zeros(echo_intensities.shape[:-1],
+                            dtype=vectorized.FLAG_DTYPE)
+
+        if (self.history is None or
+                self.history.shape[1:] != echo_intensities.shape[1:]):
+            self.reset()
+            self.history = np.zeros(
+                (self.history_size,) + echo_intensities.shape[1:],
+                dtype=echo_intensities.dtype
+            )
+            previous = None
+            previous_run = 0
+        else:
+            previous = self.history[self.position - 1]
+            previous_run = self.run_length
+
+        run_lengths = vectorized.run_lengths(echo_intensities,
+                                             previous, previous_run)
+        self.run_length = run_lengths[-1]
+
+        kept = echo_intensities[-self.history_size:]
+        slots = (self.position + np.arange(len(kept))) % self.history_size
+        self.history[slots] = kept
+        self.position = (self.position + len(kept)) % self.history_size
+        self.count += len(echo_intensities)
+
+        stuck = (run_lengths > self.tolerance).any(axis=-1)
+        return np.where(stuck, ADCP_FLAGS['bad'],
+                        ADCP_FLAGS['good']).astype(vectorized.FLAG_DTYPE)
+
+
+class TimeSeriesTest(object):
+    """
+    Base class of the rolling window time series tests.  Keeps the last
+    window ensembles in a ring buffer along with their running sum, sum
+    of squares and number of non-finite values, so the window mean and
+    standard deviation cost O(1) per value as ensembles enter and leave
+    it.  The sums are rebuilt from the buffer each time it wraps to
+    bound rounding drift, which amortizes to O(1) as well.  Flags match
+    a run of the vectorized test over the whole series.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self.reset()
+
+    def reset(self):
+        self.history = None
+        self.position = 0
+        self.count = 0
+
+    def __start(self, shape):
+        self.reset()
+        self.history = np.zeros((self.window,) + shape)
+        self.shift = np.zeros(shape)
+        self.total = np.zeros(shape)
+        self.squares = np.zeros(shape)
+        self.invalid = np.zeros(shape, dtype=np.int64)
+
+    def __shifted(self, values):
+        finite = np.isfinite(values)
+        return np.where(finite, values - self.shift, 0.), ~finite
+
+    def __rebuild(self):
+        finite = np.isfinite(self.history)
+        # sums are taken about the window mean so that the sum of
+        # squares keeps its precision when the mean is large
+        self.shift = np.where(finite, self.history, 0.).mean(axis=0)
+        shifted, invalid = self.__shifted(self.history)
+        self.total = shifted.sum(axis=0)
+        self.squares = (shifted * shifted).sum(axis=0)
+        self.invalid = invalid.sum(axis=0)
+
+    @property
+    def recent(self):
+        """
+        Values held in the ring buffer, oldest first
+        """
+        if self.history is None:
+            return None
+        kept = min(self.count, self.window)
+        order = (self.position - kept + np.arange(kept)) % self.window
+        return self.history[order]
+
+    def stats(self):
+        """
+        Mean and standard deviation of the last window values, NaN
+        until window values were seen and while any of them is not
+        finite
+        """
+        if self.count < self.window:
+            missing = np.full(self.total.shape, np.nan)
+            return missing, missing
+        mean = self.total / self.window
+        variance = np.maximum(self.squares / self.window - mean * mean, 0.)
+        invalid = self.invalid > 0
+        return (np.where(invalid, np.nan, self.shift + mean),
+                np.where(invalid, np.nan, np.sqrt(variance)))
+
+    def previous(self):
+        """
+        The last value added, NaN before the first
+        """
+        if not self.count:
+            return np.full(self.total.shape, np.nan)
+        return self.history[self.position - 1]
+
+    def push(self, values):
+        """
+        Adds one ensemble of values to the window
+        """
+        shifted, invalid = self.__shifted(values)
+        if self.count >= self.window:
+            leaving, left_invalid = self.__shifted(self.history[self.position])
+            self.total -= leaving
+            self.squares -= leaving * leaving
+            self.invalid -= left_invalid
+        self.total += shifted
+        self.squares += shifted * shifted
+        self.invalid += invalid
+
+        self.history[self.position] = values
+        self.position = (self.position + 1) % self.window
+        self.count += 1
+        if self.position == 0:
+            self.__rebuild()
+
+    def test(self, values, out):
+        raise NotImplementedError
+
+    def update(self, values):
+        """
+        Adds one ensemble of values and returns its flags
+        """
+        return self.update_many(np.asarray(values)[np.newaxis])[0]
+
+    def update_many(self, values):
+        """
+        Adds consecutive ensembles of values (ensembles on the first
+        axis) and returns their flags
+        """
+        values = np.asarray(values, dtype=np.float64)
+        if (self.history is None or
+                self.history.shape[1:] != values.shape[1:]):
+            self.__start(values.shape[1:])
+
+        flags = np.empty(values.shape, dtype=vectorized.FLAG_DTYPE)
+        for value, out in zip(values, flags):
+            self.test(value, out)
+            self.push(value)
+
+        return flags
+
+
+class RateOfChangeTest(TimeSeriesTest):
+    """
+    Incremental vectorized.rate_of_change_test
+    """
+
+    def __init__(self, window=12, n_dev=3, min_rate=0):
+        self.n_dev = n_dev
+        self.min_rate = min_rate
+        super(RateOfChangeTest, self).__init__(window)
+
+    def test(self, values, out):
+        _, std = self.stats()
+        return vectorized.rate_of_change_flags(
+            values, np.abs(values - self.previous()), std, self.n_dev,
+            self.min_rate, out
+        )
+
+
+class SpikeTest(TimeSeriesTest):
+    """
+    Incremental vectorized.spike_test
+    """
+
+    def __init__(self, window=12, suspect_dev=3, bad_dev=5,
+                 min_deviation=0):
+        self.suspect_dev = suspect_dev
+        self.bad_dev = bad_dev
+        self.min_deviation = min_deviation
+        super(SpikeTest, self).__init__(window)
+
+    def test(self, values, out):
+        mean, std = self.stats()
+        return vectorized.spike_flags(values, mean, std, self.suspect_dev,
+                                      self.bad_dev, self.min_deviation, out)
+
+
+class FlatLineTest(object):
+    """
+    Incremental vectorized.flat_line_test.  Keeps the last value and
+    its run length for every bin, like StuckSensorTest.
+    """
+
+    def __init__(self, tolerance=0, suspect_count=3, fail_count=5):
+        self.tolerance = tolerance
+        self.suspect_count = suspect_count
+        self.fail_count = fail_count
+        self.reset()
+
+    def reset(self):
+        self.last = None
+        self.run_length = None
+        self.count = 0
+
+    def update(self, values):
+        """
+        Adds one ensemble of values and returns its flags
+        """
+        return self.update_many(np.asarray(values)[np.newaxis])[0]
+
+    def update_many(self, values):
+        """
+        Adds consecutive ensembles of values (ensembles on the first
+        axis) and returns their flags
+        """
+        values = np.asarray(values, dtype=np.float64)
+        if len(values) == 0:
+            return np.zeros(values.shape, dtype=vectorized.FLAG_DTYPE)
+        if self.last is None or self.last.shape != values.shape[1:]:
+            self.reset()
+
+        runs = vectorized.run_lengths(
+            values, self.last,
+            0 if self.run_length is None else self.run_length,
+            self.tolerance
+        )
+        self.last = values[-1]
+        self.run_length = runs[-1]
+        self.count += len(values)
+
+        return vectorized.flat_line_flags(values, runs, self.suspect_count,
+                                          self.fail_count)
@@ -0,0 +1,139 @@
+# Ingest.py - Asyncio front end for telemetered PD0 ensembles
+#
+# Bytes are read from an asyncio stream (a socket, a serial bridge or
+# an in-memory asyncio.StreamReader), split into ensembles and queued.
+# QC runs in an executor so reception never waits on it, and results
+# are handed to an async sink.  The bounded queue applies backpressure:
+# when QC falls behind, reading stops until there is room again.
+#
+# Requires Python 3.7 or newer.
+
+import asyncio
+import logging
+
+from adcp_qartod_qaqc.pd0 import PD0Data, PD0FrameBuffer
+from adcp_qartod_qaqc.session import QCSession
+
+
+logger = logging.getLogger(__name__)
+
+
+class IngestService(object):
+    """
+    QA/QCs the ensembles arriving on a stream.
+
+    Results are put on sink, any object with a put() coroutine such as
+    an asyncio.Queue, as (first_ensemble, timestamps, flags) tuples
+    where flags is a QCResult.  Ensembles queued while QC was busy are
+    QC'd together in blocks of at most batch_size.
+
+    QC runs one block at a time because the session carries history
+    between ensembles.  Any executor works; the default is the event
+    loop's.  Ensembles that pass the checksum but cannot be QC'd, e.g.
+    because a data type is missing, are logged, dropped and counted in
+    n_rejected.
+    """
+
+    def __init__(self, sink, session=None, executor=None, queue_size=64,
+                 batch_size=32, read_size=4096):
+        self.sink = sink
+        self.session = session if session is not None else QCSession()
+        self.executor = executor
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.read_size = read_size
+        self.frames = PD0FrameBuffer()
+        self.n_ensembles = 0
+        self.n_rejected = 0
+
+    def qc(self, frames):
+        """
+        QA/QCs a list of ensembles (bytes).  Returns a list of
+        (timestamps, flags) tuples, one per block of ensembles that
+        share a configuration.
+        """
+
+        try:
+            pd0_data = PD0Data(b''.join(frames))
+            return [(pd0_data.timestamps, self.session.update_pd0(pd0_data))]
+        except ValueError as error:
+            if len(frames) == 1:
+                self.n_rejected += 1
+                logger.warning('Rejected ensemble: %s', error)
+                return []
+
+        results = []
+        for frame in frames:
+            results.extend(self.qc([frame]))
+        return results
+
+    async def receive(self, reader, queue):
+        """
+        Reads the stream until EOF and queues every complete ensemble
+        """
+
+        try:
+            while True:
+                data = await reader.read(self.read_size)
+                if not data:
+                    break
+                for frame in self.frames.feed(data):
+                    await queue.put(frame)
+        finally:
+            await queue.put(None)
+
+    async def process(self, queue):
+        """
+        QA/QCs queued ensembles until the end of the stream
+        """
+
+        loop = asyncio.get_running_loop()
+        done = False
+        while not done:
+            frames = [await queue.get()]
+            while len(frames) < self.batch_size and not queue.empty():
+                frames.append(queue.get_nowait())
+            if frames[-1] is None:
+                frames.pop()
+                done = True
+            if not frames:
+                continue
+
+            results = await loop.run_in_executor(self.executor, self.qc,
+                                                 frames)
+            for timestamps, flags in results:
+                await self.sink.put((self.n_ensembles, timestamps, flags))
+                self.n_ensembles += len(timestamps)
+
+    async def run(self, reader):
+        """
+        Ingests a stream until EOF.  Returns the number of ensembles
+        QC'd.
+        """
+
+        queue = asyncio.Queue(self.queue_size)
+        receiver = asyncio.ensure_future(self.receive(reader, queue))
+        try:
+            await self.process(queue)
+        finally:
+            if not receiver.done():
+                receiver.cancel()
+        await receiver
+        return self.n_ensembles
+
+
+async def serve(host, port, sink, transducer_depth=None, **kwargs):
+    """
+    Starts a TCP server that ingests each connection with its own
+    IngestService and QCSession.  Keyword arguments are passed to
+    IngestService.
+    """
+
+    async def handle(reader, writer):
+        service = IngestService(sink, QCSession(transducer_depth), **kwargs)
+        try:
+            await service.run(reader)
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
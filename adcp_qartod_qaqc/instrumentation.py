@@ -0,0 +1,97 @@
+# Instrumentation.py - Opt-in timing of the QA/QC tests and setup phases
+#
+# Methods wrapped with timed() record their wall time, call count and
+# the number of bins they covered in the instance's stats object.
+# Instances created without stats only pay for one attribute lookup
+# per call.
+
+import time
+from collections import OrderedDict
+from functools import wraps
+
+
+class QCStats(object):
+    """
+    Wall time, calls and bins processed for every instrumented test or
+    setup phase.  One QCStats can be shared by many QAQC instances to
+    total up a whole ingest run.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.phases = OrderedDict()
+
+    def record(self, name, seconds, bins=0):
+        phase = self.phases.get(name)
+        if phase is None:
+            phase = self.phases[name] = {'calls': 0, 'seconds': 0.0,
+                                         'bins': 0}
+        phase['calls'] += 1
+        phase['seconds'] += seconds
+        phase['bins'] += bins
+
+    def merge(self, other):
+        """
+        Adds the totals of another QCStats to this one
+        """
+        for name, phase in other.phases.items():
+            mine = self.phases.setdefault(
+                name, {'calls': 0, 'seconds': 0.0, 'bins': 0}
+            )
+            for key in ('calls', 'seconds', 'bins'):
+                mine[key] += phase[key]
+
+    def as_dict(self):
+        """
+        Returns {phase: {'calls', 'seconds', 'bins'}} in the order the
+        phases were first seen
+        """
+        return OrderedDict((name, dict(phase))
+                           for name, phase in self.phases.items())
+
+    def to_prometheus(self, prefix='adcp_qartod'):
+        """
+        Formats the totals in the Prometheus text exposition format
+        """
+
+        metrics = (
+            ('seconds', 'Wall time spent in each QA/QC test or phase'),
+            ('calls', 'Calls of each QA/QC test or phase'),
+            ('bins', 'Bins processed by each QA/QC test or phase')
+        )
+        lines = []
+        for key, description in metrics:
+            metric = '%s_%s_total' % (prefix, key)
+            lines.append('# HELP %s %s' % (metric, description))
+            lines.append('# TYPE %s counter' % metric)
+            for name, phase in self.phases.items():
+                lines.append('%s{phase="%s"} %r' % (metric, name,
+                                                    phase[key]))
+        return '\n'.join(lines) + '\n'
+
+
+def timed(method):
+    """
+    Records each call of a QAQC method in self.stats when it is set.
+    Bins processed are taken from self.stats_bins.
+    """
+
+    name = method.__name__.lstrip('_')
+
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        stats = self.stats
+        if stats is None:
+            return method(self, *args, **kwargs)
+
+        started = time.time()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            stats.record(name, time.time() - started, self.stats_bins)
+
+    # functools.wraps only sets this on Python 3
+    wrapper.__wrapped__ = method
+    return wrapper
@@ -0,0 +1,139 @@
+# Kernels.py - Compiled loops for the bin to bin echo and speed tests
+#
+# The bottom search stops at the first bin pair where the echo jumps,
+# and the echo intensity and current speed gradient tests compare each
+# bin with its neighbour.  With Numba installed these loops are compiled
+# and run over every ensemble without the temporary (ensemble, bin,
+# beam) difference arrays the NumPy versions in vectorized.py build.
+# Without Numba, vectorized.py keeps using NumPy.  The plain Python
+# kernels stay importable so both paths can be checked against each
+# other.
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+from adcp_qartod_qaqc.tests import ADCP_FLAGS
+
+
+def bottom_bin_kernel(intensity, tolerance, absolute, bottom):
+    n_ensembles, n_bins, n_beams = intensity.shape
+    for ensemble in range(n_ensembles):
+        bottom[ensemble] = n_bins
+        for bin in range(1, n_bins):
+            hits = 0
+            for beam in range(n_beams):
+                diff = (np.int64(intensity[ensemble, bin, beam]) -
+                        np.int64(intensity[ensemble, bin - 1, beam]))
+                if absolute and diff < 0:
+                    diff = -diff
+                if diff > tolerance:
+                    hits += 1
+            if hits >= 2:
+                bottom[ensemble] = bin
+                break
+
+
+def echo_intensity_kernel(intensity, tolerance, flags, good, suspect, bad):
+    n_ensembles, n_bins, n_beams = intensity.shape
+    for ensemble in range(n_ensembles):
+        if n_bins:
+            flags[ensemble, 0] = good
+        for bin in range(1, n_bins):
+            count = 0
+            for beam in range(n_beams):
+                if (np.int64(intensity[ensemble, bin - 1, beam]) -
+                        np.int64(intensity[ensemble, bin, beam]) <
+                        tolerance):
+                    count += 1
+            if count == 0:
+                flags[ensemble, bin] = good
+            elif count == 1:
+                flags[ensemble, bin] = suspect
+            else:
+                flags[ensemble, bin] = bad
+
+
+def speed_gradient_kernel(speed, tolerance, flags, good, bad):
+    n_ensembles, n_bins = speed.shape
+    for ensemble in range(n_ensembles):
+        if n_bins:
+            flags[ensemble, 0] = good
+        for bin in range(1, n_bins):
+            diff = abs(speed[ensemble, bin] - speed[ensemble, bin - 1])
+            if diff <= tolerance:
+                flags[ensemble, bin] = good
+            else:
+                flags[ensemble, bin] = bad
+
+
+def _compile(kernel):
+    if numba is None:
+        return None
+    return numba.njit(cache=True, nogil=True)(kernel)
+
+
+BOTTOM_BIN = _compile(bottom_bin_kernel)
+ECHO_INTENSITY = _compile(echo_intensity_kernel)
+SPEED_GRADIENT = _compile(speed_gradient_kernel)
+
+# vectorized.py runs the compiled kernels while this is set
+ENABLED = numba is not None
+
+
+def _ensembles(values, ndim):
+    """
+    Returns values as an array with a leading ensemble axis and
+    whether one was added
+    """
+    values = np.asarray(np.ma.getdata(values))
+    if values.ndim < ndim:
+        return values[np.newaxis], True
+    return values, False
+
+
+def _flag_output(shape, out, single):
+    if out is None:
+        out = np.empty(shape, dtype=np.uint8)
+        return out, (out[0] if single else out)
+    return (out[np.newaxis] if single else out), out
+
+
+def find_bottom_bin(echo_intensities, tolerance=30, absolute=True,
+                    kernel=None):
+    """
+    Kernel version of vectorized.find_bottom_bin
+    """
+    intensity, single = _ensembles(echo_intensities, 3)
+    bottom = np.empty(intensity.shape[0], dtype=np.int64)
+    (kernel or BOTTOM_BIN)(intensity, tolerance, absolute, bottom)
+    return bottom[0] if single else bottom
+
+
+def echo_intensity_test(echo_intensities, tolerance=2, out=None,
+                        kernel=None):
+    """
+    Kernel version of vectorized.echo_intensity_test
+    """
+    intensity, single = _ensembles(echo_intensities, 3)
+    flags, result = _flag_output(intensity.shape[:2], out, single)
+    (kernel or ECHO_INTENSITY)(intensity, tolerance, flags,
+                               ADCP_FLAGS['good'], ADCP_FLAGS['suspect'],
+                               ADCP_FLAGS['bad'])
+    return result
+
+
+def current_speed_gradient_test(current_speed, tolerance=6, out=None,
+                                kernel=None):
+    """
+    Kernel version of vectorized.current_speed_gradient_test
+    """
+    speed, single = _ensembles(current_speed, 2)
+    speed = speed.astype(np.float64, copy=False)
+    flags, result = _flag_output(speed.shape, out, single)
+    (kernel or SPEED_GRADIENT)(speed, tolerance, flags, ADCP_FLAGS['good'],
+                               ADCP_FLAGS['bad'])
+    return result
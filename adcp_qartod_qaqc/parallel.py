@@ -0,0 +1,215 @@
+# Parallel.py - Runs the QARTOD tests over many PD0 files in a process pool
+#
+# Files (or byte-range shards of large files) are QA/QC'd independently
+# by TRDIDeploymentQAQC in worker processes.  Workers send back compact
+# uint8 flag arrays and the results are merged in ensemble time order.
+# Shards depend only on the file sizes and shard_bytes, so results are
+# identical for any number of workers.  The 'shared' backend instead
+# decodes one file at a time and splits its ensembles across workers
+# that share the decoded stack (see shared.py).
+
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from adcp_qartod_qaqc import vectorized
+from adcp_qartod_qaqc.incremental import StuckSensorTest
+from adcp_qartod_qaqc.pd0 import PD0Data, PD0File
+from adcp_qartod_qaqc.result import QCResult
+from adcp_qartod_qaqc.shared import run_shared
+from adcp_qartod_qaqc.tests import ADCP_FLAGS, QARTOD_TESTS
+from adcp_qartod_qaqc.trdi import TRDIDeploymentQAQC
+
+
+def plan_shards(paths, shard_bytes=None):
+    """
+    Splits each file into (path, start, stop) byte ranges of at most
+    shard_bytes.  Whole files are used when shard_bytes is None.
+    """
+
+    shards = []
+    for path in paths:
+        size = os.path.getsize(path)
+        step = shard_bytes or size or 1
+        for start in range(0, max(size, 1), step):
+            shards.append((path, start, min(start + step, size)))
+
+    return shards
+
+
+def _continued_stuck_sensor_flags(pd0, start, qaqc):
+    """
+    Reruns the stuck sensor test on a shard after priming it with the
+    ensembles just before the shard, so that runs crossing shard
+    boundaries are counted the same as in a whole file
+    """
+
+    stuck_sensor = StuckSensorTest()
+    history_bytes = stuck_sensor.history_size * (pd0.lengths.max() + 2)
+    lead_in = PD0Data(pd0.raw, max(0, start - history_bytes), start)
+    if lead_in.n_ensembles:
+        stuck_sensor.update_many(lead_in.echo_intensity)
+
+    return vectorized.apply_bin_mask(
+        stuck_sensor.update_many(qaqc.data['echo_intensity']),
+        qaqc.last_good_counter_mask
+    )
+
+
+def qc_shard(shard, transducer_depth=None):
+    """
+    QA/QCs the ensembles whose header begins in a shard.  Returns a
+    dictionary with the shard's timestamps, the uint8 (test, ensemble,
+    bin) array behind its QCResult and the time spent.
+    """
+
+    path, start, stop = shard
+    started = time.time()
+    with PD0File(path, start, stop) as pd0:
+        if pd0.n_ensembles:
+            qaqc = TRDIDeploymentQAQC.from_pd0(pd0, transducer_depth)
+            flags = qaqc.flags()
+            if start > 0:
+                flags['stuck_sensor'] = _continued_stuck_sensor_flags(
+                    pd0, start, qaqc
+                )
+            flags = flags.flags
+            timestamps = pd0.timestamps
+        else:
+            flags, timestamps = _no_ensembles()
+        n_ensembles = pd0.n_ensembles
+
+    return {
+        'path': path,
+        'bytes': stop - start,
+        'n_ensembles': n_ensembles,
+        'timestamps': timestamps,
+        'flags': flags,
+        'seconds': time.time() - started
+    }
+
+
+def _qc_shard(arguments):
+    return qc_shard(*arguments)
+
+
+def _no_ensembles():
+    return (np.zeros((len(QARTOD_TESTS), 0, 0), dtype=np.uint8),
+            np.zeros(0, dtype='datetime64[ms]'))
+
+
+def qc_shared(path, workers=None, transducer_depth=None, chunk_size=1000):
+    """
+    QA/QCs a whole PD0 file with shared.run_shared, chunk_size
+    ensembles per task across workers sharing the decoded file.
+    Returns the same dictionary as qc_shard for the whole file.
+    """
+
+    started = time.time()
+    with PD0File(path) as pd0:
+        if pd0.n_ensembles:
+            flags = run_shared(pd0.to_stack(), workers, chunk_size,
+                               transducer_depth).flags
+            timestamps = pd0.timestamps
+        else:
+            flags, timestamps = _no_ensembles()
+        n_ensembles = pd0.n_ensembles
+
+    return {
+        'path': path,
+        'bytes': os.path.getsize(path),
+        'n_ensembles': n_ensembles,
+        'timestamps': timestamps,
+        'flags': flags,
+        'seconds': time.time() - started
+    }
+
+
+def merge_shards(results):
+    """
+    Merges shard results into flags ordered by ensemble time.  Shards
+    with fewer bins are padded with missing_data.  Ensembles with equal
+    times keep their file and shard order.
+    """
+
+    n_bins = max([result['flags'].shape[2] for result in results] + [0])
+    n_ensembles = sum(result['n_ensembles'] for result in results)
+    flags = np.full((len(QARTOD_TESTS), n_ensembles, n_bins),
+                    ADCP_FLAGS['missing_data'], dtype=np.uint8)
+    timestamps = np.empty(n_ensembles, dtype='datetime64[ms]')
+    file_index = np.empty(n_ensembles, dtype=np.int64)
+
+    paths = []
+    first = 0
+    for result in results:
+        if result['path'] not in paths:
+            paths.append(result['path'])
+        last = first + result['n_ensembles']
+        flags[:, first:last, :result['flags'].shape[2]] = result['flags']
+        timestamps[first:last] = result['timestamps']
+        file_index[first:last] = paths.index(result['path'])
+        first = last
+
+    order = np.argsort(timestamps, kind='mergesort')
+    return {
+        'paths': paths,
+        'timestamps': timestamps[order],
+        'file_index': file_index[order],
+        'flags': QCResult(flags).select(order)
+    }
+
+
+def file_throughput(results):
+    """
+    Summarises shard results per file: ensembles, bytes, seconds of
+    worker time, ensembles per second and megabytes per second
+    """
+
+    summary = OrderedDict()
+    for result in results:
+        stats = summary.setdefault(
+            result['path'], {'n_ensembles': 0, 'bytes': 0, 'seconds': 0.0}
+        )
+        for key in ('n_ensembles', 'bytes', 'seconds'):
+            stats[key] += result[key]
+
+    for stats in summary.values():
+        seconds = stats['seconds'] or float('nan')
+        stats['ensembles_per_second'] = stats['n_ensembles'] / seconds
+        stats['mb_per_second'] = stats['bytes'] / seconds / 1e6
+
+    return summary
+
+
+def run_files(paths, workers=None, shard_bytes=None, transducer_depth=None,
+              backend='shards'):
+    """
+    QA/QCs PD0 files in a pool of worker processes.
+
+    The 'shards' backend sends each shard of shard_bytes to a worker.
+    The 'shared' backend QA/QCs the files one after another with
+    qc_shared and ignores shard_bytes.  Returns the merged results of
+    merge_shards with the per-file summary of file_throughput under
+    'throughput'.  workers=1 runs everything in this process.
+    """
+
+    if backend == 'shared':
+        results = [qc_shared(path, workers, transducer_depth)
+                   for path in paths]
+    elif backend == 'shards':
+        shards = plan_shards(paths, shard_bytes)
+        arguments = [(shard, transducer_depth) for shard in shards]
+        if workers == 1:
+            results = [_qc_shard(argument) for argument in arguments]
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(_qc_shard, arguments))
+    else:
+        raise ValueError('Unknown backend %r' % (backend,))
+
+    merged = merge_shards(results)
+    merged['throughput'] = file_throughput(results)
+    return merged
@@ -0,0 +1,404 @@
+# PD0.py - Memory-mapped decoder for TRDI PD0 binary ensembles
+#
+# Ensembles are located by walking the 0x7F7F header chain.  Profile
+# data and leaders are exposed as NumPy views straight into the mapped
+# file: when ensembles are evenly spaced (the usual case for a single
+# deployment) no data is copied at all.  Field layouts follow the
+# "WorkHorse Commands and Output Data Format" manual from TRDI.
+
+import mmap
+
+import numpy as np
+
+
+HEADER_ID = b'\x7f\x7f'
+
+FIXED_LEADER_ID = 0x0000
+VARIABLE_LEADER_ID = 0x0080
+VELOCITY_ID = 0x0100
+CORRELATION_ID = 0x0200
+ECHO_INTENSITY_ID = 0x0300
+PERCENT_GOOD_ID = 0x0400
+
+BAD_VELOCITY = -32768
+
+BEAM_ANGLES = {0: 15, 1: 20, 2: 30, 3: 0}
+
+
+def _leader_dtype(fields):
+    names, formats, offsets = zip(*fields)
+    return np.dtype({'names': names, 'formats': formats,
+                     'offsets': offsets})
+
+
+FIXED_LEADER_DTYPE = _leader_dtype([
+    ('id', '<u2', 0),
+    ('firmware_version', 'u1', 2),
+    ('firmware_revision', 'u1', 3),
+    ('system_configuration', '<u2', 4),
+    ('real_sim_flag', 'u1', 6),
+    ('lag_length', 'u1', 7),
+    ('number_of_beams', 'u1', 8),
+    ('number_of_cells', 'u1', 9),
+    ('pings_per_ensemble', '<u2', 10),
+    ('depth_cell_length', '<u2', 12),
+    ('blank_after_transmit', '<u2', 14),
+    ('profiling_mode', 'u1', 16),
+    ('low_correlation_threshold', 'u1', 17),
+    ('number_of_code_repetitions', 'u1', 18),
+    ('percent_good_minimum', 'u1', 19),
+    ('error_velocity_maximum', '<u2', 20),
+    ('tpp_minutes', 'u1', 22),
+    ('tpp_seconds', 'u1', 23),
+    ('tpp_hundredths', 'u1', 24),
+    ('coordinate_transformation', 'u1', 25),
+    ('heading_alignment', '<i2', 26),
+    ('heading_bias', '<i2', 28),
+    ('sensor_source', 'u1', 30),
+    ('sensors_available', 'u1', 31),
+    ('bin_1_distance', '<u2', 32),
+    ('transmit_pulse_length', '<u2', 34),
+    ('transmit_lag_distance', '<u2', 40)
+])
+
+VARIABLE_LEADER_DTYPE = _leader_dtype([
+    ('id', '<u2', 0),
+    ('ensemble_number', '<u2', 2),
+    ('rtc_year', 'u1', 4),
+    ('rtc_month', 'u1', 5),
+    ('rtc_day', 'u1', 6),
+    ('rtc_hour', 'u1', 7),
+    ('rtc_minute', 'u1', 8),
+    ('rtc_second', 'u1', 9),
+    ('rtc_hundredths', 'u1', 10),
+    ('ensemble_number_msb', 'u1', 11),
+    ('bit_result', '<u2', 12),
+    ('speed_of_sound', '<u2', 14),
+    ('depth_of_transducer', '<u2', 16),
+    ('heading', '<u2', 18),
+    ('pitch', '<i2', 20),
+    ('roll', '<i2', 22),
+    ('salinity', '<u2', 24),
+    ('temperature', '<i2', 26)
+])
+
+
+def _read_u16(buffer, positions):
+    return (buffer[positions].astype(np.int64) |
+            (buffer[positions + 1].astype(np.int64) << 8))
+
+
+def _checksum_matches(raw, start, n_bytes):
+    ensemble = np.frombuffer(raw[start:start + n_bytes + 2], dtype=np.uint8)
+    stored = int(ensemble[-2]) | (int(ensemble[-1]) << 8)
+    return int(ensemble[:-2].sum(dtype=np.uint64) % 65536) == stored
+
+
+def find_ensembles(raw, start=0, stop=None):
+    """
+    Walks the 0x7F7F header chain of a PD0 byte buffer.  Returns the
+    start offset and byte count (excluding the checksum) of every
+    complete ensemble whose header begins in [start, stop).  An
+    ensemble is accepted when another header (or the end of the buffer)
+    follows it, or when its checksum matches.  Other bytes are skipped
+    by searching for the next header.
+    """
+
+    size = len(raw)
+    if stop is None:
+        stop = size
+    starts = []
+    lengths = []
+    position = raw.find(HEADER_ID, start)
+    while 0 <= position < stop and position <= size - 6:
+        n_bytes = ord(raw[position + 2:position + 3]) | (
+            ord(raw[position + 3:position + 4]) << 8)
+        end = position + n_bytes + 2
+        if n_bytes > 6 and end <= size and (
+                end == size or raw[end:end + 2] == HEADER_ID or
+                _checksum_matches(raw, position, n_bytes)):
+            starts.append(position)
+            lengths.append(n_bytes)
+            position = end
+        else:
+            position = raw.find(HEADER_ID, position + 1)
+
+    return (np.array(starts, dtype=np.int64),
+            np.array(lengths, dtype=np.int64))
+
+
+class PD0Data(object):
+    """
+    Decodes the ensembles in a PD0 byte buffer (bytes, mmap, ...),
+    optionally only those whose header begins in [start, stop).
+
+    velocity, correlation, echo_intensity and percent_good are shaped
+    (ensemble, bin, beam) and fixed_leader/variable_leader are
+    structured arrays shaped (ensemble,).  All are read-only views
+    into the buffer when the ensembles are evenly spaced.
+    """
+
+    def __init__(self, raw, start=0, stop=None):
+        self.raw = raw
+        self.buffer = np.frombuffer(raw, dtype=np.uint8)
+        self.offsets, self.lengths = find_ensembles(raw, start, stop)
+        self.n_ensembles = len(self.offsets)
+        self.__find_data_types()
+
+        if self.n_ensembles:
+            fixed_leader = self.fixed_leader
+            for key in ('number_of_cells', 'number_of_beams'):
+                if (fixed_leader[key] != fixed_leader[key][0]).any():
+                    raise ValueError('%s changes between ensembles' % key)
+            self.n_bins = int(fixed_leader['number_of_cells'][0])
+            self.n_beams = int(fixed_leader['number_of_beams'][0])
+        else:
+            self.n_bins = 0
+            self.n_beams = 0
+
+    def __find_data_types(self):
+        """
+        Records the absolute offset of every data type in
+        every ensemble keyed by data type ID
+        """
+
+        self.data_offsets = {}
+        if not self.n_ensembles:
+            return
+
+        n_types = self.buffer[self.offsets + 5].astype(np.int64)
+        for index in range(n_types.max()):
+            present = n_types > index
+            type_offsets = self.offsets + _read_u16(
+                self.buffer, self.offsets + 6 + 2 * index
+            )
+            type_offsets[~present] = -1
+            ids = np.full(self.n_ensembles, -1, dtype=np.int64)
+            ids[present] = _read_u16(self.buffer, type_offsets[present])
+            for type_id in np.unique(ids[present]):
+                found = self.data_offsets.setdefault(
+                    type_id,
+                    np.full(self.n_ensembles, -1, dtype=np.int64)
+                )
+                found[ids == type_id] = type_offsets[ids == type_id]
+
+    def __view(self, type_id, dtype, shape, skip=2):
+        """
+        Returns an (ensemble,) + shape array of dtype starting skip
+        bytes into data type type_id of every ensemble.  Evenly spaced
+        ensembles give a zero-copy strided view, otherwise the values
+        are gathered into a new array.
+        """
+
+        dtype = np.dtype(dtype)
+        offsets = self.data_offsets.get(type_id)
+        if offsets is None or (offsets < 0).any():
+            raise ValueError('Data type 0x%04X missing from ensembles' %
+                             type_id)
+        offsets = offsets + skip
+
+        item_strides = []
+        stride = dtype.itemsize
+        for dimension in reversed(shape):
+            item_strides.insert(0, stride)
+            stride *= dimension
+        n_bytes = stride
+
+        spacing = np.diff(offsets)
+        if len(offsets) < 2 or (spacing == spacing[0]).all():
+            ensemble_stride = int(spacing[0]) if len(spacing) else n_bytes
+            return np.ndarray(shape=(self.n_ensembles,) + tuple(shape),
+                              dtype=dtype, buffer=self.raw,
+                              offset=int(offsets[0]),
+                              strides=(ensemble_stride,) +
+                              tuple(item_strides))
+
+        gather = offsets[:, np.newaxis] + np.arange(n_bytes)
+        return self.buffer[gather].view(dtype).reshape(
+            (self.n_ensembles,) + tuple(shape)
+        )
+
+    @property
+    def fixed_leader(self):
+        return self.__view(FIXED_LEADER_ID, FIXED_LEADER_DTYPE, (), skip=0)
+
+    @property
+    def variable_leader(self):
+        return self.__view(VARIABLE_LEADER_ID, VARIABLE_LEADER_DTYPE, (),
+                           skip=0)
+
+    @property
+    def velocity(self):
+        """
+        Velocities in mm/s, BAD_VELOCITY where the instrument
+        rejected the measurement
+        """
+        return self.__view(VELOCITY_ID, '<i2', (self.n_bins, self.n_beams))
+
+    @property
+    def correlation(self):
+        return self.__view(CORRELATION_ID, 'u1', (self.n_bins, self.n_beams))
+
+    @property
+    def echo_intensity(self):
+        return self.__view(ECHO_INTENSITY_ID, 'u1',
+                           (self.n_bins, self.n_beams))
+
+    @property
+    def percent_good(self):
+        return self.__view(PERCENT_GOOD_ID, 'u1',
+                           (self.n_bins, self.n_beams))
+
+    @property
+    def beam_angle(self):
+        system_configuration = self.fixed_leader['system_configuration']
+        codes = (system_configuration >> 8) & 0x03
+        return np.array([BEAM_ANGLES[code] for code in range(4)])[codes]
+
+    @property
+    def timestamps(self):
+        """
+        Real time clock of every ensemble as datetime64[ms]
+        """
+        leader = self.variable_leader
+        years = (2000 + leader['rtc_year'].astype(np.int64) - 1970)
+        months = years * 12 + leader['rtc_month'] - 1
+        days = (months.astype('datetime64[M]').astype('datetime64[D]') +
+                (leader['rtc_day'].astype(np.int64) - 1))
+        milliseconds = (
+            ((leader['rtc_hour'].astype(np.int64) * 60 +
+              leader['rtc_minute']) * 60 + leader['rtc_second']) * 1000 +
+            leader['rtc_hundredths'].astype(np.int64) * 10
+        )
+        return (days.astype('datetime64[ms]') +
+                milliseconds.astype('timedelta64[ms]'))
+
+    @property
+    def checksum_ok(self):
+        """
+        Verifies the checksum of every ensemble in one pass.  The
+        checksum is the sum of all ensemble bytes modulo 65536.
+        """
+        if not self.n_ensembles:
+            return np.zeros(0, dtype=bool)
+
+        ends = self.offsets + self.lengths
+        bounds = np.empty(2 * self.n_ensembles, dtype=np.int64)
+        bounds[0::2] = self.offsets
+        bounds[1::2] = ends
+        sums = np.add.reduceat(self.buffer, bounds, dtype=np.uint64)[0::2]
+
+        return (sums % 65536) == _read_u16(self.buffer, ends)
+
+    def to_stack(self):
+        """
+        Returns the ensembles as a stack for TRDIDeploymentQAQC.
+        Velocities are converted to cm/s with bad values set to NaN.
+        """
+        velocity = self.velocity
+        fixed_leader = self.fixed_leader
+        variable_leader = self.variable_leader
+
+        return {
+            'velocity': np.where(velocity == BAD_VELOCITY, np.nan,
+                                 velocity / 10.0),
+            'correlation': self.correlation,
+            'echo_intensity': self.echo_intensity,
+            'percent_good': self.percent_good,
+            'checksum_ok': self.checksum_ok,
+            'fixed_leader': {
+                'depth_cell_length': fixed_leader['depth_cell_length'],
+                'bin_1_distance': fixed_leader['bin_1_distance'],
+                'beam_angle': self.beam_angle
+            },
+            'variable_leader': dict(
+                (key, variable_leader[key])
+                for key in ('bit_result', 'pitch', 'roll', 'speed_of_sound',
+                            'depth_of_transducer', 'heading', 'temperature')
+            )
+        }
+
+
+class PD0FrameBuffer(object):
+    """
+    Splits a PD0 byte stream that arrives in arbitrary pieces (serial
+    reads, socket packets, ...) into complete ensembles.
+
+    Only ensembles with a matching checksum are returned.  Bytes that
+    do not belong to one are skipped and counted in n_skipped.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.n_skipped = 0
+
+    def feed(self, data):
+        """
+        Adds bytes to the buffer.  Returns the list of ensembles (as
+        bytes including the checksum) completed by them.
+        """
+
+        self.buffer.extend(data)
+        frames = []
+        position = 0
+        while True:
+            header = self.buffer.find(HEADER_ID, position)
+            if header < 0:
+                # a trailing 0x7F may be the first half of a header
+                keep = 1 if self.buffer[-1:] == HEADER_ID[:1] else 0
+                header = len(self.buffer) - keep
+                self.n_skipped += header - position
+                position = header
+                break
+            self.n_skipped += header - position
+            position = header
+            if len(self.buffer) < position + 4:
+                break
+            n_bytes = self.buffer[position + 2] | (
+                self.buffer[position + 3] << 8)
+            end = position + n_bytes + 2
+            if n_bytes <= 6:
+                position += 1
+                self.n_skipped += 1
+                continue
+            if len(self.buffer) < end:
+                break
+            frame = bytes(self.buffer[position:end])
+            if _checksum_matches(frame, 0, n_bytes):
+                frames.append(frame)
+                position = end
+            else:
+                position += 1
+                self.n_skipped += 1
+
+        del self.buffer[:position]
+        return frames
+
+
+class PD0File(PD0Data):
+    """
+    Memory maps a PD0 file by path and decodes it with PD0Data
+    """
+
+    def __init__(self, path, start=0, stop=None):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        super(PD0File, self).__init__(self.mmap, start, stop)
+
+    def close(self):
+        """
+        Unmaps the file.  Views handed out earlier keep the mapping
+        alive until they are released.
+        """
+        self.buffer = None
+        try:
+            self.mmap.close()
+        except BufferError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
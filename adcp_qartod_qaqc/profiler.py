@@ -0,0 +1,205 @@
+# Profiler.py - Instrument backends for the shared QA/QC engine
+#
+# Each backend maps its instrument's native arrays into the stack that
+# TRDIDeploymentQAQC and the vectorized tests work on:
+#
+#   velocity         (ensemble, bin, 4) east, north, up and error
+#                    velocity in cm/s, NaN where missing or not measured
+#   echo_intensity   (ensemble, bin, beam) counts
+#   correlation      (ensemble, bin, beam) counts, 0-255      [optional]
+#   percent_good     (ensemble, bin, 4) TRDI percent good     [optional]
+#   noise_floor      (ensemble, beam) counts                  [optional]
+#   snr              (ensemble, bin, beam) dB                 [optional]
+#   checksum_ok      (ensemble,) bool                         [optional]
+#   fixed_leader     depth_cell_length and bin_1_distance in cm,
+#                    beam_angle in degrees
+#   variable_leader  pitch, roll, heading and temperature in hundredths,
+#                    speed_of_sound in m/s, depth_of_transducer in dm,
+#                    bit_result                               [optional]
+#
+# Tests whose inputs are missing from a stack are flagged no_test, so
+# the noise floor, signal strength and signal to noise tests (#5-#7)
+# run wherever an instrument reports the data.
+
+from collections import OrderedDict
+
+import numpy as np
+
+from adcp_qartod_qaqc.pd0 import PD0Data
+from adcp_qartod_qaqc.trdi import TRDIDeploymentQAQC, stack_ensembles
+
+
+BACKENDS = OrderedDict()
+
+
+def register_backend(backend):
+    """
+    Class decorator adding a backend to BACKENDS under its name
+    """
+    BACKENDS[backend.name] = backend()
+    return backend
+
+
+def get_backend(name):
+    try:
+        return BACKENDS[name]
+    except KeyError:
+        raise ValueError('Unknown profiler backend %r, expected one of %s' %
+                         (name, ', '.join(BACKENDS)))
+
+
+class ProfilerBackend(object):
+    """
+    Maps one instrument family's data into the common stack
+    """
+
+    name = None
+
+    def to_stack(self, source):
+        raise NotImplementedError
+
+
+@register_backend
+class TRDIBackend(ProfilerBackend):
+    """
+    TRDI ensembles, either a pd0.PD0Data or ensemble dictionaries as
+    read by trdi_adcp_readers
+    """
+
+    name = 'trdi'
+
+    def to_stack(self, source):
+        if isinstance(source, PD0Data):
+            return source.to_stack()
+        return stack_ensembles(source)
+
+
+class NativeBackend(ProfilerBackend):
+    """
+    Maps a dictionary of the arrays exported by a profiler's own
+    software:
+
+      velocity     (ensemble, bin, 3 or 4) east, north, up[, fourth]
+                   in m/s, the fourth component is instrument specific
+      amplitude    (ensemble, bin, beam) counts
+      correlation  (ensemble, bin, beam) percent             [optional]
+      noise        (ensemble, beam) counts                   [optional]
+      snr          (ensemble, bin, beam) dB, derived from amplitude and
+                   noise when missing                        [optional]
+      cell_size, blanking   meters
+      pitch, roll, heading  (ensemble,) degrees
+      temperature  (ensemble,) degrees C
+      sound_speed  (ensemble,) m/s
+      transducer_depth      (ensemble,) meters               [optional]
+    """
+
+    beam_angle = 25
+    db_per_count = 0.5
+
+    def error_velocity(self, velocity):
+        """
+        Error velocity in m/s from the native velocity components
+        """
+        if velocity.shape[-1] < 4:
+            return np.full(velocity.shape[:-1], np.nan)
+        return velocity[..., 3]
+
+    def to_stack(self, source):
+        native_velocity = np.asarray(source['velocity'], dtype=np.float64)
+        n_ensembles = native_velocity.shape[0]
+        velocity = np.empty(native_velocity.shape[:2] + (4,))
+        velocity[..., :3] = native_velocity[..., :3]
+        velocity[..., 3] = self.error_velocity(native_velocity)
+        velocity *= 100.
+
+        stack = {
+            'velocity': velocity,
+            'echo_intensity': np.asarray(source['amplitude']),
+            'fixed_leader': {
+                'depth_cell_length': source['cell_size'] * 100.,
+                'bin_1_distance': (source['blanking'] +
+                                   source['cell_size'] / 2.) * 100.,
+                'beam_angle': self.beam_angle
+            },
+            'variable_leader': {
+                'pitch': np.asarray(source['pitch']) * 100.,
+                'roll': np.asarray(source['roll']) * 100.,
+                'heading': np.asarray(source['heading']) * 100.,
+                'temperature': np.asarray(source['temperature']) * 100.,
+                'speed_of_sound': np.asarray(source['sound_speed']),
+                'depth_of_transducer': np.asarray(
+                    source.get('transducer_depth', np.zeros(n_ensembles))
+                ) * 10.
+            }
+        }
+        if 'correlation' in source:
+            stack['correlation'] = (np.asarray(source['correlation']) *
+                                    255 / 100.)
+        if 'noise' in source:
+            stack['noise_floor'] = np.asarray(source['noise'])
+        if 'snr' in source:
+            stack['snr'] = np.asarray(source['snr'])
+        elif 'noise' in source:
+            stack['snr'] = self.db_per_count * (
+                stack['echo_intensity'] -
+                stack['noise_floor'][:, np.newaxis, :].astype(np.float64)
+            )
+
+        return stack
+
+
+@register_backend
+class NortekBackend(NativeBackend):
+    """
+    Nortek Signature and Aquadopp profilers.  Four beam Signatures
+    report two vertical velocities (ENUU); their difference stands in
+    for the error velocity.
+    """
+
+    name = 'nortek'
+    beam_angle = 25
+    db_per_count = 0.5
+
+    def error_velocity(self, velocity):
+        if velocity.shape[-1] < 4:
+            return np.full(velocity.shape[:-1], np.nan)
+        return velocity[..., 2] - velocity[..., 3]
+
+
+@register_backend
+class SonTekBackend(NativeBackend):
+    """
+    SonTek ADP and RiverSurveyor profilers.  The fourth velocity of
+    four beam systems is the difference (error) velocity.
+    """
+
+    name = 'sontek'
+    beam_angle = 25
+    db_per_count = 0.43
+
+
+@register_backend
+class SyntheticBackend(NativeBackend):
+    """
+    Arrays from synthetic.synthetic_profile, for tests and benchmarks
+    """
+
+    name = 'synthetic'
+    beam_angle = 20
+    db_per_count = 0.45
+
+
+class ProfilerQAQC(TRDIDeploymentQAQC):
+    """
+    Runs the TRDIDeploymentQAQC tests on data from any backend
+    """
+
+    @staticmethod
+    def from_source(source, backend='trdi', transducer_depth=None,
+                    stats=None):
+        """
+        Maps source into the common stack with the named backend (see
+        BACKENDS) and QA/QCs it
+        """
+        return ProfilerQAQC(get_backend(backend).to_stack(source),
+                            transducer_depth, stats)
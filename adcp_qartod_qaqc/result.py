@@ -0,0 +1,141 @@
+# Result.py - Compact storage for QARTOD flags
+#
+# All flags of a QA/QC run live in one contiguous uint8 array shaped
+# (test, ensemble, bin).  Every flag value fits in 4 bits, so results
+# can also be packed two flags per byte for storage.
+
+import numpy as np
+
+from adcp_qartod_qaqc.tests import ADCP_FLAGS, QARTOD_TESTS
+
+
+# Flags from least to most severe for the worst flag rollup.  Tests that
+# were not performed never hide the result of a test that was.
+FLAG_PRECEDENCE = (
+    ADCP_FLAGS['no_test'],
+    ADCP_FLAGS['good'],
+    ADCP_FLAGS['suspect'],
+    ADCP_FLAGS['bad'],
+    ADCP_FLAGS['missing_data']
+)
+
+_FLAG_RANK = np.zeros(256, dtype=np.uint8)
+for _rank, _flag in enumerate(FLAG_PRECEDENCE):
+    _FLAG_RANK[_flag] = _rank
+_RANK_FLAG = np.array(FLAG_PRECEDENCE, dtype=np.uint8)
+
+
+class WorstFlag(object):
+    """
+    Running rollup of flag arrays following FLAG_PRECEDENCE.  Add each
+    test's flags as they are computed and read the rollup from flags.
+    """
+
+    def __init__(self, shape):
+        self.rank = np.zeros(shape, dtype=np.uint8)
+
+    def add(self, flags):
+        np.maximum(self.rank, _FLAG_RANK[flags], out=self.rank)
+
+    @property
+    def flags(self):
+        return _RANK_FLAG[self.rank]
+
+
+class QCResult(object):
+    """
+    Flags for several tests backed by one contiguous uint8 array.
+
+    Behaves like a read/write mapping from test name to the test's
+    (ensemble, bin) flags.  The arrays handed out are views into the
+    shared block.
+    """
+
+    def __init__(self, flags, names=QARTOD_TESTS):
+        self.flags = np.ascontiguousarray(flags, dtype=np.uint8)
+        self.names = tuple(names)
+        if len(self.names) != len(self.flags):
+            raise ValueError('Expected flags for %d tests, got %d' %
+                             (len(self.names), len(self.flags)))
+        self.__index = dict((name, i) for i, name in enumerate(self.names))
+
+    @staticmethod
+    def empty(n_ensembles, n_bins, names=QARTOD_TESTS,
+              fill=ADCP_FLAGS['missing_data']):
+        """
+        Allocates a result with every flag set to fill
+        """
+        return QCResult(
+            np.full((len(names), n_ensembles, n_bins), fill, dtype=np.uint8),
+            names
+        )
+
+    @property
+    def shape(self):
+        """
+        (ensemble, bin) shape of each test's flags
+        """
+        return self.flags.shape[1:]
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __contains__(self, name):
+        return name in self.__index
+
+    def __getitem__(self, name):
+        return self.flags[self.__index[name]]
+
+    def __setitem__(self, name, flags):
+        self.flags[self.__index[name]] = flags
+
+    def keys(self):
+        return list(self.names)
+
+    def values(self):
+        return [self[name] for name in self.names]
+
+    def items(self):
+        return [(name, self[name]) for name in self.names]
+
+    def select(self, order):
+        """
+        Returns a new result with the ensembles taken in order
+        """
+        return QCResult(self.flags[:, order], self.names)
+
+    def worst(self):
+        """
+        Aggregate flag of every ensemble and bin: the most severe flag
+        of all tests following FLAG_PRECEDENCE
+        """
+        worst = WorstFlag(self.shape)
+        for flags in self.flags:
+            worst.add(flags)
+        return worst.flags
+
+    def pack(self):
+        """
+        Packs the flags two per byte (first flag in the high nibble)
+        """
+        flat = self.flags.ravel()
+        if len(flat) % 2:
+            flat = np.append(flat, np.uint8(0))
+        return (flat[0::2] << 4) | flat[1::2]
+
+    @staticmethod
+    def unpack(packed, shape, names=QARTOD_TESTS):
+        """
+        Rebuilds a result from pack() output and its (ensemble, bin)
+        shape
+        """
+        packed = np.asarray(packed, dtype=np.uint8)
+        flat = np.empty(2 * len(packed), dtype=np.uint8)
+        flat[0::2] = packed >> 4
+        flat[1::2] = packed & 0x0F
+        n_flags = len(names) * shape[0] * shape[1]
+        return QCResult(flat[:n_flags].reshape((len(names),) + tuple(shape)),
+                        names)
@@ -0,0 +1,179 @@
+# Session.py - Long lived QA/QC session for real time ensemble feeds
+#
+# Fixed leader settings rarely change during a deployment, so the bin
+# geometry and side lobe cutoffs derived from them are computed once
+# for every possible bottom bin and reused until the fixed leader (or
+# transducer depth) changes.  Stateful tests carry their history from
+# one ensemble to the next.
+
+import numpy as np
+
+from adcp_qartod_qaqc import vectorized
+from adcp_qartod_qaqc.config import TestPlan
+from adcp_qartod_qaqc.incremental import StuckSensorTest
+from adcp_qartod_qaqc.tests import QARTOD_TESTS
+from adcp_qartod_qaqc.trdi import (
+    FIXED_LEADER_KEYS,
+    TRDIDeploymentQAQC,
+    side_lobe_stats,
+    stack_ensembles
+)
+
+
+class BinGeometry(object):
+    """
+    Side lobe cutoffs for one fixed leader and
+    transducer depth.  Bottom stats are tabulated for every bottom bin
+    the bottom detection can return (0 to n_bins).
+    """
+
+    def __init__(self, fixed_leader, n_bins, transducer_depth):
+        self.key = BinGeometry.make_key(fixed_leader, n_bins,
+                                        transducer_depth)
+        self.n_bins = n_bins
+        self.transducer_depth = transducer_depth
+        self.fixed_leader = dict((key, fixed_leader[key])
+                                 for key in FIXED_LEADER_KEYS)
+
+        self.tables = side_lobe_stats(np.arange(n_bins + 1),
+                                      self.fixed_leader, transducer_depth)
+        self.last_good_bin_masks = vectorized.leading_bin_mask(
+            self.tables['last_good_bin'], n_bins
+        )
+        self.last_good_counter_masks = vectorized.leading_bin_mask(
+            self.tables['last_good_counter'], n_bins
+        )
+
+    @staticmethod
+    def make_key(fixed_leader, n_bins, transducer_depth):
+        return (tuple(fixed_leader[key] for key in FIXED_LEADER_KEYS) +
+                (n_bins, transducer_depth))
+
+    def bottom_stats(self, bottom_bin):
+        """
+        Looks up the bottom stats of an array of bottom bins
+        """
+        return dict((key, table[bottom_bin])
+                    for key, table in self.tables.items())
+
+
+class QCSession(object):
+    """
+    QA/QCs ensembles one at a time (or in small blocks) as they arrive.
+
+    The BinGeometry of the current fixed leader is cached and rebuilt
+    only when the fixed leader, number of bins or transducer depth
+    changes.  The stuck sensor test keeps its history across calls.
+    A config.TestPlan given as plan selects the tests and their limits;
+    every test runs with its default limits otherwise.
+    """
+
+    def __init__(self, transducer_depth=None, stats=None, plan=None):
+        self.transducer_depth = transducer_depth
+        self.stats = stats
+        if plan is None:
+            plan = TestPlan((test, {}) for test in QARTOD_TESTS)
+        self.plan = plan
+        self.geometry = None
+        self.geometry_builds = 0
+        stuck_sensor = {}
+        if 'stuck_sensor' in plan.names:
+            stuck_sensor = plan.kwargs('stuck_sensor')
+        self.stuck_sensor = StuckSensorTest(**stuck_sensor)
+        self.n_ensembles = 0
+        # TRDIDeploymentQAQC of the latest update, for its velocities
+        # and bottom stats, and the worst flag rollup of its flags
+        self.qaqc = None
+        self.worst = None
+
+    def reset(self):
+        self.geometry = None
+        self.stuck_sensor.reset()
+        self.n_ensembles = 0
+        self.qaqc = None
+        self.worst = None
+
+    def __configuration(self, stack):
+        """
+        Returns the fixed leader of every ensemble of a stack as
+        scalars, the number of bins and the transducer depth.  Raises
+        ValueError when they differ between ensembles.
+        """
+
+        fixed_leader = {}
+        for key in FIXED_LEADER_KEYS:
+            values = np.asarray(stack['fixed_leader'][key])
+            if (values != values[0]).any():
+                raise ValueError('%s changes between ensembles' % key)
+            fixed_leader[key] = values[0].item()
+
+        transducer_depth = self.transducer_depth
+        if transducer_depth is None:
+            depths = np.asarray(
+                stack['variable_leader']['depth_of_transducer']
+            )
+            if (depths != depths[0]).any():
+                raise ValueError('depth_of_transducer changes between '
+                                 'ensembles')
+            transducer_depth = depths[0].item()
+
+        return fixed_leader, stack['velocity'].shape[1], transducer_depth
+
+    def geometry_for(self, stack):
+        """
+        Returns the cached BinGeometry for a stack of ensembles,
+        building a new one when their configuration differs
+        """
+
+        fixed_leader, n_bins, transducer_depth = self.__configuration(stack)
+        key = BinGeometry.make_key(fixed_leader, n_bins, transducer_depth)
+        if self.geometry is None or self.geometry.key != key:
+            self.geometry = BinGeometry(fixed_leader, n_bins,
+                                        transducer_depth)
+            self.geometry_builds += 1
+
+        return self.geometry
+
+    def update(self, ensemble):
+        """
+        QA/QCs one ensemble.  Returns a QCResult of (1, bin) flags.
+        """
+        return self.update_many([ensemble])
+
+    def update_many(self, ensembles):
+        """
+        QA/QCs consecutive ensembles sharing one configuration.
+        Returns a QCResult of (ensemble, bin) flags.
+        """
+        return self.update_stack(stack_ensembles(ensembles))
+
+    def update_pd0(self, pd0_data):
+        """
+        QA/QCs consecutive ensembles decoded by adcp_qartod_qaqc.pd0
+        """
+        return self.update_stack(pd0_data.to_stack())
+
+    def update_stack(self, stack):
+        """
+        QA/QCs a stack of consecutive ensembles (see
+        trdi.stack_ensembles) sharing one configuration.  The worst
+        flag rollup of the returned flags is kept in worst.
+        """
+
+        geometry = self.geometry_for(stack)
+        qaqc = TRDIDeploymentQAQC(stack, geometry.transducer_depth,
+                                  self.stats, geometry)
+
+        def stuck_sensor_flag(out=None, **kwargs):
+            # limits were given to self.stuck_sensor
+            return vectorized.apply_bin_mask(
+                self.stuck_sensor.update_many(qaqc.data['echo_intensity']),
+                qaqc.last_good_counter_mask, out
+            )
+
+        flags, self.worst = self.plan.run(
+            qaqc, {'stuck_sensor': stuck_sensor_flag}
+        )
+        self.n_ensembles += qaqc.n_ensembles
+        self.qaqc = qaqc
+        return flags
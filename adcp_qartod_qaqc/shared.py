@@ -0,0 +1,285 @@
+# Shared.py - Multi-process QC of ensemble cubes held in shared memory
+#
+# The stacked ensemble arrays (velocity, correlation, echo intensity,
+# percent good and the leader columns) are copied once into a shared
+# block: multiprocessing.shared_memory where available (Python 3.8+),
+# otherwise a memory-mapped scratch file.  Worker processes attach to
+# the block zero-copy, QA/QC a range of ensembles each and write their
+# flags straight into a shared, preallocated (test, ensemble, bin)
+# uint8 cube.  Tasks only pickle a small description of the blocks, so
+# spreading a deployment over many cores costs almost no serialization.
+
+import os
+import tempfile
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+from adcp_qartod_qaqc import vectorized
+from adcp_qartod_qaqc.incremental import StuckSensorTest
+from adcp_qartod_qaqc.result import QCResult
+from adcp_qartod_qaqc.tests import ADCP_FLAGS, QARTOD_TESTS
+from adcp_qartod_qaqc.trdi import TRDIDeploymentQAQC
+
+ALIGNMENT = 64
+
+
+def _attach_shared_memory(name):
+    try:
+        # Python 3.13+: attaching must not hand the block to this
+        # process's resource tracker, or it is unlinked when we exit
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        return shared_memory.SharedMemory(name=name)
+
+
+class SharedArrays(object):
+    """
+    Named arrays laid out in one shared block.
+
+    Create the block in the parent with create(), hand spec to worker
+    processes and attach() to it there.  Arrays are views of the block,
+    so drop every reference to them before close().  The creator
+    unlink()s the block once all workers are done.
+    """
+
+    def __init__(self, spec, handle, buffer):
+        self.spec = spec
+        self.handle = handle
+        self.arrays = OrderedDict()
+        for name, offset, shape, dtype in spec['layout']:
+            dtype = np.dtype(dtype)
+            size = int(np.prod(shape)) * dtype.itemsize
+            self.arrays[name] = buffer[offset:offset + size].view(
+                dtype
+            ).reshape(shape)
+
+    @staticmethod
+    def create(arrays, use_shared_memory=None, directory=None):
+        """
+        Allocates a block holding arrays, an OrderedDict of name to
+        array, or to a (shape, dtype) pair for an uninitialized array.
+        Uses multiprocessing.shared_memory unless it is unavailable or
+        use_shared_memory is False, in which case the block is a file
+        in directory (the system temporary directory by default).
+        """
+
+        layout = []
+        size = 0
+        for name, array in arrays.items():
+            if isinstance(array, tuple):
+                shape, dtype = array
+                dtype = np.dtype(dtype)
+            else:
+                shape, dtype = np.shape(array), np.asarray(array).dtype
+            if dtype.hasobject:
+                raise ValueError('Cannot share object array %r' % (name,))
+            layout.append((name, size, tuple(shape), dtype.str))
+            size += int(np.prod(shape)) * dtype.itemsize
+            size += -size % ALIGNMENT
+        size = max(size, 1)
+
+        if use_shared_memory is None:
+            use_shared_memory = shared_memory is not None
+        if use_shared_memory:
+            handle = shared_memory.SharedMemory(create=True, size=size)
+            spec = {'name': handle.name}
+            buffer = np.frombuffer(handle.buf, dtype=np.uint8)
+        else:
+            descriptor, path = tempfile.mkstemp(suffix='.qc',
+                                                dir=directory)
+            os.close(descriptor)
+            handle = None
+            spec = {'path': path}
+            buffer = np.memmap(path, dtype=np.uint8, mode='w+',
+                               shape=(size,))
+        spec['size'] = size
+        spec['layout'] = layout
+
+        shared = SharedArrays(spec, handle, buffer)
+        for name, array in arrays.items():
+            if not isinstance(array, tuple):
+                shared[name] = array
+        return shared
+
+    @staticmethod
+    def attach(spec):
+        """
+        Maps the block described by spec zero-copy
+        """
+        if 'name' in spec:
+            handle = _attach_shared_memory(spec['name'])
+            buffer = np.frombuffer(handle.buf, dtype=np.uint8)
+        else:
+            handle = None
+            buffer = np.memmap(spec['path'], dtype=np.uint8, mode='r+',
+                               shape=(spec['size'],))
+        return SharedArrays(spec, handle, buffer)
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def __setitem__(self, name, values):
+        self.arrays[name][...] = values
+
+    def close(self):
+        """
+        Detaches this process from the block
+        """
+        self.arrays.clear()
+        if self.handle is not None:
+            self.handle.close()
+
+    def unlink(self):
+        """
+        Frees the block.  Call once, from the process that created it.
+        """
+        if self.handle is not None:
+            self.handle.unlink()
+        elif os.path.exists(self.spec['path']):
+            os.remove(self.spec['path'])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def flatten_stack(stack):
+    """
+    Splits a stack into the per-ensemble arrays to share, keyed
+    'section/key' for the leader sections, and the remaining small
+    values, which are passed to workers as they are
+    """
+
+    n_ensembles = len(stack['velocity'])
+    arrays = OrderedDict()
+    constants = {}
+    for section, value in sorted(stack.items()):
+        items = (value.items() if isinstance(value, dict)
+                 else [(None, value)])
+        for key, item in sorted(items):
+            name = section if key is None else section + '/' + key
+            if np.ndim(item) and len(item) == n_ensembles:
+                arrays[name] = np.asarray(item)
+            else:
+                constants[name] = item
+
+    return arrays, constants
+
+
+def unflatten_stack(arrays, constants, start=0, stop=None):
+    """
+    Rebuilds a stack from flatten_stack output with ensembles
+    start:stop.  Shared arrays stay views.
+    """
+
+    stack = {}
+    values = [(name, array[start:stop]) for name, array in arrays.items()]
+    for name, value in values + list(constants.items()):
+        section, _, key = name.partition('/')
+        if key:
+            stack.setdefault(section, {})[key] = value
+        else:
+            stack[section] = value
+
+    return stack
+
+
+def _qc_views(stack, flags, transducer_depth, names, echo_history):
+    qaqc = TRDIDeploymentQAQC(stack, transducer_depth)
+    methods = qaqc.test_methods()
+    for i, name in enumerate(names):
+        methods[name](out=flags[i])
+
+    if 'stuck_sensor' in names and len(echo_history):
+        # continue the stuck sensor runs of the ensembles before start
+        stuck_sensor = StuckSensorTest()
+        stuck_sensor.update_many(echo_history)
+        vectorized.apply_bin_mask(
+            stuck_sensor.update_many(stack['echo_intensity']),
+            qaqc.last_good_counter_mask,
+            out=flags[names.index('stuck_sensor')]
+        )
+
+    return qaqc.n_ensembles
+
+
+def qc_range(input_spec, output_spec, constants, start, stop,
+             transducer_depth=None, names=QARTOD_TESTS):
+    """
+    QA/QCs ensembles start:stop of the shared stack described by
+    input_spec into the shared flag cube of output_spec.  Returns the
+    number of ensembles and the seconds taken.
+    """
+
+    started = time.time()
+    arrays = SharedArrays.attach(input_spec)
+    output = SharedArrays.attach(output_spec)
+    try:
+        history = StuckSensorTest().history_size
+        n_ensembles = _qc_views(
+            unflatten_stack(arrays.arrays, constants, start, stop),
+            output['flags'][:, start:stop], transducer_depth, list(names),
+            arrays['echo_intensity'][max(0, start - history):start]
+        )
+    finally:
+        arrays.close()
+        output.close()
+
+    return {'start': start, 'n_ensembles': n_ensembles,
+            'seconds': time.time() - started}
+
+
+def _qc_range(arguments):
+    return qc_range(*arguments)
+
+
+def run_shared(stack, workers=None, chunk_size=1000, transducer_depth=None,
+               names=QARTOD_TESTS, use_shared_memory=None, directory=None):
+    """
+    QA/QCs a stack (see TRDIDeploymentQAQC) chunk_size ensembles per
+    task in a pool of worker processes that share the stack and the
+    flag cube.  Flags are identical to TRDIDeploymentQAQC.flags() on
+    the whole stack.  Returns a QCResult.
+    """
+
+    arrays, constants = flatten_stack(stack)
+    n_ensembles, n_bins = stack['velocity'].shape[:2]
+    names = tuple(names)
+
+    inputs = SharedArrays.create(arrays, use_shared_memory, directory)
+    outputs = SharedArrays.create(
+        OrderedDict([('flags', ((len(names), n_ensembles, n_bins),
+                                np.uint8))]),
+        use_shared_memory, directory
+    )
+    try:
+        outputs['flags'] = ADCP_FLAGS['missing_data']
+        tasks = [(inputs.spec, outputs.spec, constants, start,
+                  min(start + chunk_size, n_ensembles), transducer_depth,
+                  names)
+                 for start in range(0, n_ensembles, chunk_size)]
+        if workers == 1:
+            for task in tasks:
+                _qc_range(task)
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(_qc_range, tasks))
+
+        result = QCResult(np.array(outputs['flags']), names)
+    finally:
+        inputs.close()
+        outputs.close()
+        inputs.unlink()
+        outputs.unlink()
+
+    return result
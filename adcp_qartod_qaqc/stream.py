@@ -0,0 +1,52 @@
+# Stream.py - Runs the QARTOD tests over ensembles in fixed-size chunks
+#
+# Ensembles are pulled from any iterable (a reader generator, a list,
+# synthetic_ensembles, ...) so peak memory is bounded by the chunk size
+# instead of the size of the file.
+
+from adcp_qartod_qaqc import vectorized
+from adcp_qartod_qaqc.incremental import StuckSensorTest
+from adcp_qartod_qaqc.trdi import TRDIDeploymentQAQC
+
+
+def iter_chunks(ensembles, chunk_size):
+    """
+    Groups any iterable of ensembles into lists of at most chunk_size
+    ensembles without reading ahead of the current chunk
+    """
+
+    if chunk_size < 1:
+        raise ValueError('chunk_size must be at least 1')
+
+    chunk = []
+    for ensemble in ensembles:
+        chunk.append(ensemble)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+
+def stream_flags(ensembles, chunk_size=1000, transducer_depth=None):
+    """
+    Runs the QARTOD battery on each chunk of ensembles.
+
+    Yields (first_ensemble, flags) tuples where first_ensemble is the
+    index of the chunk's first ensemble in the stream and flags is the
+    QCResult returned by TRDIDeploymentQAQC.flags().  The
+    stuck sensor test carries its history across chunks.
+    """
+
+    stuck_sensor = StuckSensorTest()
+    first_ensemble = 0
+    for chunk in iter_chunks(ensembles, chunk_size):
+        qaqc = TRDIDeploymentQAQC.from_ensembles(chunk, transducer_depth)
+        flags = qaqc.flags()
+        flags['stuck_sensor'] = vectorized.apply_bin_mask(
+            stuck_sensor.update_many(qaqc.data['echo_intensity']),
+            qaqc.last_good_counter_mask
+        )
+        yield first_ensemble, flags
+        first_ensemble += len(chunk)
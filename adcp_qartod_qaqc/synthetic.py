@@ -0,0 +1,268 @@
+# Synthetic.py - Generates fake TRDI ADCP ensembles for tests and benchmarks
+#
+# Ensembles use the same dictionary layout as trdi_adcp_readers so they
+# can be fed straight to the QAQC classes.
+
+import numpy as np
+
+from adcp_qartod_qaqc import pd0
+
+
+def synthetic_ensembles(n_ensembles, n_bins, n_beams=4,
+                        bottom_bin=None, seed=None):
+    """
+    Yields n_ensembles ensemble dictionaries with n_bins bins.
+
+    Velocities are in cm/s.  Echo intensity decays away from the
+    transducer and jumps up at bottom_bin (random per ensemble when
+    not given) so the bottom detection has something to find.
+    """
+
+    random = np.random.RandomState(seed)
+    bins = np.arange(n_bins)
+    for ensemble_number in range(n_ensembles):
+        if bottom_bin is None:
+            ensemble_bottom = random.randint(n_bins // 2, n_bins + 1)
+        else:
+            ensemble_bottom = bottom_bin
+
+        echo = (180 - 3 * bins[:, np.newaxis] +
+                random.randint(-1, 2, (n_bins, n_beams)))
+        echo[ensemble_bottom:] += 60
+        echo = np.clip(echo, 0, 255)
+
+        velocity = random.normal(0, 40, (n_bins, n_beams))
+        velocity[:, 2] /= 10.0
+        velocity[:, 3] = np.abs(random.normal(0, 2, n_bins))
+
+        yield {
+            'fixed_leader': {
+                'number_of_cells': n_bins,
+                'number_of_beams': n_beams,
+                'depth_cell_length': 100,
+                'bin_1_distance': 176,
+                'beam_angle': 20
+            },
+            'variable_leader': {
+                'ensemble_number': ensemble_number,
+                'bit_result': '0',
+                'speed_of_sound': int(random.randint(1480, 1540)),
+                'depth_of_transducer': 104,
+                'heading': int(random.randint(0, 36000)),
+                'pitch': int(random.randint(-500, 500)),
+                'roll': int(random.randint(-500, 500)),
+                'temperature': int(random.randint(1500, 3000))
+            },
+            'velocity': {'data': velocity.tolist()},
+            'correlation': {
+                'data': random.randint(60, 140, (n_bins, n_beams)).tolist()
+            },
+            'echo_intensity': {'data': echo.tolist()},
+            'percent_good': {
+                'data': random.randint(0, 60, (n_bins, n_beams)).tolist()
+            }
+        }
+
+
+def synthetic_profile(n_ensembles, n_bins, n_beams=4, noise_floor=25,
+                      bottom_bin=None, seed=None):
+    """
+    Returns the arrays of n_ensembles synthetic_ensembles in the native
+    layout read by profiler.NativeBackend: SI units, correlation in
+    percent and a per-beam noise floor in counts
+    """
+
+    random = np.random.RandomState(seed)
+    ensembles = list(synthetic_ensembles(n_ensembles, n_bins, n_beams,
+                                         bottom_bin=bottom_bin, seed=seed))
+
+    def stacked(section):
+        return np.array([ensemble[section]['data']
+                         for ensemble in ensembles])
+
+    def leader(key, scale):
+        return np.array([ensemble['variable_leader'][key]
+                         for ensemble in ensembles]) * scale
+
+    fixed_leader = ensembles[0]['fixed_leader']
+    return {
+        'velocity': stacked('velocity') / 100.,
+        'amplitude': stacked('echo_intensity'),
+        'correlation': stacked('correlation') * 100. / 255,
+        'noise': random.randint(noise_floor - 3, noise_floor + 4,
+                                (n_ensembles, n_beams)),
+        'cell_size': fixed_leader['depth_cell_length'] / 100.,
+        'blanking': (fixed_leader['bin_1_distance'] -
+                     fixed_leader['depth_cell_length'] / 2.) / 100.,
+        'pitch': leader('pitch', 0.01),
+        'roll': leader('roll', 0.01),
+        'heading': leader('heading', 0.01),
+        'temperature': leader('temperature', 0.01),
+        'sound_speed': leader('speed_of_sound', 1),
+        'transducer_depth': leader('depth_of_transducer', 0.1)
+    }
+
+
+class SyntheticMultiread(object):
+    """
+    Attribute container shaped like the output of University of
+    Hawaii's Multiread.read() for exercising trdiUH.TRDIQAQC
+    """
+
+    VL_DTYPE = np.dtype([
+        ('EnsNum', np.uint16), ('Year', np.uint8), ('Month', np.uint8),
+        ('Day', np.uint8), ('Hour', np.uint8), ('Minute', np.uint8),
+        ('Second', np.uint8), ('Hundredths', np.uint8),
+        ('EnsNumMSB', np.uint8), ('BIT', np.uint16),
+        ('SoundSpeed', np.uint16), ('XducerDepth', np.uint16),
+        ('Heading', np.uint16), ('Pitch', np.int16), ('Roll', np.int16),
+        ('Salinity', np.uint16), ('Temperature', np.int16),
+        ('Pressure', np.uint32)
+    ])
+
+
+def synthetic_multiread(n_ensembles, n_bins, bottom_bin=None, seed=None):
+    """
+    Returns a SyntheticMultiread holding n_ensembles ensembles built
+    from synthetic_ensembles.  Velocities are in m/s as masked arrays.
+    """
+
+    stack = {'velocity': [], 'correlation': [],
+             'echo_intensity': [], 'percent_good': [], 'VL': []}
+    for ensemble in synthetic_ensembles(n_ensembles, n_bins,
+                                        bottom_bin=bottom_bin, seed=seed):
+        for section in ('velocity', 'correlation',
+                        'echo_intensity', 'percent_good'):
+            stack[section].append(ensemble[section]['data'])
+        leader = ensemble['variable_leader']
+        number = leader['ensemble_number']
+        stack['VL'].append(
+            (number % 65536, 14, 7, 1, number // 3600 % 24,
+             number // 60 % 60, number % 60, 0, number // 65536,
+             int(leader['bit_result']), leader['speed_of_sound'],
+             leader['depth_of_transducer'], leader['heading'],
+             leader['pitch'], leader['roll'], 35000,
+             leader['temperature'], 100000)
+        )
+
+    data = SyntheticMultiread()
+    velocity = np.array(stack['velocity']) / 100.
+    for beam in range(4):
+        setattr(data, 'vel%d' % (beam + 1),
+                np.ma.masked_invalid(velocity[..., beam]))
+        setattr(data, 'cor%d' % (beam + 1),
+                np.array(stack['correlation'])[..., beam])
+        setattr(data, 'pg%d' % (beam + 1),
+                np.array(stack['percent_good'])[..., beam])
+    data.amp = np.array(stack['echo_intensity'], dtype=np.uint8)
+    data.VL = np.array(stack['VL'], dtype=SyntheticMultiread.VL_DTYPE)
+    data.yearbase = 2014
+    data.nprofs = n_ensembles
+    data.NCells = n_bins
+    data.Bin1Dist = 1.76
+    data.dep = data.Bin1Dist + np.arange(n_bins) * 1.0
+    data.sysconfig = {'kHz': 600, 'angle': 20, 'up': True}
+    data.heading = data.VL['Heading'] / 100.
+    data.pitch = data.VL['Pitch'] / 100.
+    data.roll = data.VL['Roll'] / 100.
+    data.temperature = data.VL['Temperature'] / 100.
+
+    data.FL = SyntheticMultiread()
+    data.FL.CellSize = 100
+    data.FL.Blank = 176
+    data.FL.NPings = 60
+    data.FL.TransLag = 49
+    data.FL.Pulse = 113
+    data.FL.TPP_min = 0
+    data.FL.TPP_sec = 1
+    data.FL.TPP_hun = 0
+    data.FL.EV = 0
+
+    return data
+
+
+def encode_pd0(ensemble):
+    """
+    Encodes a synthetic ensemble dictionary as a PD0 binary ensemble
+    with fixed leader, variable leader, velocity and the correlation,
+    echo intensity and percent good data types the ensemble has
+    """
+
+    fixed = ensemble['fixed_leader']
+    variable = ensemble['variable_leader']
+    velocity = np.asarray(ensemble['velocity']['data'], dtype=float)
+    n_bins, n_beams = velocity.shape
+
+    fixed_leader = np.zeros(59, dtype=np.uint8)
+    record = fixed_leader[:pd0.FIXED_LEADER_DTYPE.itemsize].view(
+        pd0.FIXED_LEADER_DTYPE
+    )
+    angle_codes = dict((angle, code)
+                       for code, angle in pd0.BEAM_ANGLES.items())
+    record['id'] = pd0.FIXED_LEADER_ID
+    record['system_configuration'] = (
+        (0x40 | angle_codes[fixed['beam_angle']]) << 8 | 0xCB
+    )
+    record['number_of_beams'] = n_beams
+    record['number_of_cells'] = n_bins
+    record['depth_cell_length'] = fixed['depth_cell_length']
+    record['bin_1_distance'] = fixed['bin_1_distance']
+
+    variable_leader = np.zeros(65, dtype=np.uint8)
+    record = variable_leader[:pd0.VARIABLE_LEADER_DTYPE.itemsize].view(
+        pd0.VARIABLE_LEADER_DTYPE
+    )
+    number = variable['ensemble_number']
+    record['id'] = pd0.VARIABLE_LEADER_ID
+    record['ensemble_number'] = number % 65536
+    record['ensemble_number_msb'] = number // 65536
+    record['rtc_year'] = 14
+    record['rtc_month'] = 7
+    record['rtc_day'] = 1
+    record['rtc_hour'] = number // 3600 % 24
+    record['rtc_minute'] = number // 60 % 60
+    record['rtc_second'] = number % 60
+    record['bit_result'] = int(variable['bit_result'])
+    for key in ('speed_of_sound', 'depth_of_transducer', 'heading',
+                'pitch', 'roll', 'temperature'):
+        record[key] = variable[key]
+
+    velocity = np.where(np.isnan(velocity), pd0.BAD_VELOCITY,
+                        np.round(velocity * 10))
+    data_types = [
+        fixed_leader.tobytes(),
+        variable_leader.tobytes(),
+        np.uint16(pd0.VELOCITY_ID).tobytes() +
+        velocity.astype('<i2').tobytes()
+    ]
+    for type_id, key in ((pd0.CORRELATION_ID, 'correlation'),
+                         (pd0.ECHO_INTENSITY_ID, 'echo_intensity'),
+                         (pd0.PERCENT_GOOD_ID, 'percent_good')):
+        if key not in ensemble:
+            continue
+        data_types.append(
+            np.uint16(type_id).tobytes() +
+            np.asarray(ensemble[key]['data'], dtype=np.uint8).tobytes()
+        )
+
+    header_size = 6 + 2 * len(data_types)
+    offsets = np.cumsum([header_size] +
+                        [len(data) for data in data_types[:-1]])
+    n_bytes = header_size + sum(len(data) for data in data_types)
+    header = (pd0.HEADER_ID +
+              np.array([n_bytes], dtype='<u2').tobytes() +
+              np.array([0, len(data_types)], dtype=np.uint8).tobytes() +
+              offsets.astype('<u2').tobytes())
+    body = header + b''.join(data_types)
+    checksum = np.frombuffer(body, dtype=np.uint8).sum() % 65536
+
+    return body + np.array([checksum], dtype='<u2').tobytes()
+
+
+def write_pd0(fileobj, ensembles):
+    """
+    Writes ensemble dictionaries to an open binary file as PD0
+    """
+
+    for ensemble in ensembles:
+        fileobj.write(encode_pd0(ensemble))
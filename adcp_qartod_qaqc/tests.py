@@ -8,7 +8,10 @@
 # By: Jeff Donovan <jdonovan@usf.edu>
 #     Michael Lindemuth <mlindemu@usf.edu>
 
-from itertools import izip
+try:
+    from itertools import izip
+except ImportError:
+    izip = zip
 
 
 ADCP_FLAGS = {
@@ -19,6 +22,29 @@ ADCP_FLAGS = {
     'missing_data': 9
 }
 
+# Flag sets in QARTOD test order, keyed as in the QAQC classes
+QARTOD_TESTS = (
+    'battery',
+    'checksum',
+    'bit',
+    'orientation',
+    'sound_speed',
+    'noise_floor',
+    'signal_strength',
+    'signal_to_noise',
+    'correlation_magnitude',
+    'percent_good',
+    'current_speed',
+    'current_direction',
+    'horizontal_velocity',
+    'vertical_velocity',
+    'error_velocity',
+    'stuck_sensor',
+    'echo_intensity',
+    'range_drop_off',
+    'current_speed_gradient'
+)
+
 
 def battery_flag_test(ensemble):
     """
@@ -31,15 +57,18 @@ def battery_flag_test(ensemble):
     return ADCP_FLAGS['no_test']
 
 
-def checksum_test(ensemble):
+def checksum_test(ensemble, checksum_ok=True):
     """
     QARTOD Test #2 Required
-    The fact that this code is running means that the checksum was tested
-    and passed the test. If the checksum test fails, we will not load anything
-    into the database.
+    Readers that do not report the checksum only return ensembles that
+    passed it, so the test passes unless checksum_ok says otherwise.
+    The pd0 decoder verifies the checksum of every ensemble.
     """
 
-    return ADCP_FLAGS['good']
+    if checksum_ok:
+        return ADCP_FLAGS['good']
+    else:
+        return ADCP_FLAGS['bad']
 
 
 def bit_test(bit_flag):
@@ -47,7 +76,7 @@ def bit_test(bit_flag):
     Not an official QARTOD test.  Checks special TRDI bit flag.
     """
 
-    if bit_flag == '0':
+    if str(bit_flag) == '0':
         return ADCP_FLAGS['good']
     else:
         return ADCP_FLAGS['bad']
@@ -253,27 +282,51 @@ def error_velocity_test(error_velocities,
     return flags
 
 
-def stuck_sensor_test(echo_intensities, previous_intensities, tolerance=4):
+def stuck_sensor_test(echo_intensities, previous_intensities=None,
+                      tolerance=4):
     """
     QARTOD Test #15 Strongly Recommended
 
     Input:
         echo_intensities - A set of ADCP echo intensity bins
-        previous_intensities - A set of previous echo intensities
+        previous_intensities - Echo intensity bins of previous
+            ensembles, oldest first.  Without them the test
+            is not performed.
         tolerance (optional) - the number of same sensor values
             allowed.  Default: 4
 
     Output:
-        flags - Flags for each beam
+        flags - Flags for each bin.  A bin is bad when any of its beams
+            repeats the same value more than tolerance times.
 
     NOTE:
     This test is not performed by COMPS. For as long as I have been involved
     in QARTOD, real time tests were meant to be performed on the current
     sample as if it were the only sample. This test requires examinimg the
     historical samples and is therefore NOT a real time data test.
+    incremental.StuckSensorTest keeps just enough history to run it in real
+    time.
     """
 
-    return ADCP_FLAGS['no_test']
+    if previous_intensities is None or len(previous_intensities) == 0:
+        return ADCP_FLAGS['no_test']
+
+    flags = []
+    for bin_number, bin in enumerate(echo_intensities):
+        bin_flag = ADCP_FLAGS['good']
+        for beam_number, beam in enumerate(bin):
+            run_length = 1
+            for previous in reversed(previous_intensities):
+                if previous[bin_number][beam_number] != beam:
+                    break
+                run_length += 1
+
+            if run_length > tolerance:
+                bin_flag = ADCP_FLAGS['bad']
+
+        flags.append(bin_flag)
+
+    return flags
 
 
 def echo_intensity_test(echo_intensities, tolerance=2):
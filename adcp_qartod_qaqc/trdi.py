@@ -1,10 +1,22 @@
 
 import math
-from itertools import imap
+from collections import OrderedDict
+try:
+    from itertools import imap
+except ImportError:
+    imap = map
 
 from operator import itemgetter
 
+import numpy as np
+
+from adcp_qartod_qaqc import vectorized
+from adcp_qartod_qaqc.fields import VelocityFields
+from adcp_qartod_qaqc.instrumentation import timed
+from adcp_qartod_qaqc.result import QCResult, WorstFlag
 from adcp_qartod_qaqc.tests import (
+    ADCP_FLAGS,
+    QARTOD_TESTS,
     battery_flag_test,
     checksum_test,
     bit_test,
@@ -34,15 +46,18 @@ class TRDIQAQC(object):
     "IOOS:
     Manual for Real-Time Quality Control of In-Situ Current Observations"
 
-    Works on 1 ensemble at a time
+    Works on 1 ensemble at a time.  Pass a QCStats as stats to
+    record the time spent in every test and setup phase.
 
     By: Jeff Donovan <jdonovan@usf.edu> & Michael Lindemuth <mlindemu@usf.edu>
     University of South Florida
     College of Marine Science
     """
 
-    def __init__(self, data, transducer_depth=None):
+    def __init__(self, data, transducer_depth=None, stats=None):
         self.data = data
+        self.stats = stats
+        self.stats_bins = len(self.data['velocity']['data'])
 
         if transducer_depth is not None:
             self.transducer_depth = transducer_depth
@@ -54,35 +69,28 @@ class TRDIQAQC(object):
         self.__read_velocities()
         self.__calc_bottom_stats()
 
+    @timed
     def __read_velocities(self):
         """
-        Calculates z magnitude and direction given
-        east (u), north(v), and vertical(w) velocities
-        """
-
-        self.u = []
-        self.v = []
-        self.w = []
-        self.z = []
-        self.current_speed = []
-        self.current_direction = []
-        for bin in self.data['velocity']['data']:
-            u = bin[0]
-            v = bin[1]
-            w = bin[2]
-            z = u + 1j * v
-            self.u.append(u)
-            self.v.append(v)
-            self.w.append(w)
-            self.z.append(z)
-
-            self.current_speed.append(abs(z))
-            direction = math.atan2(z.real, z.imag)*180/math.pi
-            if direction < 360:
-                direction = direction + 360
-
-            self.current_direction.append(direction)
+        Reads east (u), north(v), and vertical(w) velocities.
+        Current speed and direction are derived from them on first use.
+        """
+
+        velocity = np.asarray(self.data['velocity']['data'], dtype=float)
+        self.u = velocity[:, 0]
+        self.v = velocity[:, 1]
+        self.w = velocity[:, 2]
+        self.fields = VelocityFields(self.u, self.v)
+
+    @property
+    def current_speed(self):
+        return self.fields.speed
 
+    @property
+    def current_direction(self):
+        return self.fields.direction
+
+    @timed
     def __calc_bottom_stats(self, tolerance=30):
         bottom_bin = 1
         intensity = self.data['echo_intensity']['data']
@@ -100,13 +108,13 @@ class TRDIQAQC(object):
 
         bottom_stats = {}
         bottom_stats['bottom_bin'] = bottom_bin
-        self.data['fixed_leader']['bin_1_distance'] = (
+        bin_1_distance = (
             (self.data['fixed_leader']['bin_1_distance'] + self.transducer_depth) / 100  # NOQA
         )
         bottom_stats['range_to_bottom'] = (
             bottom_stats['bottom_bin'] *
             self.data['fixed_leader']['depth_cell_length'] / 100.0 +
-            self.data['fixed_leader']['bin_1_distance'] / 100.0
+            bin_1_distance / 100.0
         )
         bottom_stats['side_lobe_start'] = (
             int(
@@ -125,6 +133,7 @@ class TRDIQAQC(object):
         self.last_good_bin = bottom_stats['last_good_bin']
         self.last_good_counter = bottom_stats['last_good_counter']
 
+    @timed
     def battery_flag(self):
         """
         QARTOD Test #1 Strongly Recommended
@@ -135,6 +144,7 @@ class TRDIQAQC(object):
         """
         return battery_flag_test(self.data)
 
+    @timed
     def checksum_flag(self):
         """
         QARTOD Test #2 Required
@@ -144,6 +154,7 @@ class TRDIQAQC(object):
         """
         return checksum_test(self.data)
 
+    @timed
     def bit_flag(self):
         """
         Not an official QARTOD test.  Checks special TRDI bit flag.
@@ -152,6 +163,7 @@ class TRDIQAQC(object):
 
         return bit_flags
 
+    @timed
     def orientation_flags(self, max_pitch=20, max_roll=20):
         """
         QARTOD Test #3 Required: orientation (pitch and roll) tests
@@ -161,6 +173,7 @@ class TRDIQAQC(object):
         return orientation_test(pitch, roll,
                                 max_pitch, max_roll)
 
+    @timed
     def sound_speed_flags(self, sound_speed_min=1400, sound_speed_max=1600):
         """
         QARTOD Test 4 Required: Sound speed test
@@ -170,6 +183,7 @@ class TRDIQAQC(object):
                              sound_speed_min, sound_speed_max)
         )
 
+    @timed
     def noise_floor_flag(self):
         """
         QARTOD Test #5 Strongly Recommended
@@ -177,6 +191,7 @@ class TRDIQAQC(object):
         """
         return noise_floor_test(self.data)
 
+    @timed
     def signal_strength_flag(self):
         """
         QARTOD Test #6 Strongly Recommended
@@ -184,6 +199,7 @@ class TRDIQAQC(object):
         """
         return signal_strength_test(self.data)
 
+    @timed
     def signal_to_noise_flag(self):
         """
         QARTOD Test #7 Strongly Recommended
@@ -191,6 +207,7 @@ class TRDIQAQC(object):
         """
         return signal_to_noise_test(self.data)
 
+    @timed
     def correlation_magnitude_flags(self,
                                     good_tolerance=115,
                                     questionable_tolerance=64):
@@ -205,6 +222,7 @@ class TRDIQAQC(object):
                                        questionable_tolerance)
         )
 
+    @timed
     def percent_good_flags(self, percent_good=21, percent_bad=17):
         """
         QARTOD Test #9 Required
@@ -221,6 +239,7 @@ class TRDIQAQC(object):
                               percent_good, percent_bad)
         )
 
+    @timed
     def current_speed_flags(self, max_speed=150):
         """
         QARTOD Test #10 Required
@@ -230,6 +249,7 @@ class TRDIQAQC(object):
 
         return current_speed_test(self.current_speed[:self.last_good_counter])
 
+    @timed
     def current_direction_flags(self):
         """
         QARTOD Test #11 Required
@@ -240,6 +260,7 @@ class TRDIQAQC(object):
 
         return current_direction_test(self.current_direction[:self.last_good_counter])  # NOQA
 
+    @timed
     def horizontal_velocity_flags(self,
                                   max_u_vel=150, max_v_vel=150):
         """
@@ -253,6 +274,7 @@ class TRDIQAQC(object):
                                         self.v[:self.last_good_counter],
                                         max_u_vel, max_v_vel)
 
+    @timed
     def vertical_velocity_flags(self, max_w_velocity=15):
         """
         QARTOD Test #13 Strongly Recommended
@@ -263,6 +285,7 @@ class TRDIQAQC(object):
         return vertical_velocity_test(self.w[:self.last_good_counter],
                                       max_w_velocity)
 
+    @timed
     def error_velocity_flags(self,
                              questionable_error_velocity=2.6,
                              bad_error_velocity=5.2):
@@ -280,17 +303,21 @@ class TRDIQAQC(object):
                                    questionable_error_velocity,
                                    bad_error_velocity)
 
-    def stuck_sensor_flag(self):
+    @timed
+    def stuck_sensor_flag(self, previous_intensities=None, tolerance=4):
         """
         QARTOD Test #15 Strongly Recommended
-        This test will not be performed. For as long as I have been involved
+        This test is only performed when the echo intensities of previous
+        ensembles are given.  For as long as I have been involved
         in QARTOD, real time tests were meant to be performed on the current
         sample as if it were the only sample. This test requires examinimg the
         historical samples and is therefore NOT a real time data test.
         """
 
-        return stuck_sensor_test(self.data)
+        return stuck_sensor_test(self.data['echo_intensity']['data'],
+                                 previous_intensities, tolerance)
 
+    @timed
     def echo_intensity_flags(self, tolerance=2):
         """
         QARTOD Test #16 Required
@@ -300,6 +327,7 @@ class TRDIQAQC(object):
         echo_intensities = self.data['echo_intensity']['data'][:self.last_good_counter]  # NOQA
         return echo_intensity_test(echo_intensities)
 
+    @timed
     def range_drop_off_flags(self, drop_off_limit=60):
         """
         QARTOD Test #17 Strongly Recommended
@@ -311,6 +339,7 @@ class TRDIQAQC(object):
         echo_intensities = self.data['echo_intensity']['data'][:self.last_good_counter]  # NOQA
         return range_drop_off_test(echo_intensities, drop_off_limit)
 
+    @timed
     def current_speed_gradient_flags(self, tolerance=6):
         """
         QARTOD Test #18 Strongly Recommended
@@ -320,12 +349,594 @@ class TRDIQAQC(object):
         return current_speed_gradient_test(self.current_speed,
                                            tolerance)
 
+
+FIXED_LEADER_KEYS = ('depth_cell_length', 'bin_1_distance', 'beam_angle')
+VARIABLE_LEADER_KEYS = ('bit_result', 'pitch', 'roll', 'speed_of_sound',
+                        'depth_of_transducer', 'heading', 'temperature')
+
+
+def side_lobe_stats(bottom_bin, fixed_leader, transducer_depth):
+    """
+    Range to bottom and side lobe cutoff bins for the bins found by the
+    bottom detection.  Works on scalars and on arrays alike.
+    """
+
+    bin_1_distance = (
+        (fixed_leader['bin_1_distance'] + transducer_depth) / 100
+    )
+    bottom_stats = {}
+    bottom_stats['bottom_bin'] = bottom_bin
+    bottom_stats['range_to_bottom'] = (
+        bottom_bin * fixed_leader['depth_cell_length'] / 100.0 +
+        bin_1_distance / 100.0
+    )
+    bottom_stats['side_lobe_start'] = np.trunc(
+        np.cos(fixed_leader['beam_angle'] * np.pi/180.0) *
+        bottom_stats['range_to_bottom']
+    ).astype(int)
+    bottom_stats['last_good_bin'] = bottom_stats['side_lobe_start'] - 1
+    bottom_stats['last_good_counter'] = (
+        bottom_stats['last_good_bin'] - 1
+    )
+    return bottom_stats
+
+
+def stack_ensembles(ensembles):
+    """
+    Stacks ensembles as read by trdi_adcp_readers into one dictionary of
+    arrays.  Profile data is shaped (ensemble, bin, beam) and leader
+    values are shaped (ensemble,).  All ensembles must have the same
+    number of bins.
+    """
+
+    ensembles = list(ensembles)
+    stack = {}
+    for section in ('velocity', 'correlation',
+                    'echo_intensity', 'percent_good'):
+        stack[section] = np.array(
+            [ensemble[section]['data'] for ensemble in ensembles]
+        )
+
+    for section, keys in (('fixed_leader', FIXED_LEADER_KEYS),
+                          ('variable_leader', VARIABLE_LEADER_KEYS)):
+        stack[section] = dict(
+            (key, np.array([ensemble[section][key]
+                            for ensemble in ensembles]))
+            for key in keys
+        )
+
+    return stack
+
+
+class TRDIDeploymentQAQC(object):
+    """
+    Performs the TRDIQAQC tests on a whole deployment at once.
+
+    Takes a stack of ensembles (see stack_ensembles and
+    pd0.PD0Data.to_stack) and returns every flag set as a dense uint8
+    (ensemble, bin) array.  Ensemble level tests are repeated across
+    bins and bins past the side lobe cutoff of each ensemble are
+    flagged as missing_data.  Pass a QCStats as stats to record the
+    time spent in every test and setup phase.
+
+    A session.BinGeometry given as geometry replaces the side lobe
+    calculation with table lookups.  All ensembles must then share the
+    fixed leader and transducer depth the geometry was built for.
+    """
+
+    # Method running each test, keyed by QARTOD_TESTS name
+    TEST_METHODS = OrderedDict(zip(QARTOD_TESTS, (
+        'battery_flag',
+        'checksum_flag',
+        'bit_flag',
+        'orientation_flags',
+        'sound_speed_flags',
+        'noise_floor_flag',
+        'signal_strength_flag',
+        'signal_to_noise_flag',
+        'correlation_magnitude_flags',
+        'percent_good_flags',
+        'current_speed_flags',
+        'current_direction_flags',
+        'horizontal_velocity_flags',
+        'vertical_velocity_flags',
+        'error_velocity_flags',
+        'stuck_sensor_flag',
+        'echo_intensity_flags',
+        'range_drop_off_flags',
+        'current_speed_gradient_flags'
+    )))
+
+    @staticmethod
+    def from_ensembles(ensembles, transducer_depth=None, stats=None):
+        """
+        A convenience method to QA/QC a sequence of ensemble dictionaries
+        """
+        return TRDIDeploymentQAQC(stack_ensembles(ensembles),
+                                  transducer_depth, stats)
+
+    @staticmethod
+    def from_pd0(pd0_data, transducer_depth=None, stats=None):
+        """
+        A convenience method to QA/QC every ensemble decoded by
+        adcp_qartod_qaqc.pd0
+        """
+        return TRDIDeploymentQAQC(pd0_data.to_stack(), transducer_depth,
+                                  stats)
+
+    def __init__(self, stack, transducer_depth=None, stats=None,
+                 geometry=None):
+        self.data = stack
+        self.stats = stats
+        self.geometry = geometry
+
+        if transducer_depth is not None:
+            self.transducer_depth = transducer_depth
+        else:
+            self.transducer_depth = (
+                self.data['variable_leader']['depth_of_transducer']
+            )
+
+        self.n_ensembles, self.n_bins = self.data['velocity'].shape[:2]
+        self.stats_bins = self.n_ensembles * self.n_bins
+
+        self.__read_velocities()
+        self.__calc_bottom_stats()
+
+    @timed
+    def __read_velocities(self):
+        """
+        Reads east (u), north(v), vertical(w) and error velocities for
+        every ensemble.  Current speed and direction are derived from
+        them on first use.
+        """
+
+        velocity = self.data['velocity']
+        self.u = velocity[..., 0]
+        self.v = velocity[..., 1]
+        self.w = velocity[..., 2]
+        self.ev = velocity[..., 3]
+        self.fields = VelocityFields(self.u, self.v)
+
+    @property
+    def current_speed(self):
+        return self.fields.speed
+
+    @property
+    def current_direction(self):
+        return self.fields.direction
+
+    @timed
+    def __calc_bottom_stats(self, tolerance=30):
+        bottom_bin = vectorized.find_bottom_bin(self.data['echo_intensity'],
+                                                tolerance)
+        if self.geometry is not None:
+            self.bottom_stats = self.geometry.bottom_stats(bottom_bin)
+            self.last_good_bin_mask = (
+                self.geometry.last_good_bin_masks[bottom_bin]
+            )
+            self.last_good_counter_mask = (
+                self.geometry.last_good_counter_masks[bottom_bin]
+            )
+            return
+
+        bottom_stats = side_lobe_stats(bottom_bin, self.data['fixed_leader'],
+                                       self.transducer_depth)
+        self.bottom_stats = bottom_stats
+        self.last_good_bin_mask = vectorized.leading_bin_mask(
+            bottom_stats['last_good_bin'], self.n_bins
+        )
+        self.last_good_counter_mask = vectorized.leading_bin_mask(
+            bottom_stats['last_good_counter'], self.n_bins
+        )
+
+    def __ensemble_flags(self, flags, out=None):
+        if out is None:
+            out = np.empty((self.n_ensembles, self.n_bins),
+                           dtype=vectorized.FLAG_DTYPE)
+        out[...] = np.asarray(flags)[..., np.newaxis]
+        return out
+
+    def __no_test(self, out=None):
+        """
+        Flags for a test the instrument has no data for
+        """
+        return self.__ensemble_flags(ADCP_FLAGS['no_test'], out)
+
+    def __masked_flags(self, flags, mask, values=()):
+        """
+        Sets flags past the side lobe cutoff in mask, and where any of
+        values is masked or NaN, to missing_data in place
+        """
+        vectorized.mark_missing(flags, *values)
+        return vectorized.apply_bin_mask(flags, mask, out=flags)
+
+    def __bin_flags(self, out):
+        if out is None:
+            out = np.empty((self.n_ensembles, self.n_bins),
+                           dtype=vectorized.FLAG_DTYPE)
+        return out
+
+    @timed
+    def battery_flag(self, out=None):
+        """
+        QARTOD Test #1 Strongly Recommended
+        """
+        return self.__ensemble_flags(battery_flag_test(self.data), out)
+
+    @timed
+    def checksum_flag(self, out=None):
+        """
+        QARTOD Test #2 Required
+        """
+        if 'checksum_ok' in self.data:
+            return self.__ensemble_flags(
+                vectorized.checksum_test(self.data['checksum_ok']), out
+            )
+        return self.__ensemble_flags(checksum_test(self.data), out)
+
+    @timed
+    def bit_flag(self, out=None):
+        """
+        Not an official QARTOD test.  Checks special TRDI bit flag.
+        """
+        if 'bit_result' not in self.data['variable_leader']:
+            return self.__no_test(out)
+        return self.__ensemble_flags(
+            vectorized.bit_test(self.data['variable_leader']['bit_result']),
+            out
+        )
+
+    @timed
+    def orientation_flags(self, max_pitch=20, max_roll=20, out=None):
+        """
+        QARTOD Test #3 Required: orientation (pitch and roll) tests
+        """
+        pitch = self.data['variable_leader']['pitch']/100.0
+        roll = self.data['variable_leader']['roll']/100.0
+        return self.__ensemble_flags(
+            vectorized.orientation_test(pitch, roll, max_pitch, max_roll),
+            out
+        )
+
+    @timed
+    def sound_speed_flags(self, sound_speed_min=1400, sound_speed_max=1600,
+                          out=None):
+        """
+        QARTOD Test 4 Required: Sound speed test
+        """
+        return self.__ensemble_flags(
+            vectorized.sound_speed_test(
+                self.data['variable_leader']['speed_of_sound'],
+                sound_speed_min, sound_speed_max
+            ),
+            out
+        )
+
+    @timed
+    def heading_flags(self, out=None):
+        """
+        Not an official QARTOD test.  Checks the compass heading.
+        Not part of run_all.
+        """
+        return self.__ensemble_flags(
+            vectorized.heading_test(
+                self.data['variable_leader']['heading']/100.0
+            ),
+            out
+        )
+
+    @timed
+    def temperature_flags(self, temperature_min=-5, temperature_max=40,
+                          out=None):
+        """
+        Not an official QARTOD test.  Checks the transducer
+        temperature.  Not part of run_all.
+        """
+        return self.__ensemble_flags(
+            vectorized.temperature_test(
+                self.data['variable_leader']['temperature']/100.0,
+                temperature_min, temperature_max
+            ),
+            out
+        )
+
+    @timed
+    def noise_floor_flag(self, suspect_noise_floor=40, bad_noise_floor=60,
+                         out=None):
+        """
+        QARTOD Test #5 Strongly Recommended
+        For TRDI ADCP's noise floor data is not available.  Runs on
+        stacks from instruments that report a noise floor.
+        """
+        if 'noise_floor' not in self.data:
+            return self.__ensemble_flags(noise_floor_test(self.data), out)
+        return self.__ensemble_flags(
+            vectorized.noise_floor_test(self.data['noise_floor'],
+                                        suspect_noise_floor,
+                                        bad_noise_floor),
+            out
+        )
+
+    @timed
+    def signal_strength_flag(self, suspect_margin=10, bad_margin=3,
+                             out=None):
+        """
+        QARTOD Test #6 Strongly Recommended
+        For TRDI ADCP's signal strength data is not available.  Runs on
+        stacks from instruments that report a noise floor.
+        """
+        if 'noise_floor' not in self.data:
+            return self.__ensemble_flags(signal_strength_test(self.data),
+                                         out)
+        return self.__masked_flags(
+            vectorized.signal_strength_test(self.data['echo_intensity'],
+                                            self.data['noise_floor'],
+                                            suspect_margin, bad_margin,
+                                            self.__bin_flags(out)),
+            self.last_good_bin_mask
+        )
+
+    @timed
+    def signal_to_noise_flag(self, suspect_snr=6, bad_snr=3, out=None):
+        """
+        QARTOD Test #7 Strongly Recommended
+        For TRDI ADCP's signal to noise data is not available.  Runs on
+        stacks from instruments that report signal to noise ratios.
+        """
+        if 'snr' not in self.data:
+            return self.__ensemble_flags(signal_to_noise_test(self.data),
+                                         out)
+        return self.__masked_flags(
+            vectorized.signal_to_noise_test(self.data['snr'],
+                                            suspect_snr, bad_snr,
+                                            self.__bin_flags(out)),
+            self.last_good_bin_mask
+        )
+
+    @timed
+    def correlation_magnitude_flags(self,
+                                    good_tolerance=115,
+                                    questionable_tolerance=64,
+                                    out=None):
+        """
+        QARTOD Test #8 Strongly Recommended
+        correlation magnitude test
+        """
+        if 'correlation' not in self.data:
+            return self.__no_test(out)
+        return self.__masked_flags(
+            vectorized.correlation_magnitude_test(self.data['correlation'],
+                                                  good_tolerance,
+                                                  questionable_tolerance,
+                                                  self.__bin_flags(out)),
+            self.last_good_bin_mask
+        )
+
+    @timed
+    def percent_good_flags(self, percent_good=21, percent_bad=17,
+                           out=None):
+        """
+        QARTOD Test #9 Required
+        percent good test
+        """
+        if 'percent_good' not in self.data:
+            return self.__no_test(out)
+        return self.__masked_flags(
+            vectorized.percent_good_test(self.data['percent_good'][..., 2],
+                                         self.data['percent_good'][..., 3],
+                                         percent_good, percent_bad,
+                                         self.__bin_flags(out)),
+            self.last_good_bin_mask
+        )
+
+    @timed
+    def current_speed_flags(self, max_speed=150, out=None):
+        """
+        QARTOD Test #10 Required
+        current speed test
+        """
+        return self.__masked_flags(
+            vectorized.current_speed_test(self.current_speed, max_speed,
+                                          self.__bin_flags(out)),
+            self.last_good_counter_mask, (self.u, self.v)
+        )
+
+    @timed
+    def current_direction_flags(self, out=None):
+        """
+        QARTOD Test #11 Required
+        current direction test
+        """
+        return self.__masked_flags(
+            vectorized.current_direction_test(self.current_direction,
+                                              self.__bin_flags(out)),
+            self.last_good_counter_mask, (self.u, self.v)
+        )
+
+    @timed
+    def horizontal_velocity_flags(self,
+                                  max_u_vel=150, max_v_vel=150, out=None):
+        """
+        QARTOD Test #12 Required
+        horizontal velocity test
+        """
+        return self.__masked_flags(
+            vectorized.horizontal_velocity_test(self.u, self.v,
+                                                max_u_vel, max_v_vel,
+                                                self.__bin_flags(out)),
+            self.last_good_counter_mask, (self.u, self.v)
+        )
+
+    @timed
+    def vertical_velocity_flags(self, max_w_velocity=15, out=None):
+        """
+        QARTOD Test #13 Strongly Recommended
+        vertical velocity test
+        """
+        return self.__masked_flags(
+            vectorized.vertical_velocity_test(self.w, max_w_velocity,
+                                              self.__bin_flags(out)),
+            self.last_good_counter_mask, (self.w,)
+        )
+
+    @timed
+    def error_velocity_flags(self,
+                             questionable_error_velocity=2.6,
+                             bad_error_velocity=5.2, out=None):
+        """
+        QARTOD Test #14 Required
+        error velocity test
+        """
+        return self.__masked_flags(
+            vectorized.error_velocity_test(self.ev,
+                                           questionable_error_velocity,
+                                           bad_error_velocity,
+                                           self.__bin_flags(out)),
+            self.last_good_counter_mask, (self.ev,)
+        )
+
+    @timed
+    def stuck_sensor_flag(self, tolerance=4, out=None):
+        """
+        QARTOD Test #15 Strongly Recommended
+        stuck sensor test on echo intensity across the stacked ensembles
+        """
+        return self.__masked_flags(
+            vectorized.stuck_sensor_test(self.data['echo_intensity'],
+                                         tolerance,
+                                         out=self.__bin_flags(out)),
+            self.last_good_counter_mask
+        )
+
+    @timed
+    def echo_intensity_flags(self, tolerance=2, out=None):
+        """
+        QARTOD Test #16 Required
+        echo intensity test
+        """
+        return self.__masked_flags(
+            vectorized.echo_intensity_test(self.data['echo_intensity'],
+                                           tolerance, self.__bin_flags(out)),
+            self.last_good_counter_mask
+        )
+
+    @timed
+    def range_drop_off_flags(self, drop_off_limit=60, out=None):
+        """
+        QARTOD Test #17 Strongly Recommended
+        range drop-off test
+        """
+        return self.__masked_flags(
+            vectorized.range_drop_off_test(self.data['echo_intensity'],
+                                           drop_off_limit,
+                                           self.__bin_flags(out)),
+            self.last_good_counter_mask
+        )
+
+    @timed
+    def current_speed_gradient_flags(self, tolerance=6, out=None):
+        """
+        QARTOD Test #18 Strongly Recommended
+        current speed gradient test
+        """
+        return vectorized.mark_missing(
+            vectorized.current_speed_gradient_test(self.current_speed,
+                                                   tolerance, out),
+            self.u, self.v
+        )
+
+    def __series_flags(self, flags):
+        mask = self.last_good_counter_mask.reshape(
+            self.last_good_counter_mask.shape + (1,) * (flags.ndim - 2)
+        )
+        np.copyto(flags, ADCP_FLAGS['missing_data'], where=~mask)
+        return flags
+
+    @timed
+    def rate_of_change_flags(self, values=None, window=12, n_dev=3,
+                             min_rate=0, out=None):
+        """
+        Time series rate of change test along the ensembles of values
+        shaped (ensemble, bin[, beam]), current speed by default.  See
+        vectorized.rate_of_change_test.
+        """
+        if values is None:
+            values = self.current_speed
+        return self.__series_flags(
+            vectorized.rate_of_change_test(values, window, n_dev, min_rate,
+                                           out=out)
+        )
+
+    @timed
+    def spike_flags(self, values=None, window=12, suspect_dev=3, bad_dev=5,
+                    min_deviation=0, out=None):
+        """
+        Time series spike test along the ensembles of values shaped
+        (ensemble, bin[, beam]), current speed by default.  See
+        vectorized.spike_test.
+        """
+        if values is None:
+            values = self.current_speed
+        return self.__series_flags(
+            vectorized.spike_test(values, window, suspect_dev, bad_dev,
+                                  min_deviation, out=out)
+        )
+
+    @timed
+    def flat_line_flags(self, values=None, tolerance=0, suspect_count=3,
+                        fail_count=5, out=None):
+        """
+        Time series flat line test along the ensembles of values shaped
+        (ensemble, bin[, beam]), current speed by default.  See
+        vectorized.flat_line_test.
+        """
+        if values is None:
+            values = self.current_speed
+        return self.__series_flags(
+            vectorized.flat_line_test(values, tolerance, suspect_count,
+                                      fail_count, out=out)
+        )
+
+    def test_methods(self):
+        """
+        Returns the test methods keyed by their QARTOD_TESTS name
+        """
+        return OrderedDict((name, getattr(self, method))
+                           for name, method in self.TEST_METHODS.items())
+
+    @timed
+    def run_all(self, params=None):
+        """
+        Runs every test and rolls the flags up in one pass.  Each test
+        writes straight into its slice of a preallocated QCResult.
+        params optionally maps test names to keyword arguments
+        overriding the default limits, e.g.
+        {'current_speed': {'max_speed': 200}}.  Returns the QCResult
+        keyed by QARTOD_TESTS and the (ensemble, bin) worst flag rollup.
+        """
+        params = params or {}
+        result = QCResult.empty(self.n_ensembles, self.n_bins)
+        worst = WorstFlag(result.shape)
+        for name, test in self.test_methods().items():
+            worst.add(test(out=result[name], **params.get(name, {})))
+
+        return result, worst.flags
+
+    def flags(self):
+        """
+        Runs every test with its default limits.  Returns a QCResult
+        of (ensemble, bin) flag arrays keyed by QARTOD_TESTS.
+        """
+        return self.run_all()[0]
+
 import sys
 import argparse
-from trdi_adcp_readers.readers import read_PD0_file
 
 
 def main():
+    from trdi_adcp_readers.readers import read_PD0_file
+
     parser = argparse.ArgumentParser()
     parser.add_argument("input_path", help="Path of PD0 file to parse")
     args = parser.parse_args()
@@ -334,8 +945,8 @@ def main():
 
     qaqc = TRDIQAQC(pd0_data)
 
-    print qaqc.bottom_stats
-    print qaqc.echo_intensity_flags()
+    print(qaqc.bottom_stats)
+    print(qaqc.echo_intensity_flags())
 
     return 1
 
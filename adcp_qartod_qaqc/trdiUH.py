@@ -1,25 +1,23 @@
 
-from pycurrents.adcp.rdiraw import Multiread
+from collections import OrderedDict
+
 import numpy as np
 import numpy.ma as ma
 from datetime import datetime
 
+try:
+    from pycurrents.adcp.rdiraw import Multiread
+except ImportError:
+    Multiread = None
+
+from adcp_qartod_qaqc import vectorized
+from adcp_qartod_qaqc.fields import VelocityFields
+from adcp_qartod_qaqc.instrumentation import timed
+from adcp_qartod_qaqc.result import QCResult, WorstFlag
 from adcp_qartod_qaqc.tests import (
+    ADCP_FLAGS,
     battery_flag_test,
-    checksum_test,
-    bit_test,
-    orientation_test,
-    sound_speed_test,
-    correlation_magnitude_test,
-    percent_good_test,
-    current_speed_test,
-    current_direction_test,
-    horizontal_velocity_test,
-    vertical_velocity_test,
-    error_velocity_test,
-    echo_intensity_test,
-    range_drop_off_test,
-    current_speed_gradient_test
+    checksum_test
 )
 
 
@@ -31,24 +29,73 @@ class TRDIQAQC(object):
     Manual for Real-Time Quality Control of In-Situ Current Observations"
 
     Expects data in the same format as output by
-    University of Hawaii's Multiread function
+    University of Hawaii's Multiread function.  Pass a QCStats as
+    stats to record the time spent in every test and setup phase.
+
+    Velocities (u, v, w, ev and current_speed) are views of the
+    Multiread arrays and stay in its m/s.  Test limits are given in
+    cm/s and divided by velocity_scale.
 
     By: Jeff Donovan <jdonovan@usf.edu> & Michael Lindemuth <mlindemu@usf.edu>
     University of South Florida
     College of Marine Science
     """
 
+    TEST_METHODS = OrderedDict((
+        ('battery', 'battery_flag'),
+        ('checksum', 'checksum_flag'),
+        ('bit', 'bit_flag'),
+        ('orientation', 'orientation_flags'),
+        ('sound_speed', 'sound_speed_flags'),
+        ('correlation_magnitude', 'correlation_magnitude_flags'),
+        ('percent_good', 'percent_good_flags'),
+        ('current_speed', 'current_speed_flags'),
+        ('current_direction', 'current_direction_flags'),
+        ('horizontal_velocity', 'horizontal_velocity_flags'),
+        ('vertical_velocity', 'vertical_velocity_flags'),
+        ('error_velocity', 'error_velocity_flags'),
+        ('stuck_sensor', 'stuck_sensor_flags'),
+        ('echo_intensity', 'echo_intensity_flags'),
+        ('range_drop_off', 'range_drop_off_flags'),
+        ('current_speed_gradient', 'current_speed_gradient_flags')
+    ))
+
+    # tests returning one flag (or one flag per ensemble)
+    ENSEMBLE_TESTS = ('battery', 'checksum', 'bit', 'orientation',
+                      'sound_speed')
+
+    @staticmethod
+    def __multiread(path, read_type):
+        if Multiread is None:
+            raise ImportError('Reading files requires pycurrents')
+        return Multiread(path, read_type)
+
     @staticmethod
-    def from_file(path, read_type, transducer_depth):
+    def from_file(path, read_type, transducer_depth, stats=None):
         """
         A convenience method to read in a file by path
         """
-        m = Multiread(path, read_type)
-        return TRDIQAQC(m.read(), transducer_depth)
+        m = TRDIQAQC.__multiread(path, read_type)
+        return TRDIQAQC(m.read(), transducer_depth, stats)
 
-    def __init__(self, multiread_data, transducer_depth):
+    @staticmethod
+    def iter_file(path, read_type, transducer_depth, chunk_size=1000,
+                  stats=None):
+        """
+        Reads a file by path chunk_size ensembles at a time and yields
+        a TRDIQAQC for each chunk so that memory use does not grow with
+        the size of the file
+        """
+        m = TRDIQAQC.__multiread(path, read_type)
+        for start in range(0, m.nprofs, chunk_size):
+            yield TRDIQAQC(m.read(start=start, stop=start + chunk_size),
+                           transducer_depth, stats)
+
+    def __init__(self, multiread_data, transducer_depth, stats=None):
         self.data = multiread_data
         self.transducer_depth = transducer_depth
+        self.stats = stats
+        self.stats_bins = self.data.amp.shape[0] * self.data.amp.shape[1]
 
         self.__read_timestamp()
         self.__read_configuration()
@@ -56,6 +103,7 @@ class TRDIQAQC(object):
 
         self.set_ensemble_bottom_stats()
 
+    @timed
     def __read_timestamp(self):
         yr = str(self.data.yearbase)
         mon = str(self.data.VL[0][2]).zfill(2)
@@ -68,6 +116,7 @@ class TRDIQAQC(object):
         time_str = ' '.join([dt, tm])
         self.timestamp = datetime.strptime(time_str, '%Y/%m/%d %H:%M:%S')
 
+    @timed
     def __read_configuration(self):
         """
         Reads some shared configuration variables into
@@ -108,69 +157,85 @@ class TRDIQAQC(object):
         # magnetic declination applied to data, site specific, use  r input
         self.mag_declination = self.data.FL.EV / 10.0
 
+    @timed
     def __read_velocities(self):
         """
-        extract velocity from the masked array
-        Univ of Hawaii code converts the mm/s
-        velocity data from the instrument to
-        m/s. We work in cm/s so I will have to
-        convert the velocities from m/s to cm/s
-        """
-        u_vel_masked = self.data.vel1
-        u_vel_masked.mask = ma.nomask
-        u_vel = u_vel_masked.compressed()
-        self.u = u_vel * 100.
-
-        v_vel_masked = self.data.vel2
-        v_vel_masked.mask = ma.nomask
-        v_vel = v_vel_masked.compressed()
-        self.v = v_vel * 100.
-
-        w_vel_masked = self.data.vel3
-        w_vel_masked.mask = ma.nomask
-        w_vel = w_vel_masked.compressed()
-        self.w = w_vel * 100.
-
-        err_vel_masked = self.data.vel4
-        err_vel_masked.mask = ma.nomask
-        err_vel = err_vel_masked.compressed()
-        self.ev = err_vel * 100.
-        self.ev = self.ev
-
-        self.z = self.u + 1j + self.v
-        self.current_speed = abs(self.z)
-        self.current_direction = np.arctan2(self.z.real, self.z.imag)*180/np.pi
-        self.current_direction = self.current_direction
+        Keeps views of the masked velocity arrays from the reader.
+        Univ of Hawaii code converts the mm/s velocity data from the
+        instrument to m/s.  Limits are in cm/s, so rather than copying
+        every array to convert it, the tests divide their limits by
+        velocity_scale.  u, v, w and ev are therefore in m/s (they were
+        copied into cm/s before).  Masked bins are flagged missing_data.
+        Current speed (m/s) and direction are derived on first use.
+        """
+        self.velocity_scale = 100.
+        self.u = self.data.vel1
+        self.v = self.data.vel2
+        self.w = self.data.vel3
+        self.ev = self.data.vel4
+        self.fields = VelocityFields(self.u, self.v)
 
-    def set_ensemble_bottom_stats(self, tolerance=30):
-        self.ensemble_bottom_stats = []
-        for ensemble in self.data.amp:
-            bottom_bin = 1
-            for bin_prev, bin_curr in zip(ensemble, ensemble[1:]):
-                bin_flag_count = 0
-                for beam_prev, beam_curr in zip(bin_prev, bin_curr):
-                    bin_diff = int(beam_curr) - int(beam_prev)
-                    if bin_diff > tolerance:
-                        bin_flag_count += 1
-
-                if bin_flag_count < 2:
-                    bottom_bin += 1
-                else:
-                    break
-
-            bottom_stats = {}
-            bottom_stats['bottom_bin'] = bottom_bin
-            bottom_stats['range_to_bottom'] = (
-                (bottom_stats['bottom_bin'] * (self.NCells / 100)) +
-                self.bin1depth)
-            bottom_stats['side_lobe_start'] = (
-                (int(np.cos(self.data.sysconfig['angle'] * (np.pi/180.)) *
-                 bottom_stats['range_to_bottom'])))
-            bottom_stats['last_good_bin'] = bottom_stats['side_lobe_start'] - 1
-            bottom_stats['last_good_counter'] = (
-                bottom_stats['last_good_bin'] - 1)
-            self.ensemble_bottom_stats.append(bottom_stats)
+    @property
+    def current_speed(self):
+        """
+        Horizontal current speed in m/s
+        """
+        return self.fields.speed
 
+    @property
+    def current_direction(self):
+        return self.fields.direction
+
+    @timed
+    def set_ensemble_bottom_stats(self, tolerance=30):
+        """
+        Finds the bottom of every ensemble at once from the amplitude
+        cube.  range_to_bottom is the distance in meters from the
+        transducer to the bottom bin.  Side lobe reflections contaminate
+        bins beyond cos(beam angle) of that range; side_lobe_start and
+        the last good bins are bin indices clipped to the profile.
+        Stats are stored (and returned) as a dictionary of per-ensemble
+        arrays.
+        """
+        n_bins = self.data.amp.shape[1]
+        cell_size = self.bin_size / 100.
+        bottom_stats = {}
+        bottom_stats['bottom_bin'] = vectorized.find_bottom_bin(
+            self.data.amp, tolerance, absolute=False
+        )
+        bottom_stats['range_to_bottom'] = (
+            self.data.Bin1Dist + bottom_stats['bottom_bin'] * cell_size
+        )
+        side_lobe_range = (
+            np.cos(self.beam_angle * (np.pi/180.)) *
+            bottom_stats['range_to_bottom']
+        )
+        bottom_stats['side_lobe_start'] = np.clip(
+            np.floor((side_lobe_range - self.data.Bin1Dist) / cell_size),
+            0, n_bins
+        ).astype(int)
+        bottom_stats['last_good_bin'] = np.maximum(
+            bottom_stats['side_lobe_start'] - 1, 0
+        )
+        bottom_stats['last_good_counter'] = np.maximum(
+            bottom_stats['last_good_bin'] - 1, 0
+        )
+        self.ensemble_bottom_stats = bottom_stats
+        self.good_bin_mask = vectorized.leading_bin_mask(
+            bottom_stats['last_good_counter'], n_bins
+        )
+
+        return bottom_stats
+
+    def __masked_flags(self, flags, values=()):
+        """
+        Sets flags past each ensemble's side lobe cutoff, and where any
+        of values is masked, to missing_data in place
+        """
+        vectorized.apply_bin_mask(flags, self.good_bin_mask, out=flags)
+        return vectorized.mark_missing(flags, *values)
+
+    @timed
     def battery_flag(self):
         """
         QARTOD Test #1 Strongly Recommended
@@ -180,6 +245,7 @@ class TRDIQAQC(object):
         """
         return battery_flag_test(self.data)
 
+    @timed
     def checksum_flag(self):
         """
         QARTOD Test #2 Required
@@ -190,86 +256,126 @@ class TRDIQAQC(object):
         """
         return checksum_test(self.data)
 
+    @timed
     def bit_flag(self):
         """
         Not an official QARTOD test.  Checks special TRDI bit flag.
         """
-        bit_flags = []
-        for ensemble in self.data.VL:
-            bit_flags.append(bit_test(ensemble))
-
-        return bit_flags
+        return vectorized.bit_test(self.data.VL['BIT'])
 
+    @timed
     def orientation_flags(self, max_pitch=20, max_roll=20):
         """
         QARTOD Test #3 Required: orientation (pitch and roll) tests
         """
-        return orientation_test(self.data.pitch, self.data.roll,
-                                max_pitch, max_roll)
+        return vectorized.orientation_test(self.data.pitch, self.data.roll,
+                                           max_pitch, max_roll)
 
+    @timed
     def sound_speed_flags(self, sound_speed_min=1400, sound_speed_max=1600):
         """
         QARTOD Test 4 Required: Sound speed test
         """
-        ssval_flags = []
-        for ensemble_ssv in self.data.VL:
-            ssval_flags.append(
-                sound_speed_test(ensemble_ssv,
-                                 sound_speed_min, sound_speed_max))
+        return vectorized.sound_speed_test(self.data.VL['SoundSpeed'],
+                                           sound_speed_min, sound_speed_max)
 
-        return ssval_flags
+    @timed
+    def heading_flags(self):
+        """
+        Not an official QARTOD test.  Checks the compass heading.
+        """
+        return vectorized.heading_test(self.data.heading)
+
+    @timed
+    def temperature_flags(self, temperature_min=-5, temperature_max=40):
+        """
+        Not an official QARTOD test.  Checks the transducer temperature.
+        """
+        return vectorized.temperature_test(self.data.temperature,
+                                           temperature_min, temperature_max)
+
+    @timed
+    def pressure_flags(self, pressure_min=0, pressure_max=6000):
+        """
+        Not an official QARTOD test.  Checks the pressure sensor
+        reading, recorded in decapascals, against limits in dbar.
+        Instruments without a pressure sensor leave the Pressure
+        column out of the variable leader and are flagged no_test.
+        """
+        if 'Pressure' not in self.data.VL.dtype.names:
+            return np.full(len(self.data.VL), ADCP_FLAGS['no_test'],
+                           dtype=vectorized.FLAG_DTYPE)
+        return vectorized.pressure_test(self.data.VL['Pressure'] / 1000.,
+                                        pressure_min, pressure_max)
+
+    def variable_leader_flags(self):
+        """
+        Runs every ensemble level test over the whole variable leader
+        table with default limits.  Returns an OrderedDict of
+        (ensemble,) flag arrays keyed by test name.
+        """
+        return OrderedDict((
+            ('bit', self.bit_flag()),
+            ('orientation', self.orientation_flags()),
+            ('sound_speed', self.sound_speed_flags()),
+            ('heading', self.heading_flags()),
+            ('temperature', self.temperature_flags()),
+            ('pressure', self.pressure_flags())
+        ))
 
     # NOTE: QARTOD Tests 5, 6, and 7 cannot be performed on TRDI ADCP
 
+    @timed
     def correlation_magnitude_flags(self,
                                     good_tolerance=115,
-                                    questionable_tolerance=64):
+                                    questionable_tolerance=64, out=None):
         """
         QARTOD Test #8 Strongly Recommended
         correlation magnitude test
         """
-        ensemble_flags = []
-        for i in xrange(0, len(self.data.cor1)):
-            correlation = zip(self.data.cor1[i], self.data.cor2[i],
-                              self.data.cor3[i], self.data.cor4[i])
-            correlation_flags = correlation_magnitude_test(
-                correlation,
-                good_tolerance,
-                questionable_tolerance
-            )
-            ensemble_flags.append(correlation_flags)
-
-        return ensemble_flags
+        correlation = (self.data.cor1, self.data.cor2,
+                       self.data.cor3, self.data.cor4)
+        return vectorized.mark_missing(
+            vectorized.correlation_magnitude_test(
+                np.stack([ma.getdata(beam) for beam in correlation],
+                         axis=-1),
+                good_tolerance, questionable_tolerance, out
+            ),
+            *correlation
+        )
 
-    def percent_good_flags(self, percent_good=21, percent_bad=17):
+    @timed
+    def percent_good_flags(self, percent_good=21, percent_bad=17, out=None):
         """
         QARTOD Test #9 Required
         percent good test
         default limits on this test are > 21%, good: < 17%, bad
         limits derived from TRDI Spreadsheed based on our instruments and setup
         """
-        ensemble_flags = []
-        for pg3, pg4, bottom_stats in zip(self.data.pg3, self.data.pg4,
-                                          self.ensemble_bottom_stats):
-            ensemble_flags.append(
-                percent_good_test(pg3, pg4, bottom_stats['last_good_counter'],
-                                  percent_good, percent_bad)
-            )
-
-        return ensemble_flags
+        return self.__masked_flags(
+            vectorized.percent_good_test(ma.getdata(self.data.pg3),
+                                         ma.getdata(self.data.pg4),
+                                         percent_good, percent_bad, out),
+            (self.data.pg3, self.data.pg4)
+        )
 
-    def current_speed_flags(self, max_speed=150):
+    @timed
+    def current_speed_flags(self, max_speed=150, out=None):
         """
         QARTOD Test #10 Required
         current speed test
         150 cm/s is the West Florida Shelf limit.  Adjust as necessary
         """
 
-        last_good_counter = self.ensemble_bottom_stats[0]['last_good_counter']
-        return current_speed_test(self.current_speed,
-                                  last_good_counter)
+        return self.__masked_flags(
+            vectorized.current_speed_test(self.current_speed,
+                                          max_speed / self.velocity_scale,
+                                          out),
+            (self.u, self.v)
+        )
 
-    def current_direction_flags(self):
+    @timed
+    def current_direction_flags(self, out=None):
         """
         QARTOD Test #11 Required
         current direction test
@@ -277,12 +383,14 @@ class TRDIQAQC(object):
         Negative values are made positive by adding 360 to them
         """
 
-        last_good_bin = self.ensemble_bottom_stats[0]['last_good_counter']
-        return current_direction_test(self.current_direction,
-                                      last_good_bin)
+        return self.__masked_flags(
+            vectorized.current_direction_test(self.current_direction, out),
+            (self.u, self.v)
+        )
 
+    @timed
     def horizontal_velocity_flags(self,
-                                  max_u_vel=150, max_v_vel=150):
+                                  max_u_vel=150, max_v_vel=150, out=None):
         """
         QARTOD Test #12 Required
         horizontal velocity test
@@ -290,25 +398,33 @@ class TRDIQAQC(object):
         150 cm/s is a local WFS limit
         """
 
-        last_good_bin = self.ensemble_bottom_stats[0]['last_good_counter']
-        return horizontal_velocity_test(self.u, self.v,
-                                        last_good_bin,
-                                        max_u_vel, max_v_vel)
+        return self.__masked_flags(
+            vectorized.horizontal_velocity_test(
+                self.u, self.v, max_u_vel / self.velocity_scale,
+                max_v_vel / self.velocity_scale, out
+            ),
+            (self.u, self.v)
+        )
 
-    def vertical_velocity_flags(self, max_w_velocity=15):
+    @timed
+    def vertical_velocity_flags(self, max_w_velocity=15, out=None):
         """
         QARTOD Test #13 Strongly Recommended
         vertical velocity test
         if w greater than 15 cm/s (10% MAX speed from TRDI), w is bad
         """
 
-        last_good_bin = self.ensemble_bottom_stats[0]['last_good_counter']
-        return vertical_velocity_test(self.w, last_good_bin,
-                                      max_w_velocity)
+        return self.__masked_flags(
+            vectorized.vertical_velocity_test(
+                self.w, max_w_velocity / self.velocity_scale, out
+            ),
+            (self.w,)
+        )
 
+    @timed
     def error_velocity_flags(self,
                              questionable_error_velocity=2.6,
-                             bad_error_velocity=5.2):
+                             bad_error_velocity=5.2, out=None):
         """
         QARTOD Test #14 Required
         error velocity test
@@ -317,26 +433,42 @@ class TRDIQAQC(object):
         based on our instruments and setup
         """
 
-        last_good_bin = self.ensemble_bottom_stats[0]['last_good_counter']
-        return error_velocity_test(self.ev, last_good_bin,
-                                   questionable_error_velocity,
-                                   bad_error_velocity)
+        return self.__masked_flags(
+            vectorized.error_velocity_test(
+                self.ev, questionable_error_velocity / self.velocity_scale,
+                bad_error_velocity / self.velocity_scale, out
+            ),
+            (self.ev,)
+        )
 
-    def echo_intensity_flags(self, tolerance=2):
+    @timed
+    def stuck_sensor_flags(self, tolerance=4, out=None):
+        """
+        QARTOD Test #15 Strongly Recommended
+        stuck sensor test on echo intensity across the file's ensembles
+        """
+
+        return self.__masked_flags(
+            vectorized.stuck_sensor_test(ma.getdata(self.data.amp),
+                                         tolerance, out=out),
+            (self.data.amp,)
+        )
+
+    @timed
+    def echo_intensity_flags(self, tolerance=2, out=None):
         """
         QARTOD Test #15 Required
         echo intensity test
         """
 
-        ensemble_flags = []
-        for ensemble in self.data.amp:
-            ensemble_flags.append(
-                echo_intensity_test(ensemble, tolerance)
-            )
-
-        return ensemble_flags
+        return vectorized.mark_missing(
+            vectorized.echo_intensity_test(ma.getdata(self.data.amp),
+                                           tolerance, out),
+            self.data.amp
+        )
 
-    def range_drop_off_flags(self, drop_off_limit=60):
+    @timed
+    def range_drop_off_flags(self, drop_off_limit=60, out=None):
         """
         QARTOD Test #16 Strongly Recommended
         range drop-off test
@@ -344,24 +476,54 @@ class TRDIQAQC(object):
         The QARTOD recommended cut-off is 30. ???
         """
 
-        ensemble_flags = []
-        for ensemble in self.data.amp:
-            ensemble_flags.append(
-                range_drop_off_test(ensemble, drop_off_limit)
-            )
+        return vectorized.mark_missing(
+            vectorized.range_drop_off_test(ma.getdata(self.data.amp),
+                                           drop_off_limit, out),
+            self.data.amp
+        )
 
-        return ensemble_flags
-
-    def current_speed_gradient_flags(self, tolerance=6):
+    @timed
+    def current_speed_gradient_flags(self, tolerance=6, out=None):
         """
         QARTOD Test #17 Strongly Recommended
         current speed gradient test
         """
 
-        last_good_bin = self.ensemble_bottom_stats[0]['last_good_counter']
-        return current_speed_gradient_test(self.current_speed,
-                                           last_good_bin,
-                                           tolerance)
+        return self.__masked_flags(
+            vectorized.current_speed_gradient_test(
+                self.current_speed, tolerance / self.velocity_scale, out
+            ),
+            (self.u, self.v)
+        )
+
+    @timed
+    def run_all(self, params=None):
+        """
+        Runs every test in TEST_METHODS and rolls the flags up in one
+        pass.  The (ensemble, bin) tests write straight into their
+        slice of a preallocated QCResult; ensemble level flags are
+        repeated over the bins.  params optionally maps test names to
+        keyword arguments overriding the default limits, e.g.
+        {'current_speed': {'max_speed': 200}}.  Returns the QCResult
+        and the (ensemble, bin) worst flag rollup.
+        """
+
+        params = params or {}
+        n_ensembles, n_bins = self.data.amp.shape[:2]
+        result = QCResult.empty(n_ensembles, n_bins,
+                                names=tuple(self.TEST_METHODS))
+        worst = WorstFlag(result.shape)
+        for name, method in self.TEST_METHODS.items():
+            test = getattr(self, method)
+            if name in self.ENSEMBLE_TESTS:
+                flags = np.asarray(test(**params.get(name, {})))
+                result[name] = flags[..., np.newaxis]
+            else:
+                test(out=result[name], **params.get(name, {}))
+            worst.add(result[name])
+
+        return result, worst.flags
+
 
 import sys
 import argparse
@@ -379,7 +541,7 @@ def main():
 
     trdi_qaqc = TRDIQAQC.from_file(args.input_path,
                                    args.read_type, args.transducer_height)
-    print 'Ensemble Bottom Bins: %s' % (trdi_qaqc.ensemble_bottom_stats,)
+    print('Ensemble Bottom Bins: %s' % (trdi_qaqc.ensemble_bottom_stats,))
 
     return 1
 
@@ -0,0 +1,670 @@
+# Vectorized.py - Array versions of the ADCP QARTOD tests in tests.py
+#
+# Each test accepts NumPy arrays shaped (n_ensembles, n_bins[, n_beams])
+# (or a single ensemble shaped (n_bins[, n_beams])) and returns a uint8
+# flag array with the leading shape of the input.  Flags match the
+# list-returning functions in tests.py flag for flag.  Every test takes
+# an optional preallocated uint8 out array to write its flags into.
+# The bin to bin tests and the bottom search run as compiled loops from
+# kernels.py when Numba is installed.
+#
+# By: Jeff Donovan <jdonovan@usf.edu>
+#     Michael Lindemuth <mlindemu@usf.edu>
+
+import numpy as np
+
+from adcp_qartod_qaqc import kernels
+from adcp_qartod_qaqc.tests import ADCP_FLAGS
+
+
+FLAG_DTYPE = np.uint8
+
+
+def _output(shape, out):
+    if out is None:
+        return np.empty(shape, dtype=FLAG_DTYPE)
+    return out
+
+
+def _flags(condition, true_flag, false_flag, out=None):
+    flags = _output(np.shape(condition), out)
+    flags[...] = ADCP_FLAGS[false_flag]
+    np.copyto(flags, ADCP_FLAGS[true_flag], where=condition)
+    return flags
+
+
+def checksum_test(checksum_ok, out=None):
+    """
+    QARTOD Test #2 Required
+    Flags each ensemble by its verified checksum
+    """
+
+    return _flags(checksum_ok, 'good', 'bad', out)
+
+
+def bit_test(bit_result, out=None):
+    """
+    Not an official QARTOD test.  Checks special TRDI bit flag.
+    Accepts the bit results as integers or as strings.
+    """
+
+    bit_result = np.asarray(bit_result)
+    if bit_result.dtype.kind in 'SU':
+        passed = np.char.strip(bit_result) == bit_result.dtype.type('0')
+    else:
+        passed = bit_result == 0
+
+    return _flags(passed, 'good', 'bad', out)
+
+
+def range_test(values, minimum, maximum, out=None):
+    """
+    Flags values within [minimum, maximum] good and the rest bad.
+    Values that are NaN or masked are missing_data.
+    """
+
+    data = np.ma.getdata(values)
+    flags = _flags((data >= minimum) & (data <= maximum), 'good', 'bad',
+                   out)
+    missing = missing_values(values, flags.ndim)
+    if missing is not None:
+        flags[missing] = ADCP_FLAGS['missing_data']
+
+    return flags
+
+
+def orientation_test(pitch, roll, max_pitch=20, max_roll=20, out=None):
+    """
+    QARTOD Test #3 Required: orientation (pitch and roll) tests
+    Pitch and roll are in degrees
+    """
+
+    return _flags((np.abs(pitch) < max_pitch) & (np.abs(roll) < max_roll),
+                  'good', 'bad', out)
+
+
+def sound_speed_test(sound_speed, sound_speed_min=1400,
+                     sound_speed_max=1600, out=None):
+    """
+    QARTOD Test 4 Required: Sound speed test
+    Sound speed is in m/s
+    """
+
+    return range_test(sound_speed, sound_speed_min, sound_speed_max, out)
+
+
+def heading_test(heading, out=None):
+    """
+    Not an official QARTOD test.  Compass heading in degrees must lie
+    in [0, 360].
+    """
+
+    return range_test(heading, 0, 360, out)
+
+
+def temperature_test(temperature, temperature_min=-5, temperature_max=40,
+                     out=None):
+    """
+    Not an official QARTOD test.  Transducer temperature in degrees C
+    must lie within the given limits.
+    """
+
+    return range_test(temperature, temperature_min, temperature_max, out)
+
+
+def pressure_test(pressure, pressure_min=0, pressure_max=6000, out=None):
+    """
+    Not an official QARTOD test.  Pressure in dbar must lie within the
+    given limits; the default maximum is the rating of the deepest
+    TRDI housings.
+    """
+
+    return range_test(pressure, pressure_min, pressure_max, out)
+
+
+def noise_floor_test(noise_floor, suspect_noise_floor=40,
+                     bad_noise_floor=60, out=None):
+    """
+    QARTOD Test #5 Strongly Recommended
+    noise floor test
+    Noise floor in echo intensity counts shaped (ensemble, beam).  The
+    noisiest beam sets the flag: a high noise floor points to
+    interference or a failing receiver.  Adjust limits per instrument.
+    """
+
+    noise = np.max(np.ma.getdata(noise_floor), axis=-1)
+
+    flags = _output(noise.shape, out)
+    flags[...] = ADCP_FLAGS['good']
+    flags[noise > suspect_noise_floor] = ADCP_FLAGS['suspect']
+    flags[noise > bad_noise_floor] = ADCP_FLAGS['bad']
+
+    return mark_missing(flags, noise_floor)
+
+
+def signal_strength_test(echo_intensity, noise_floor, suspect_margin=10,
+                         bad_margin=3, out=None):
+    """
+    QARTOD Test #6 Strongly Recommended
+    signal strength test
+    Echo intensity (ensemble, bin, beam) must stand above each beam's
+    noise floor (ensemble, beam), both in counts.  The weakest beam sets
+    the flag: suspect within suspect_margin of the noise floor and bad
+    within bad_margin.
+    """
+
+    margin = (np.asarray(np.ma.getdata(echo_intensity), dtype=np.float64) -
+              np.ma.getdata(noise_floor)[..., np.newaxis, :]).min(axis=-1)
+
+    flags = _output(margin.shape, out)
+    flags[...] = ADCP_FLAGS['bad']
+    flags[margin >= bad_margin] = ADCP_FLAGS['suspect']
+    flags[margin >= suspect_margin] = ADCP_FLAGS['good']
+    mark_missing(flags, echo_intensity)
+    noise_missing = missing_values(noise_floor, flags.ndim - 1)
+    if noise_missing is not None:
+        flags[noise_missing] = ADCP_FLAGS['missing_data']
+
+    return flags
+
+
+def signal_to_noise_test(snr, suspect_snr=6, bad_snr=3, out=None):
+    """
+    QARTOD Test #7 Strongly Recommended
+    signal to noise test
+    Signal to noise ratio in dB shaped (ensemble, bin, beam).  The
+    weakest beam sets the flag: suspect below suspect_snr and bad below
+    bad_snr.
+    """
+
+    weakest = np.min(np.ma.getdata(snr), axis=-1)
+
+    flags = _output(weakest.shape, out)
+    flags[...] = ADCP_FLAGS['bad']
+    flags[weakest >= bad_snr] = ADCP_FLAGS['suspect']
+    flags[weakest >= suspect_snr] = ADCP_FLAGS['good']
+
+    return mark_missing(flags, snr)
+
+
+def correlation_magnitude_test(ensemble_correlation,
+                               good_tolerance=115, suspect_tolerance=64,
+                               out=None):
+    """
+    QARTOD Test #8 Strongly Recommended
+    correlation magnitude test
+    Beams are on the last axis
+    """
+
+    correlation = np.asarray(ensemble_correlation)
+    n_beams = correlation.shape[-1]
+    good_count = (correlation >= good_tolerance).sum(axis=-1)
+    usable_count = (correlation >= suspect_tolerance).sum(axis=-1)
+
+    flags = _output(good_count.shape, out)
+    flags[...] = ADCP_FLAGS['bad']
+    flags[usable_count >= 3] = ADCP_FLAGS['suspect']
+    flags[good_count == n_beams] = ADCP_FLAGS['good']
+
+    return flags
+
+
+def percent_good_test(one_bad_percent_data, all_good_percent_data,
+                      percent_good=21, percent_bad=17, out=None):
+    """
+    QARTOD Test #9 Required
+    percent good test
+    default limits on this test are > 21%, good: < 17%, bad
+    """
+
+    pg_sum = (np.asarray(one_bad_percent_data) +
+              np.asarray(all_good_percent_data))
+
+    flags = _output(pg_sum.shape, out)
+    flags[...] = ADCP_FLAGS['suspect']
+    flags[pg_sum <= percent_bad] = ADCP_FLAGS['bad']
+    flags[pg_sum >= percent_good] = ADCP_FLAGS['good']
+
+    return flags
+
+
+def current_speed_test(current_speed, max_speed=150, out=None):
+    """
+    QARTOD Test #10 Required
+    current speed test
+    150 cm/s is the West Florida Shelf limit.  Adjust as necessary
+    """
+
+    return _flags(np.asarray(current_speed) <= max_speed, 'good', 'bad', out)
+
+
+def current_direction_test(current_direction, out=None):
+    """
+    QARTOD Test #11 Required
+    current direction test
+    Verifies that the current direction is less than 360 degrees
+    Negative values are made positive by adding 360 to them
+    """
+
+    direction = np.asarray(current_direction)
+    direction = np.where(direction < 0.0, direction + 360, direction)
+
+    return _flags(direction <= 360, 'good', 'bad', out)
+
+
+def horizontal_velocity_test(u, v,
+                             max_u_velocity=150, max_v_velocity=150,
+                             out=None):
+    """
+    QARTOD Test #12 Required
+    horizontal velocity test
+    If EITHER u or v greater than 150 cm/s, velocity is bad
+    """
+
+    exceeded = ((np.abs(u) > max_u_velocity) |
+                (np.abs(v) > max_v_velocity))
+
+    return _flags(exceeded, 'bad', 'good', out)
+
+
+def vertical_velocity_test(w, max_w_velocity=15, out=None):
+    """
+    QARTOD Test #13 Strongly Recommended
+    vertical velocity test
+    if w greater than 15 cm/s (10% MAX speed from WFS), w is bad
+    """
+
+    return _flags(np.abs(w) <= max_w_velocity, 'good', 'bad', out)
+
+
+def error_velocity_test(error_velocities,
+                        suspect_error_velocity=2.6,
+                        bad_error_velocity=5.2, out=None):
+    """
+    QARTOD Test #14 Required
+    error velocity test
+    err < 2.6 cm/s, good: err > 5.2 cm/s, bad
+    """
+
+    error_velocities = np.asarray(error_velocities)
+
+    flags = _output(error_velocities.shape, out)
+    flags[...] = ADCP_FLAGS['bad']
+    flags[error_velocities < bad_error_velocity] = ADCP_FLAGS['suspect']
+    flags[error_velocities < suspect_error_velocity] = ADCP_FLAGS['good']
+
+    return flags
+
+
+def _same(values, previous, tolerance):
+    if tolerance:
+        return np.abs(values.astype(np.float64) - previous) <= tolerance
+    return values == previous
+
+
+def run_lengths(values, previous=None, previous_run=0, tolerance=0):
+    """
+    Counts how many times in a row each value has repeated (to within
+    tolerance of the value before it) along the first (ensemble) axis.
+    previous and previous_run continue the count from the last ensemble
+    before values.
+    """
+
+    values = np.asarray(values)
+    same = np.empty(values.shape, dtype=bool)
+    if previous is None:
+        same[:1] = False
+    else:
+        same[:1] = _same(values[:1], previous, tolerance)
+    same[1:] = _same(values[1:], values[:-1], tolerance)
+
+    index = np.arange(len(values)).reshape((-1,) + (1,) * (values.ndim - 1))
+    run_start = np.maximum.accumulate(np.where(same, -1, index), axis=0)
+
+    return np.where(run_start < 0,
+                    index + 1 + np.asarray(previous_run),
+                    index - run_start + 1)
+
+
+def stuck_sensor_test(echo_intensities, tolerance=4,
+                      previous=None, previous_run=0, out=None):
+    """
+    QARTOD Test #15 Strongly Recommended
+    stuck sensor test over (n_ensembles, n_bins, n_beams) echo
+    intensities.  A bin is bad when any of its beams repeats the same
+    value more than tolerance ensembles in a row.
+    """
+
+    stuck = run_lengths(echo_intensities, previous, previous_run) > tolerance
+
+    return _flags(stuck.any(axis=-1), 'bad', 'good', out)
+
+
+def echo_intensity_test(echo_intensities, tolerance=2, out=None):
+    """
+    QARTOD Test #16 Required
+    echo intensity test
+    Bins are on the second to last axis, beams on the last axis.
+    The first bin has no neighbour and is always good.
+    """
+
+    if kernels.ENABLED:
+        return kernels.echo_intensity_test(echo_intensities, tolerance, out)
+
+    intensity = np.asarray(echo_intensities).astype(np.int64)
+    beam_diff = intensity[..., :-1, :] - intensity[..., 1:, :]
+    flag_count = (beam_diff < tolerance).sum(axis=-1)
+
+    flags = _output(intensity.shape[:-1], out)
+    flags[..., :1] = ADCP_FLAGS['good']
+    pair_flags = flags[..., 1:]
+    pair_flags[...] = ADCP_FLAGS['bad']
+    pair_flags[flag_count == 1] = ADCP_FLAGS['suspect']
+    pair_flags[flag_count == 0] = ADCP_FLAGS['good']
+
+    return flags
+
+
+def range_drop_off_test(echo_intensities, drop_off_limit=60, out=None):
+    """
+    QARTOD Test #17 Strongly Recommended
+    range drop-off test
+    Range Limit set to 60 as recommended in QARTOD spreadsheet (CO-OPS).
+    """
+
+    flag_count = (np.asarray(echo_intensities) < drop_off_limit).sum(axis=-1)
+
+    return _flags(flag_count >= 2, 'bad', 'good', out)
+
+
+def current_speed_gradient_test(current_speed,
+                                tolerance=6, out=None):
+    """
+    QARTOD Test #18 Strongly Recommended
+    current speed gradient test
+    Bins are on the last axis.  The first bin is always good.
+    """
+
+    if kernels.ENABLED and np.ndim(current_speed) <= 2:
+        return kernels.current_speed_gradient_test(current_speed,
+                                                   tolerance, out)
+
+    current_speed = np.asarray(current_speed)
+    speed_diff = np.abs(np.diff(current_speed, axis=-1))
+
+    flags = _output(current_speed.shape, out)
+    flags[..., :1] = ADCP_FLAGS['good']
+    _flags(speed_diff <= tolerance, 'good', 'bad', flags[..., 1:])
+
+    return flags
+
+
+def _series(values, previous, history_size):
+    """
+    Joins the last history_size previous values (oldest first) with
+    values into one float series.  Returns the series and the number
+    of previous values in it.
+    """
+
+    values = np.asarray(values, dtype=np.float64)
+    if previous is None or history_size < 1:
+        return values, 0
+    previous = np.asarray(previous, dtype=np.float64)[-history_size:]
+    return np.concatenate((previous, values)), len(previous)
+
+
+def window_sums(values, window):
+    """
+    Sums of every window consecutive values along the first axis from
+    a running (cumulative) sum, so the cost per value does not depend
+    on window
+    """
+
+    totals = np.zeros((len(values) + 1,) + values.shape[1:],
+                      dtype=np.result_type(values, np.int64))
+    np.cumsum(values, axis=0, out=totals[1:])
+    return totals[window:] - totals[:-window]
+
+
+def rolling_stats(values, window, previous=None):
+    """
+    Mean and standard deviation of the window values before each value
+    along the first (ensemble) axis.  previous holds the values just
+    before values (oldest first) to continue a series.  Values without
+    a full window of finite history get NaN.
+    """
+
+    series, n_previous = _series(values, previous, window)
+    n_values = len(series) - n_previous
+    mean = np.full(series.shape, np.nan)[n_previous:]
+    std = np.full(series.shape, np.nan)[n_previous:]
+
+    first = max(window - n_previous, 0)
+    count = n_values - first
+    if count > 0:
+        history = series[n_previous + first - window:-1]
+        finite = np.isfinite(history)
+        # sums are taken about the first window's mean so that the sum
+        # of squares keeps its precision when the mean is large
+        shift = np.where(finite[:window], history[:window], 0.).mean(axis=0)
+        shifted = np.where(finite, history - shift, 0.)
+        window_mean = window_sums(shifted, window) / window
+        variance = np.maximum(
+            window_sums(shifted * shifted, window) / window -
+            window_mean * window_mean, 0.
+        )
+        invalid = window_sums(~finite, window) > 0
+        mean[first:] = np.where(invalid, np.nan, shift + window_mean)
+        std[first:] = np.where(invalid, np.nan, np.sqrt(variance))
+
+    return mean, std
+
+
+def rate_of_change_flags(values, rate, std, n_dev=3, min_rate=0, out=None):
+    """
+    Rate of change test flags of values given their rate of change and
+    the standard deviation of the window before them
+    """
+
+    flags = _output(values.shape, out)
+    flags[...] = ADCP_FLAGS['good']
+    with np.errstate(invalid='ignore'):
+        flags[rate > np.maximum(n_dev * std, min_rate)] = (
+            ADCP_FLAGS['suspect']
+        )
+    flags[~np.isfinite(std)] = ADCP_FLAGS['no_test']
+    flags[~np.isfinite(values)] = ADCP_FLAGS['missing_data']
+
+    return flags
+
+
+def rate_of_change_test(values, window=12, n_dev=3, min_rate=0,
+                        previous=None, out=None):
+    """
+    Time series rate of change test along the first (ensemble) axis.
+    A value is suspect when it differs from the value before it by more
+    than n_dev standard deviations of the previous window values (and
+    by more than min_rate).  Values without a full window of history
+    are not tested.  Non-finite values are missing_data.
+    """
+
+    series, n_previous = _series(values, previous, window)
+    _, std = rolling_stats(values, window, previous)
+    rate = np.full(std.shape, np.nan)
+    rate[max(1 - n_previous, 0):] = np.abs(
+        np.diff(series, axis=0)[max(n_previous - 1, 0):]
+    )
+
+    return rate_of_change_flags(series[n_previous:], rate, std, n_dev,
+                                min_rate, out)
+
+
+def spike_flags(values, mean, std, suspect_dev=3, bad_dev=5,
+                min_deviation=0, out=None):
+    """
+    Spike test flags of values given the mean and standard deviation
+    of the window before them
+    """
+
+    deviation = np.abs(values - mean)
+
+    flags = _output(values.shape, out)
+    flags[...] = ADCP_FLAGS['good']
+    with np.errstate(invalid='ignore'):
+        flags[deviation > np.maximum(suspect_dev * std, min_deviation)] = (
+            ADCP_FLAGS['suspect']
+        )
+        flags[deviation > np.maximum(bad_dev * std, min_deviation)] = (
+            ADCP_FLAGS['bad']
+        )
+    flags[~np.isfinite(std)] = ADCP_FLAGS['no_test']
+    flags[~np.isfinite(values)] = ADCP_FLAGS['missing_data']
+
+    return flags
+
+
+def spike_test(values, window=12, suspect_dev=3, bad_dev=5,
+               min_deviation=0, previous=None, out=None):
+    """
+    Time series spike test along the first (ensemble) axis.  A value
+    is suspect (bad) when it is more than suspect_dev (bad_dev)
+    standard deviations, and more than min_deviation, away from the
+    mean of the previous window values.  Values without a full window
+    of history are not tested.  Non-finite values are missing_data.
+    """
+
+    current = np.asarray(values, dtype=np.float64)
+    mean, std = rolling_stats(current, window, previous)
+
+    return spike_flags(current, mean, std, suspect_dev, bad_dev,
+                       min_deviation, out)
+
+
+def flat_line_flags(values, runs, suspect_count=3, fail_count=5, out=None):
+    """
+    Flat line test flags of values given their run_lengths
+    """
+
+    flags = _output(values.shape, out)
+    flags[...] = ADCP_FLAGS['good']
+    flags[runs > suspect_count] = ADCP_FLAGS['suspect']
+    flags[runs > fail_count] = ADCP_FLAGS['bad']
+    flags[~np.isfinite(values)] = ADCP_FLAGS['missing_data']
+
+    return flags
+
+
+def flat_line_test(values, tolerance=0, suspect_count=3, fail_count=5,
+                   previous=None, out=None):
+    """
+    Time series flat line test along the first (ensemble) axis.  A
+    value is suspect (bad) when more than suspect_count (fail_count)
+    values in a row, ending with it, each stay within tolerance of the
+    value before them.  Signals attenuated to less than tolerance are
+    caught as well as exact repeats.  Non-finite values are
+    missing_data.
+    """
+
+    series, n_previous = _series(values, previous, fail_count)
+    runs = run_lengths(series, tolerance=tolerance)[n_previous:]
+
+    return flat_line_flags(series[n_previous:], runs, suspect_count,
+                           fail_count, out)
+
+
+def find_bottom_bin(echo_intensities, tolerance=30, absolute=True):
+    """
+    Finds the bin at which echo intensity jumps in at least two beams
+    (the bottom), scanning adjacent bin pairs from the transducer out.
+    Returns the 1 based bottom bin for each ensemble.  Ensembles without
+    a jump report the number of bins.
+    """
+
+    if kernels.ENABLED:
+        return kernels.find_bottom_bin(echo_intensities, tolerance,
+                                       absolute)
+
+    intensity = np.asarray(echo_intensities).astype(np.int64)
+    bin_diff = intensity[..., 1:, :] - intensity[..., :-1, :]
+    if absolute:
+        bin_diff = np.abs(bin_diff)
+    bottom_hit = (bin_diff > tolerance).sum(axis=-1) >= 2
+
+    return np.where(bottom_hit.any(axis=-1),
+                    bottom_hit.argmax(axis=-1) + 1,
+                    intensity.shape[-2])
+
+
+def slice_length(stop, length):
+    """
+    Number of items kept by sequence[:stop] for each stop, following
+    Python slice semantics for negative stops
+    """
+
+    stop = np.asarray(stop)
+    stop = np.where(stop < 0, stop + length, stop)
+
+    return np.clip(stop, 0, length)
+
+
+def leading_bin_mask(stop, n_bins):
+    """
+    Boolean (n_ensembles, n_bins) mask of the bins kept by
+    bins[:stop] for each ensemble's stop
+    """
+
+    kept = slice_length(stop, n_bins)
+
+    return np.arange(n_bins) < kept[..., np.newaxis]
+
+
+def apply_bin_mask(flags, mask, out=None):
+    """
+    Returns a preallocated (n_ensembles, n_bins) flag array holding
+    flags where mask is set and missing_data everywhere else.  flags
+    may itself be out, in which case it is masked in place.
+    """
+
+    bin_flags = _output(mask.shape, out)
+    if bin_flags is not flags:
+        bin_flags[...] = flags
+    np.copyto(bin_flags, ADCP_FLAGS['missing_data'], where=~mask)
+
+    return bin_flags
+
+
+def missing_values(values, ndim=2):
+    """
+    Boolean mask, shaped like the first ndim axes of values, of the
+    positions where any value along the remaining axes is masked
+    (numpy.ma) or not finite.  Returns None when nothing is missing.
+    """
+
+    missing = None
+    data = np.ma.getdata(values)
+    if data.dtype.kind in 'fc':
+        missing = ~np.isfinite(data)
+    mask = np.ma.getmask(values)
+    if mask is not np.ma.nomask:
+        missing = mask if missing is None else missing | mask
+    if missing is None:
+        return None
+
+    if missing.ndim > ndim:
+        missing = missing.reshape(missing.shape[:ndim] + (-1,)).any(axis=-1)
+    return missing if missing.any() else None
+
+
+def mark_missing(flags, *values):
+    """
+    Sets flags to missing_data in place wherever any of values is
+    masked or not finite.  values share the leading shape of flags and
+    may have extra (beam) axes.  Returns flags.
+    """
+
+    for value in values:
+        missing = missing_values(value, np.ndim(flags))
+        if missing is not None:
+            np.copyto(flags, ADCP_FLAGS['missing_data'], where=missing)
+
+    return flags
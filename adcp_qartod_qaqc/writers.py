@@ -0,0 +1,259 @@
+# Writers.py - Columnar output of QA/QC flags, velocities and bottom stats
+#
+# Results are appended chunk by chunk so a deployment never has to be
+# held in memory.  NetCDF files follow the CF conventions for flags
+# (flag_values, flag_meanings and ancillary_variables built from
+# ADCP_FLAGS) and need netCDF4.  Parquet files hold one row per
+# ensemble and bin and need pyarrow.
+
+from collections import OrderedDict
+
+import numpy as np
+
+try:
+    import netCDF4
+except ImportError:
+    netCDF4 = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from adcp_qartod_qaqc.pd0 import PD0File, PD0Data
+from adcp_qartod_qaqc.session import QCSession
+from adcp_qartod_qaqc.tests import ADCP_FLAGS, QARTOD_TESTS
+
+
+VELOCITY_COMPONENTS = (
+    ('u', 'eastward_sea_water_velocity'),
+    ('v', 'northward_sea_water_velocity'),
+    ('w', 'upward_sea_water_velocity'),
+    ('error_velocity', None)
+)
+
+BOTTOM_STATS = ('bottom_bin', 'range_to_bottom', 'side_lobe_start',
+                'last_good_bin', 'last_good_counter')
+
+ROLLUP = 'qartod_rollup'
+
+
+def flag_attributes():
+    """
+    CF flag_values and flag_meanings describing ADCP_FLAGS
+    """
+    meanings = sorted(ADCP_FLAGS.items(), key=lambda item: item[1])
+    return {
+        'flag_values': np.array([value for _, value in meanings],
+                                dtype=np.uint8),
+        'flag_meanings': ' '.join(name for name, _ in meanings)
+    }
+
+
+def flag_variable(name):
+    return 'qartod_' + name
+
+
+def result_columns(flags, velocity=None, bottom_stats=None):
+    """
+    Returns the (ensemble, bin) and (ensemble,) arrays of a chunk of
+    results keyed by output variable name: velocity components, one
+    flag array per test, the worst flag rollup and the bottom stats
+    """
+
+    columns = OrderedDict()
+    if velocity is not None:
+        for i, (name, _) in enumerate(VELOCITY_COMPONENTS):
+            columns[name] = np.asarray(velocity[..., i], dtype=np.float32)
+    for name, test_flags in flags.items():
+        columns[flag_variable(name)] = test_flags
+    columns[ROLLUP] = flags.worst()
+    if bottom_stats is not None:
+        for key in BOTTOM_STATS:
+            columns[key] = np.asarray(bottom_stats[key])
+
+    return columns
+
+
+class NetCDFWriter(object):
+    """
+    Appends results to a CF NetCDF4 file along an unlimited time
+    dimension.  Velocities are in cm/s and carry the flag variables as
+    ancillary_variables.
+    """
+
+    def __init__(self, path, n_bins, names=QARTOD_TESTS, velocity=True,
+                 bottom_stats=True, chunk_size=1000):
+        if netCDF4 is None:
+            raise ImportError('NetCDFWriter requires netCDF4')
+
+        self.names = tuple(names)
+        self.n_written = 0
+        self.dataset = netCDF4.Dataset(path, 'w', format='NETCDF4')
+        self.dataset.Conventions = 'CF-1.6'
+        self.dataset.createDimension('time', None)
+        self.dataset.createDimension('bin', n_bins)
+
+        time = self.dataset.createVariable('time', 'i8', ('time',),
+                                           chunksizes=(chunk_size,))
+        time.standard_name = 'time'
+        time.units = 'milliseconds since 1970-01-01 00:00:00'
+        time.calendar = 'standard'
+        bins = self.dataset.createVariable('bin', 'i4', ('bin',))
+        bins.long_name = 'bin number'
+        bins[:] = np.arange(1, n_bins + 1)
+
+        flag_names = [flag_variable(name) for name in self.names]
+        chunks = (chunk_size, n_bins)
+        for name in flag_names + [ROLLUP]:
+            variable = self.dataset.createVariable(
+                name, 'u1', ('time', 'bin'), zlib=True, chunksizes=chunks,
+                fill_value=ADCP_FLAGS['missing_data']
+            )
+            variable.setncatts(flag_attributes())
+            if name == ROLLUP:
+                variable.standard_name = 'aggregate_quality_flag'
+                variable.long_name = 'QARTOD worst flag of all tests'
+            else:
+                variable.long_name = 'QARTOD %s test flag' % name[7:]
+
+        if velocity:
+            for name, standard_name in VELOCITY_COMPONENTS:
+                variable = self.dataset.createVariable(
+                    name, 'f4', ('time', 'bin'), zlib=True,
+                    chunksizes=chunks, fill_value=np.float32(np.nan)
+                )
+                variable.units = 'cm s-1'
+                if standard_name is not None:
+                    variable.standard_name = standard_name
+                else:
+                    variable.long_name = 'error velocity'
+                variable.ancillary_variables = ' '.join(flag_names +
+                                                        [ROLLUP])
+
+        if bottom_stats:
+            for key in BOTTOM_STATS:
+                dtype = 'f8' if key == 'range_to_bottom' else 'i4'
+                variable = self.dataset.createVariable(
+                    key, dtype, ('time',), chunksizes=(chunk_size,)
+                )
+                variable.long_name = key.replace('_', ' ')
+            self.dataset['range_to_bottom'].units = 'm'
+
+    def write(self, timestamps, flags, velocity=None, bottom_stats=None):
+        """
+        Appends one chunk: datetime64 timestamps, a QCResult and
+        optionally (ensemble, bin, beam) velocities and bottom stats
+        """
+
+        first = self.n_written
+        last = first + len(timestamps)
+        self.dataset['time'][first:last] = (
+            np.asarray(timestamps, dtype='datetime64[ms]').astype(np.int64)
+        )
+        for name, values in result_columns(flags, velocity,
+                                           bottom_stats).items():
+            if name in self.dataset.variables:
+                self.dataset[name][first:last] = values
+        self.n_written = last
+
+    def close(self):
+        self.dataset.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ParquetWriter(object):
+    """
+    Appends results to a Parquet file, one row group per chunk and one
+    row per ensemble and bin.  Ensemble values (time, bottom stats) are
+    repeated on every bin of the ensemble.
+    """
+
+    def __init__(self, path, names=QARTOD_TESTS, velocity=True,
+                 bottom_stats=True):
+        if pyarrow is None:
+            raise ImportError('ParquetWriter requires pyarrow')
+
+        fields = [('time', pyarrow.timestamp('ms')),
+                  ('ensemble', pyarrow.int64()),
+                  ('bin', pyarrow.int32())]
+        if velocity:
+            fields += [(name, pyarrow.float32())
+                       for name, _ in VELOCITY_COMPONENTS]
+        fields += [(flag_variable(name), pyarrow.uint8())
+                   for name in names]
+        fields.append((ROLLUP, pyarrow.uint8()))
+        if bottom_stats:
+            fields += [(key, pyarrow.float64() if key == 'range_to_bottom'
+                        else pyarrow.int32()) for key in BOTTOM_STATS]
+
+        self.schema = pyarrow.schema(fields)
+        self.n_written = 0
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+
+    def write(self, timestamps, flags, velocity=None, bottom_stats=None):
+        """
+        Appends one chunk: datetime64 timestamps, a QCResult and
+        optionally (ensemble, bin, beam) velocities and bottom stats
+        """
+
+        n_ensembles, n_bins = flags.shape
+        columns = result_columns(flags, velocity, bottom_stats)
+        columns['time'] = np.asarray(timestamps, dtype='datetime64[ms]')
+        columns['ensemble'] = self.n_written + np.arange(n_ensembles)
+        columns['bin'] = np.tile(np.arange(1, n_bins + 1), n_ensembles)
+
+        arrays = []
+        for field in self.schema:
+            if field.name not in columns:
+                arrays.append(pyarrow.nulls(n_ensembles * n_bins,
+                                            field.type))
+                continue
+            values = np.asarray(columns[field.name])
+            if values.ndim == 1 and field.name != 'bin':
+                values = np.repeat(values, n_bins)
+            arrays.append(pyarrow.array(values.ravel(), type=field.type))
+
+        self.writer.write_table(
+            pyarrow.Table.from_arrays(arrays, schema=self.schema)
+        )
+        self.n_written += n_ensembles
+
+    def close(self):
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def export_pd0(path, writer, chunk_size=1000, transducer_depth=None,
+               plan=None):
+    """
+    QA/QCs a PD0 file chunk_size ensembles at a time and appends the
+    flags, velocities and bottom stats of every chunk to writer.  A
+    config.TestPlan limits the tests run and sets their limits.
+    Returns the number of ensembles written.
+    """
+
+    session = QCSession(transducer_depth, plan=plan)
+    with PD0File(path) as pd0:
+        for first in range(0, pd0.n_ensembles, chunk_size):
+            last = first + chunk_size
+            stop = (pd0.offsets[last] if last < pd0.n_ensembles
+                    else len(pd0.raw))
+            chunk = PD0Data(pd0.raw, pd0.offsets[first], stop)
+            flags = session.update_pd0(chunk)
+            writer.write(chunk.timestamps, flags,
+                         session.qaqc.data['velocity'],
+                         session.qaqc.bottom_stats)
+
+    return session.n_ensembles
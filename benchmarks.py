@@ -0,0 +1,312 @@
+# Benchmarks.py - Times the QARTOD tests and the QAQC classes on
+# synthetic ensembles
+#
+# Run with e.g.
+#   python benchmarks.py --ensembles 2000 --bins 50 --output run.json
+#   python benchmarks.py --output new.json --compare run.json
+#
+# Every benchmark reports the best wall time of --repeat runs, the
+# ensembles per second at that time and the peak memory allocated
+# during the run.
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+    import resource
+
+from adcp_qartod_qaqc import tests as list_tests
+from adcp_qartod_qaqc import trdiUH
+from adcp_qartod_qaqc import vectorized
+from adcp_qartod_qaqc.parallel import run_files
+from adcp_qartod_qaqc.synthetic import (
+    synthetic_ensembles,
+    synthetic_multiread,
+    write_pd0
+)
+from adcp_qartod_qaqc.trdi import (
+    TRDIQAQC,
+    TRDIDeploymentQAQC,
+    stack_ensembles
+)
+
+
+def peak_memory(function):
+    """
+    Calls function and returns the peak number of bytes it allocated.
+    Without tracemalloc this is the growth of the process' maximum
+    resident set size, which stays 0 once an earlier run went higher.
+    """
+
+    if tracemalloc is not None:
+        tracemalloc.start()
+        try:
+            function()
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    function()
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on OS X and in kilobytes elsewhere
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return (after - before) * scale
+
+
+def measure(function, n_ensembles, repeat=3):
+    """
+    Times function repeat times.  Returns a dictionary with the best
+    time, ensembles per second and peak memory.
+    """
+
+    times = []
+    for _ in range(repeat):
+        started = time.time()
+        function()
+        times.append(time.time() - started)
+
+    seconds = min(times)
+    return {
+        'n_ensembles': n_ensembles,
+        'seconds': seconds,
+        'ensembles_per_second': n_ensembles / (seconds or float('nan')),
+        'peak_bytes': peak_memory(function)
+    }
+
+
+def list_test_cases(ensembles):
+    """
+    Returns (name, function) pairs running one list based test from
+    adcp_qartod_qaqc.tests over every ensemble
+    """
+
+    velocity = [np.array(e['velocity']['data']) for e in ensembles]
+    speed = [np.hypot(v[:, 0], v[:, 1]).tolist() for v in velocity]
+    direction = [(np.arctan2(v[:, 0], v[:, 1]) * 180 / np.pi % 360).tolist()
+                 for v in velocity]
+    correlation = [e['correlation']['data'] for e in ensembles]
+    echo = [e['echo_intensity']['data'] for e in ensembles]
+    percent_good = [np.array(e['percent_good']['data']) for e in ensembles]
+    leaders = [e['variable_leader'] for e in ensembles]
+
+    def over(test, arguments):
+        def run():
+            for argument in arguments:
+                test(*argument)
+        return run
+
+    return [
+        ('battery', over(list_tests.battery_flag_test,
+                         [(e,) for e in ensembles])),
+        ('checksum', over(list_tests.checksum_test,
+                          [(e,) for e in ensembles])),
+        ('bit', over(list_tests.bit_test,
+                     [(leader['bit_result'],) for leader in leaders])),
+        ('orientation', over(list_tests.orientation_test,
+                             [(leader['pitch'] / 100.,
+                               leader['roll'] / 100.)
+                              for leader in leaders])),
+        ('sound_speed', over(list_tests.sound_speed_test,
+                             [(leader['speed_of_sound'],)
+                              for leader in leaders])),
+        ('correlation_magnitude', over(list_tests.correlation_magnitude_test,
+                                       [(c,) for c in correlation])),
+        ('percent_good', over(list_tests.percent_good_test,
+                              [(p[:, 2].tolist(), p[:, 3].tolist())
+                               for p in percent_good])),
+        ('current_speed', over(list_tests.current_speed_test,
+                               [(s,) for s in speed])),
+        ('current_direction', over(list_tests.current_direction_test,
+                                   [(d,) for d in direction])),
+        ('horizontal_velocity', over(list_tests.horizontal_velocity_test,
+                                     [(v[:, 0].tolist(), v[:, 1].tolist())
+                                      for v in velocity])),
+        ('vertical_velocity', over(list_tests.vertical_velocity_test,
+                                   [(v[:, 2].tolist(),) for v in velocity])),
+        ('error_velocity', over(list_tests.error_velocity_test,
+                                [(v[:, 3].tolist(),) for v in velocity])),
+        ('stuck_sensor', over(list_tests.stuck_sensor_test,
+                              [(echo[i], echo[max(0, i - 5):i])
+                               for i in range(len(echo))])),
+        ('echo_intensity', over(list_tests.echo_intensity_test,
+                                [(e,) for e in echo])),
+        ('range_drop_off', over(list_tests.range_drop_off_test,
+                                [(e,) for e in echo])),
+        ('current_speed_gradient', over(list_tests.current_speed_gradient_test,
+                                        [(s,) for s in speed]))
+    ]
+
+
+def vectorized_test_cases(ensembles):
+    """
+    Returns (name, function) pairs running the vectorized version of
+    each list_test_cases test over every ensemble at once
+    """
+
+    stack = stack_ensembles(ensembles)
+    velocity = stack['velocity']
+    speed = np.hypot(velocity[..., 0], velocity[..., 1])
+    direction = np.arctan2(velocity[..., 0], velocity[..., 1]) * 180 / np.pi
+    direction %= 360
+    echo = stack['echo_intensity']
+    percent_good = stack['percent_good']
+    leader = stack['variable_leader']
+
+    def call(test, *arguments):
+        return lambda: test(*arguments)
+
+    return [
+        ('bit', call(vectorized.bit_test, leader['bit_result'])),
+        ('orientation', call(vectorized.orientation_test,
+                             leader['pitch'] / 100., leader['roll'] / 100.)),
+        ('sound_speed', call(vectorized.sound_speed_test,
+                             leader['speed_of_sound'])),
+        ('correlation_magnitude', call(vectorized.correlation_magnitude_test,
+                                       stack['correlation'])),
+        ('percent_good', call(vectorized.percent_good_test,
+                              percent_good[..., 2], percent_good[..., 3])),
+        ('current_speed', call(vectorized.current_speed_test, speed)),
+        ('current_direction', call(vectorized.current_direction_test,
+                                   direction)),
+        ('horizontal_velocity', call(vectorized.horizontal_velocity_test,
+                                     velocity[..., 0], velocity[..., 1])),
+        ('vertical_velocity', call(vectorized.vertical_velocity_test,
+                                   velocity[..., 2])),
+        ('error_velocity', call(vectorized.error_velocity_test,
+                                velocity[..., 3])),
+        ('stuck_sensor', call(vectorized.stuck_sensor_test, echo)),
+        ('echo_intensity', call(vectorized.echo_intensity_test, echo)),
+        ('range_drop_off', call(vectorized.range_drop_off_test, echo)),
+        ('current_speed_gradient', call(
+            vectorized.current_speed_gradient_test, speed
+        ))
+    ]
+
+
+def run_benchmarks(n_ensembles, n_bins, n_beams=4, repeat=3, seed=1407):
+    """
+    Runs every benchmark and returns a dictionary of the run's
+    settings and the measure() results keyed by benchmark name
+    """
+
+    ensembles = list(synthetic_ensembles(n_ensembles, n_bins, n_beams,
+                                         seed=seed))
+    results = {}
+
+    for name, function in list_test_cases(ensembles):
+        results['tests.' + name] = measure(function, n_ensembles, repeat)
+    for name, function in vectorized_test_cases(ensembles):
+        results['vectorized.' + name] = measure(function, n_ensembles,
+                                                repeat)
+
+    def trdi_init():
+        for ensemble in ensembles:
+            TRDIQAQC(ensemble, transducer_depth=104)
+    results['trdi.TRDIQAQC.__init__'] = measure(trdi_init, n_ensembles,
+                                                repeat)
+
+    results['trdi.TRDIDeploymentQAQC.__init__'] = measure(
+        lambda: TRDIDeploymentQAQC.from_ensembles(ensembles, 104),
+        n_ensembles, repeat
+    )
+    results['trdi.TRDIDeploymentQAQC.run_all'] = measure(
+        TRDIDeploymentQAQC.from_ensembles(ensembles, 104).run_all,
+        n_ensembles, repeat
+    )
+
+    multiread = synthetic_multiread(n_ensembles, n_bins, seed=seed)
+    results['trdiUH.TRDIQAQC.__init__'] = measure(
+        lambda: trdiUH.TRDIQAQC(multiread, 10), n_ensembles, repeat
+    )
+    results['trdiUH.TRDIQAQC.variable_leader_flags'] = measure(
+        trdiUH.TRDIQAQC(multiread, 10).variable_leader_flags,
+        n_ensembles, repeat
+    )
+    results['trdiUH.TRDIQAQC.run_all'] = measure(
+        trdiUH.TRDIQAQC(multiread, 10).run_all, n_ensembles, repeat
+    )
+
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'synthetic.pd0')
+        with open(path, 'wb') as pd0_file:
+            write_pd0(pd0_file, ensembles)
+        results['parallel.run_files'] = measure(
+            lambda: run_files([path], workers=1), n_ensembles, repeat
+        )
+    finally:
+        shutil.rmtree(directory)
+
+    return {
+        'settings': {
+            'n_ensembles': n_ensembles,
+            'n_bins': n_bins,
+            'n_beams': n_beams,
+            'repeat': repeat,
+            'seed': seed,
+            'python': platform.python_version(),
+            'numpy': np.__version__
+        },
+        'results': results
+    }
+
+
+def compare(run, baseline):
+    """
+    Returns (name, seconds, baseline seconds) for the benchmarks in
+    both runs
+    """
+
+    return [(name, result['seconds'], baseline['results'][name]['seconds'])
+            for name, result in sorted(run['results'].items())
+            if name in baseline['results']]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ensembles', type=int, default=1000,
+                        help='Number of synthetic ensembles')
+    parser.add_argument('--bins', type=int, default=50,
+                        help='Number of bins per ensemble')
+    parser.add_argument('--beams', type=int, default=4,
+                        help='Number of beams (at least 4)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Runs per benchmark, the best time is kept')
+    parser.add_argument('--output', help='Path of JSON results to write')
+    parser.add_argument('--compare', help='Path of earlier JSON results')
+    args = parser.parse_args()
+
+    run = run_benchmarks(args.ensembles, args.bins, args.beams, args.repeat)
+    for name, result in sorted(run['results'].items()):
+        print('%-40s %10.4f s %12.1f ens/s %12d B' % (
+            name, result['seconds'], result['ensembles_per_second'],
+            result['peak_bytes']))
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        print('')
+        for name, seconds, baseline_seconds in compare(run, baseline):
+            print('%-40s %8.2fx' % (name, baseline_seconds / seconds))
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(run, output_file, indent=2, sort_keys=True)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,9 +1,20 @@
-from distutils.core import setup
+try:
+    from setuptools import setup
+except ImportError:
+    from distutils.core import setup
 
 setup(
     name='adcp_qartod_qaqc',
     version='1.0',
     author='Michael Lindemuth',
     author_email='mlindemu@usf.edu',
-    packages=['adcp_qartod_qaqc']
+    packages=['adcp_qartod_qaqc'],
+    install_requires=[
+        'numpy',
+        'futures; python_version < "3"',
+        'trdi_adcp_readers'
+    ],
+    entry_points={
+        'console_scripts': ['adcp-qartod = adcp_qartod_qaqc.cli:main']
+    }
 )
@@ -1,15 +1,109 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
 import unittest
+from itertools import count, islice
+
+import numpy as np
 
 from trdi_adcp_readers.readers import (
     read_PD15_file
 )
 
 from adcp_qartod_qaqc.trdi import (
-    TRDIQAQC
+    TRDIQAQC,
+    TRDIDeploymentQAQC,
+    stack_ensembles
+)
+
+from adcp_qartod_qaqc.cache import (
+    FlagCache,
+    pd0_key,
+    run_cached
+)
+
+from adcp_qartod_qaqc import cli
+
+from adcp_qartod_qaqc.config import (
+    compile_profile,
+    load_profile
+)
+
+if sys.version_info >= (3, 5):
+    import asyncio
+    from adcp_qartod_qaqc.ingest import (
+        IngestService
+    )
+
+from adcp_qartod_qaqc.fields import (
+    VelocityFields
+)
+
+from adcp_qartod_qaqc.incremental import (
+    FlatLineTest,
+    RateOfChangeTest,
+    SpikeTest,
+    StuckSensorTest
+)
+
+from adcp_qartod_qaqc.instrumentation import (
+    QCStats
+)
+
+from adcp_qartod_qaqc.parallel import (
+    run_files
+)
+
+from adcp_qartod_qaqc.pd0 import (
+    PD0Data,
+    PD0FrameBuffer
+)
+
+from adcp_qartod_qaqc.profiler import (
+    ProfilerQAQC,
+    get_backend
+)
+
+from adcp_qartod_qaqc.result import (
+    QCResult
+)
+
+from adcp_qartod_qaqc.session import (
+    QCSession
+)
+
+from adcp_qartod_qaqc.shared import (
+    SharedArrays,
+    run_shared,
+    shared_memory
+)
+
+from adcp_qartod_qaqc.stream import (
+    iter_chunks,
+    stream_flags
 )
 
+from adcp_qartod_qaqc.synthetic import (
+    encode_pd0,
+    synthetic_ensembles,
+    synthetic_multiread,
+    synthetic_profile,
+    write_pd0
+)
+
+from adcp_qartod_qaqc import writers
+
+from adcp_qartod_qaqc import kernels
+from adcp_qartod_qaqc import tests as list_tests
+from adcp_qartod_qaqc import trdiUH
+from adcp_qartod_qaqc import vectorized
+
 from adcp_qartod_qaqc.tests import (
-    ADCP_FLAGS
+    ADCP_FLAGS,
+    QARTOD_TESTS
 )
 
 
@@ -17,12 +111,1123 @@ class TestBaseTests(unittest.TestCase):
     pass
 
 
+class TestVectorizedTests(unittest.TestCase):
+
+    def setUp(self):
+        random = np.random.RandomState(1407)
+        self.n_ensembles = 5
+        self.n_bins = 30
+        shape = (self.n_ensembles, self.n_bins)
+        self.correlation = random.randint(40, 140, shape + (4,))
+        self.percent_good = random.randint(0, 30, shape + (4,))
+        self.echo = random.randint(20, 180, shape + (4,)).astype(np.uint8)
+        self.u = random.uniform(-200, 200, shape)
+        self.v = random.uniform(-200, 200, shape)
+        self.w = random.uniform(-30, 30, shape)
+        self.ev = random.uniform(-1, 8, shape)
+        self.speed = np.hypot(self.u, self.v)
+        self.direction = random.uniform(-180, 540, shape)
+
+    def assertMatches(self, list_test, vector_test, *columns):
+        vector_flags = vector_test(*columns)
+        self.assertEqual(np.uint8, vector_flags.dtype)
+        self.assertEqual(columns[0].shape[:2], vector_flags.shape[:2])
+        for i in range(self.n_ensembles):
+            expected = list_test(*[column[i].tolist() for column in columns])
+            self.assertEqual(expected, vector_flags[i].tolist())
+
+    def test_correlation_magnitude(self):
+        self.assertMatches(list_tests.correlation_magnitude_test,
+                           vectorized.correlation_magnitude_test,
+                           self.correlation)
+
+    def test_percent_good(self):
+        self.assertMatches(list_tests.percent_good_test,
+                           vectorized.percent_good_test,
+                           self.percent_good[..., 2],
+                           self.percent_good[..., 3])
+
+    def test_velocity_tests(self):
+        self.assertMatches(list_tests.current_speed_test,
+                           vectorized.current_speed_test, self.speed)
+        self.assertMatches(list_tests.current_direction_test,
+                           vectorized.current_direction_test, self.direction)
+        self.assertMatches(list_tests.horizontal_velocity_test,
+                           vectorized.horizontal_velocity_test, self.u, self.v)
+        self.assertMatches(list_tests.vertical_velocity_test,
+                           vectorized.vertical_velocity_test, self.w)
+        self.assertMatches(list_tests.error_velocity_test,
+                           vectorized.error_velocity_test, self.ev)
+        self.assertMatches(list_tests.current_speed_gradient_test,
+                           vectorized.current_speed_gradient_test, self.speed)
+
+    def test_echo_intensity_tests(self):
+        self.assertMatches(list_tests.echo_intensity_test,
+                           vectorized.echo_intensity_test, self.echo)
+        self.assertMatches(list_tests.range_drop_off_test,
+                           vectorized.range_drop_off_test, self.echo)
+
+    def test_ensemble_tests(self):
+        random = np.random.RandomState(1407)
+        bit_result = random.choice([0, 0, 0, 4], 50)
+        pitch = random.uniform(-30, 30, 50)
+        roll = random.uniform(-30, 30, 50)
+        sound_speed = random.uniform(1350, 1650, 50)
+
+        self.assertEqual([list_tests.bit_test(b) for b in bit_result],
+                         vectorized.bit_test(bit_result).tolist())
+        self.assertEqual(
+            vectorized.bit_test(bit_result).tolist(),
+            vectorized.bit_test(bit_result.astype(str)).tolist()
+        )
+        self.assertEqual(
+            [list_tests.orientation_test(p, r) for p, r in zip(pitch, roll)],
+            vectorized.orientation_test(pitch, roll).tolist()
+        )
+        self.assertEqual(
+            [list_tests.sound_speed_test(c) for c in sound_speed],
+            vectorized.sound_speed_test(sound_speed).tolist()
+        )
+
+        self.assertEqual([1, 4, 4, 9],
+                         vectorized.heading_test([359.9, 360.1, -1, np.nan])
+                         .tolist())
+        temperature = np.ma.masked_array([20.0, 41.0, 20.0],
+                                         [False, False, True])
+        self.assertEqual([1, 4, 9],
+                         vectorized.temperature_test(temperature).tolist())
+
+    def test_mark_missing(self):
+        flags = np.ones((2, 3), dtype=np.uint8)
+        velocity = np.ma.masked_array(np.zeros((2, 3, 4)))
+        velocity[0, 1, 2] = np.ma.masked
+        velocity[1, 2, 0] = np.nan
+        self.assertIsNone(vectorized.missing_values(self.u))
+        vectorized.mark_missing(flags, self.u, velocity)
+        self.assertEqual([[1, 9, 1], [1, 1, 9]], flags.tolist())
+
+
+class TestKernels(unittest.TestCase):
+
+    def setUp(self):
+        random = np.random.RandomState(1407)
+        self.echo = random.randint(0, 256, (20, 30, 4)).astype(np.uint8)
+        self.echo[:5] = np.arange(30)[:, np.newaxis] * 2
+        self.speed = random.uniform(0, 30, (20, 30))
+        self.speed[3, 7] = np.nan
+        self.enabled = kernels.ENABLED
+        kernels.ENABLED = False
+
+    def tearDown(self):
+        kernels.ENABLED = self.enabled
+
+    def implementations(self):
+        yield (kernels.bottom_bin_kernel, kernels.echo_intensity_kernel,
+               kernels.speed_gradient_kernel)
+        if kernels.numba is not None:
+            yield (kernels.BOTTOM_BIN, kernels.ECHO_INTENSITY,
+                   kernels.SPEED_GRADIENT)
+
+    def test_kernels_match_numpy(self):
+        for bottom_bin, echo_intensity, gradient in self.implementations():
+            for tolerance, absolute in ((30, True), (10, False)):
+                self.assertEqual(
+                    vectorized.find_bottom_bin(self.echo, tolerance,
+                                               absolute).tolist(),
+                    kernels.find_bottom_bin(self.echo, tolerance, absolute,
+                                            kernel=bottom_bin).tolist()
+                )
+            self.assertEqual(
+                vectorized.find_bottom_bin(self.echo[0]),
+                kernels.find_bottom_bin(self.echo[0], kernel=bottom_bin)
+            )
+            for tolerance in (2, -20):
+                self.assertEqual(
+                    vectorized.echo_intensity_test(self.echo,
+                                                   tolerance).tolist(),
+                    kernels.echo_intensity_test(
+                        self.echo, tolerance, kernel=echo_intensity
+                    ).tolist()
+                )
+            out = np.zeros(30, dtype=np.uint8)
+            kernels.current_speed_gradient_test(self.speed[3], out=out,
+                                                kernel=gradient)
+            self.assertEqual(
+                vectorized.current_speed_gradient_test(self.speed).tolist(),
+                kernels.current_speed_gradient_test(
+                    self.speed, kernel=gradient
+                ).tolist()
+            )
+            self.assertEqual(
+                vectorized.current_speed_gradient_test(self.speed[3]).tolist(),
+                out.tolist()
+            )
+
+    def test_enabled(self):
+        expected = TRDIDeploymentQAQC.from_ensembles(
+            synthetic_ensembles(6, 25, seed=1407), 104
+        ).flags()
+        kernels.ENABLED = kernels.numba is not None
+        flags = TRDIDeploymentQAQC.from_ensembles(
+            synthetic_ensembles(6, 25, seed=1407), 104
+        ).flags()
+        self.assertTrue((expected.flags == flags.flags).all())
+
+
+class TestVelocityFields(unittest.TestCase):
+
+    def test_compass_direction(self):
+        u = np.array([[0.0, 10.0, 0.0, -10.0, 3.0]])
+        v = np.array([[10.0, 0.0, -10.0, 0.0, 4.0]])
+        fields = VelocityFields(u, v)
+        self.assertEqual([], fields.computed())
+        self.assertEqual([[10, 10, 10, 10, 5]], fields.speed.tolist())
+        self.assertEqual(['speed'], fields.computed())
+        self.assertTrue(np.allclose([[0, 90, 180, 270, 36.8699]],
+                                    fields.direction, atol=1e-4))
+        self.assertIs(fields.direction, fields.direction)
+
+        direction = VelocityFields(np.array([-1e-20]), np.array([1.0]))
+        self.assertTrue(0 <= direction.direction[0] < 360)
+
+    def test_masks_kept(self):
+        u = np.ma.masked_array([[1.0, 2.0], [3.0, 4.0]],
+                               [[False, True], [False, False]])
+        v = np.ma.masked_array([[1.0, 2.0], [3.0, 4.0]],
+                               [[False, False], [True, False]])
+        fields = VelocityFields(u, v)
+        expected = [[False, True], [True, False]]
+        self.assertEqual((2, 2), fields.speed.shape)
+        self.assertEqual(expected, np.ma.getmaskarray(fields.speed).tolist())
+        self.assertEqual(expected,
+                         np.ma.getmaskarray(fields.direction).tolist())
+
+    def test_lazy_in_deployment(self):
+        deployment = TRDIDeploymentQAQC.from_ensembles(
+            synthetic_ensembles(4, 20, seed=1407), 104
+        )
+        deployment.current_speed_flags()
+        self.assertEqual(['speed'], deployment.fields.computed())
+        direction = deployment.current_direction
+        self.assertTrue(((direction >= 0) & (direction < 360)).all())
+
+
+class TestQCResult(unittest.TestCase):
+
+    def setUp(self):
+        self.result = QCResult.empty(2, 3, names=('a', 'b', 'c'))
+        self.result['a'] = [[1, 1, 1], [1, 3, 2]]
+        self.result['b'] = [[2, 4, 1], [1, 1, 2]]
+        self.result['c'] = [[2, 1, 9], [1, 1, 2]]
+
+    def test_views_share_one_block(self):
+        self.assertEqual((3, 2, 3), self.result.flags.shape)
+        self.assertTrue(self.result.flags.flags['C_CONTIGUOUS'])
+        self.result['b'][0, 0] = 3
+        self.assertEqual(3, self.result.flags[1, 0, 0])
+
+    def test_worst(self):
+        self.assertEqual([[1, 4, 9], [1, 3, 2]],
+                         self.result.worst().tolist())
+
+    def test_pack_round_trip(self):
+        packed = self.result.pack()
+        self.assertEqual(9, len(packed))
+        unpacked = QCResult.unpack(packed, (2, 3), names=('a', 'b', 'c'))
+        self.assertTrue((self.result.flags == unpacked.flags).all())
+
+
+class TestStuckSensor(unittest.TestCase):
+
+    def setUp(self):
+        random = np.random.RandomState(15)
+        self.echo = random.randint(50, 54, (40, 6, 4))
+        self.echo[10:16, 2, 1] = 99
+        self.echo[30:34, 4, 3] = 99
+
+    def test_list_test_needs_history(self):
+        self.assertEqual(ADCP_FLAGS['no_test'],
+                         list_tests.stuck_sensor_test(self.echo[0]))
+
+    def test_vectorized_matches_list_test(self):
+        flags = vectorized.stuck_sensor_test(self.echo, tolerance=4)
+        self.assertEqual(ADCP_FLAGS['bad'], flags[15, 2])
+        self.assertEqual(ADCP_FLAGS['good'], flags[33, 4])
+        for i in range(1, len(self.echo)):
+            expected = list_tests.stuck_sensor_test(
+                self.echo[i].tolist(), self.echo[:i].tolist(), tolerance=4
+            )
+            self.assertEqual(expected, flags[i].tolist())
+
+    def test_rolling_stats(self):
+        random = np.random.RandomState(3)
+        series = 1e4 + random.normal(0, 0.5, (3000, 2))
+        series[1500, 0] = np.nan
+        mean, std = vectorized.rolling_stats(series, 12)
+        windows = np.array([series[i - 12:i] for i in range(12, 3000)])
+        self.assertTrue(np.isnan(mean[:12]).all())
+        self.assertTrue(np.allclose(windows.mean(axis=1), mean[12:],
+                                    equal_nan=True))
+        self.assertTrue(np.allclose(windows.std(axis=1), std[12:],
+                                    equal_nan=True))
+
+        checker = SpikeTest()
+        checker.update_many(series)
+        last_mean, last_std = checker.stats()
+        self.assertTrue(np.allclose(series[-12:].mean(axis=0), last_mean))
+        self.assertTrue(np.allclose(series[-12:].std(axis=0), last_std))
+
+    def test_incremental_matches_vectorized(self):
+        expected = vectorized.stuck_sensor_test(self.echo, tolerance=4)
+        one_at_a_time = StuckSensorTest(tolerance=4)
+        blocks = StuckSensorTest(tolerance=4)
+        for i, ensemble in enumerate(self.echo):
+            self.assertEqual(expected[i].tolist(),
+                             one_at_a_time.update(ensemble).tolist())
+        self.assertTrue((one_at_a_time.recent == self.echo[-5:]).all())
+        for first in range(0, len(self.echo), 7):
+            block = blocks.update_many(self.echo[first:first + 7])
+            self.assertTrue((expected[first:first + 7] == block).all())
+
+
+class TestTimeSeries(unittest.TestCase):
+
+    def setUp(self):
+        random = np.random.RandomState(17)
+        self.speed = random.normal(50, 2, (60, 5))
+        self.speed[30, 1] += 6
+        self.speed[40, 2] += 30
+        self.speed[45:52, 3] = 42.0
+        self.speed[20, 4] = np.nan
+
+    def test_rate_of_change(self):
+        flags = vectorized.rate_of_change_test(self.speed, window=12)
+        self.assertTrue((flags[:12] == ADCP_FLAGS['no_test']).all())
+        self.assertEqual(ADCP_FLAGS['suspect'], flags[40, 2])
+        self.assertEqual(ADCP_FLAGS['missing_data'], flags[20, 4])
+        self.assertEqual(ADCP_FLAGS['good'], flags[59, 0])
+
+    def test_spike(self):
+        flags = vectorized.spike_test(self.speed, window=12)
+        self.assertEqual(ADCP_FLAGS['suspect'], flags[30, 1])
+        self.assertEqual(ADCP_FLAGS['bad'], flags[40, 2])
+
+    def test_flat_line(self):
+        flags = vectorized.flat_line_test(self.speed, suspect_count=3,
+                                          fail_count=5)
+        self.assertEqual([1, 1, 1, 3, 3, 4, 4],
+                         flags[45:52, 3].tolist())
+        attenuated = 42 + 0.01 * np.arange(8)
+        self.assertEqual(
+            ADCP_FLAGS['bad'],
+            vectorized.flat_line_test(attenuated, tolerance=0.05)[-1]
+        )
+
+    def test_incremental_matches_vectorized(self):
+        for test, checker in (
+                (vectorized.rate_of_change_test, RateOfChangeTest()),
+                (vectorized.spike_test, SpikeTest()),
+                (vectorized.flat_line_test, FlatLineTest())):
+            expected = test(self.speed)
+            self.assertEqual(expected[0].tolist(),
+                             checker.update(self.speed[0]).tolist())
+            for first in range(1, len(self.speed), 7):
+                block = checker.update_many(self.speed[first:first + 7])
+                self.assertTrue((expected[first:first + 7] == block).all())
+
+
+class TestTRDIDeploymentQAQC(unittest.TestCase):
+
+    def setUp(self):
+        self.n_bins = 25
+        self.deployment = TRDIDeploymentQAQC.from_ensembles(
+            synthetic_ensembles(6, self.n_bins, seed=1407),
+            transducer_depth=104
+        )
+        self.ensembles = [
+            TRDIQAQC(ensemble, transducer_depth=104)
+            for ensemble in synthetic_ensembles(6, self.n_bins, seed=1407)
+        ]
+
+    def test_bottom_stats(self):
+        for i, qaqc in enumerate(self.ensembles):
+            for key, value in qaqc.bottom_stats.items():
+                self.assertAlmostEqual(
+                    value, self.deployment.bottom_stats[key][i]
+                )
+
+    def test_missing_velocity(self):
+        stack = stack_ensembles(synthetic_ensembles(6, self.n_bins,
+                                                    bottom_bin=self.n_bins,
+                                                    seed=1407))
+        stack['velocity'][2, 3, 0] = np.nan
+        stack['velocity'][4, 5, 2] = np.nan
+        flags = TRDIDeploymentQAQC(stack, 104).flags()
+        for name in ('current_speed', 'current_direction',
+                     'horizontal_velocity', 'current_speed_gradient'):
+            self.assertEqual(ADCP_FLAGS['missing_data'], flags[name][2, 3])
+            self.assertNotEqual(ADCP_FLAGS['missing_data'],
+                                flags[name][4, 5])
+        self.assertEqual(ADCP_FLAGS['missing_data'],
+                         flags['vertical_velocity'][4, 5])
+
+    def test_flags_match_single_ensembles(self):
+        flags = self.deployment.flags()
+        self.assertEqual(19, len(flags))
+        for name, bin_flags in flags.items():
+            self.assertEqual((6, self.n_bins), bin_flags.shape)
+
+        for name in ('correlation_magnitude', 'percent_good',
+                     'current_speed', 'current_direction',
+                     'horizontal_velocity', 'vertical_velocity',
+                     'error_velocity', 'echo_intensity', 'range_drop_off',
+                     'current_speed_gradient'):
+            for i, qaqc in enumerate(self.ensembles):
+                method = getattr(qaqc, name + '_flags')
+                expected = list(method())
+                missing = self.n_bins - len(expected)
+                expected += [ADCP_FLAGS['missing_data']] * missing
+                self.assertEqual(expected, flags[name][i].tolist())
+
+        for i, qaqc in enumerate(self.ensembles):
+            self.assertTrue((flags['battery'][i] ==
+                             qaqc.battery_flag()).all())
+            self.assertTrue((flags['orientation'][i] ==
+                             qaqc.orientation_flags()).all())
+            self.assertTrue((flags['sound_speed'][i] ==
+                             qaqc.sound_speed_flags()).all())
+
+    def test_run_all_matches_single_tests(self):
+        flags, worst = self.deployment.run_all()
+        self.assertTrue((flags['percent_good'] ==
+                         self.deployment.percent_good_flags()).all())
+        self.assertTrue((flags['stuck_sensor'] ==
+                         self.deployment.stuck_sensor_flag()).all())
+        self.assertTrue((flags['orientation'] ==
+                         self.deployment.orientation_flags()).all())
+        self.assertTrue((worst == flags.worst()).all())
+
+
+class TestTRDIUHQAQC(unittest.TestCase):
+
+    def setUp(self):
+        self.n_bins = 20
+        self.data = synthetic_multiread(6, self.n_bins, seed=1)
+        self.qaqc = trdiUH.TRDIQAQC(self.data, 10)
+
+    def test_bottom_bins(self):
+        bottom_bins = [vectorized.find_bottom_bin(amp, absolute=False)
+                       for amp in self.data.amp]
+        self.assertEqual(
+            bottom_bins,
+            self.qaqc.ensemble_bottom_stats['bottom_bin'].tolist()
+        )
+        qaqc = trdiUH.TRDIQAQC(
+            synthetic_multiread(6, self.n_bins, bottom_bin=12, seed=1), 10
+        )
+        self.assertTrue(
+            (qaqc.ensemble_bottom_stats['bottom_bin'] == 12).all()
+        )
+
+    def test_bins_past_bottom_are_missing(self):
+        stats = self.qaqc.ensemble_bottom_stats
+        self.assertTrue((stats['side_lobe_start'] <
+                         stats['bottom_bin']).all())
+        self.assertTrue((self.qaqc.good_bin_mask.sum(axis=1) ==
+                         stats['last_good_counter']).all())
+
+        flags = self.qaqc.current_speed_flags()
+        for ensemble, bottom_bin in enumerate(stats['bottom_bin']):
+            self.assertTrue((flags[ensemble, bottom_bin:] ==
+                             ADCP_FLAGS['missing_data']).all())
+            self.assertTrue((flags[ensemble, :2] !=
+                             ADCP_FLAGS['missing_data']).all())
+
+        # a bottom in the second bin leaves no good bins
+        data = synthetic_multiread(2, self.n_bins, bottom_bin=1, seed=1)
+        qaqc = trdiUH.TRDIQAQC(data, 10)
+        self.assertFalse(qaqc.good_bin_mask.any())
+
+    def test_current_speed_and_direction(self):
+        self.data.vel1[2, 3] = np.ma.masked
+        qaqc = trdiUH.TRDIQAQC(self.data, 10)
+        self.assertEqual([], qaqc.fields.computed())
+
+        u, v = self.data.vel1, self.data.vel2
+        self.assertTrue(np.ma.allclose(np.hypot(u, v), qaqc.current_speed))
+        direction = qaqc.current_direction
+        self.assertTrue(np.ma.allclose(np.degrees(np.arctan2(u, v)) % 360,
+                                       direction))
+        self.assertTrue(((direction >= 0) & (direction < 360)).all())
+        self.assertTrue(qaqc.current_speed.mask[2, 3])
+        self.assertTrue(direction.mask[2, 3])
+        self.assertEqual(['direction', 'speed'], qaqc.fields.computed())
+
+    def test_masked_bins_are_missing(self):
+        self.data.vel3[1, 4] = np.ma.masked
+        self.data.amp = np.ma.masked_array(self.data.amp)
+        self.data.amp[3, 2, 1] = np.ma.masked
+        qaqc = trdiUH.TRDIQAQC(self.data, 10)
+        self.assertTrue(np.may_share_memory(qaqc.w, self.data.vel3))
+
+        flags, worst = qaqc.run_all()
+        missing = ADCP_FLAGS['missing_data']
+        self.assertEqual(missing, flags['vertical_velocity'][1, 4])
+        self.assertNotEqual(missing, flags['current_speed'][1, 4])
+        for name in ('stuck_sensor', 'echo_intensity', 'range_drop_off'):
+            self.assertEqual(missing, flags[name][3, 2])
+        self.assertTrue((flags.worst() == worst).all())
+
+    def test_velocity_limits(self):
+        self.data.vel1[0, 1] = 1.2
+        qaqc = trdiUH.TRDIQAQC(self.data, 10)
+        self.assertEqual(100., qaqc.velocity_scale)
+
+        default = qaqc.horizontal_velocity_flags()
+        strict = qaqc.horizontal_velocity_flags(max_u_vel=100)
+        self.assertEqual(ADCP_FLAGS['good'], default[0, 1])
+        self.assertEqual(ADCP_FLAGS['bad'], strict[0, 1])
+
+        params = {'horizontal_velocity': {'max_u_vel': 100},
+                  'error_velocity': {'bad_error_velocity': 1},
+                  'orientation': {'max_pitch': 1}}
+        flags, _ = qaqc.run_all(params)
+        self.assertTrue((strict == flags['horizontal_velocity']).all())
+        self.assertTrue((qaqc.error_velocity_flags(bad_error_velocity=1) ==
+                         flags['error_velocity']).all())
+        self.assertTrue((qaqc.orientation_flags(max_pitch=1) ==
+                         flags['orientation'][:, 0]).all())
+        for name, method in trdiUH.TRDIQAQC.TEST_METHODS.items():
+            if name not in params and name not in qaqc.ENSEMBLE_TESTS:
+                self.assertTrue(
+                    (getattr(qaqc, method)() == flags[name]).all(), name
+                )
+
+    def test_variable_leader_flags(self):
+        self.assertEqual(['bit', 'orientation', 'sound_speed', 'heading',
+                          'temperature', 'pressure'],
+                         list(self.qaqc.variable_leader_flags()))
+
+        self.data.VL['BIT'][1] = 1
+        self.data.VL['SoundSpeed'][2] = 1300
+        self.data.VL['Pressure'][3] = 6500000
+        self.data.heading[4] = 400
+        self.data.temperature[5] = 50
+        flags = self.qaqc.variable_leader_flags()
+        bad_ensembles = (('bit', 1), ('sound_speed', 2), ('pressure', 3),
+                         ('heading', 4), ('temperature', 5))
+        for name, ensemble in bad_ensembles:
+            expected = [ADCP_FLAGS['good']] * 6
+            expected[ensemble] = ADCP_FLAGS['bad']
+            self.assertEqual(expected, flags[name].tolist(), name)
+        self.assertTrue((flags['orientation'] == ADCP_FLAGS['good']).all())
+
+        # pressure is recorded in decapascals, 100 dbar in synthetic data
+        self.assertEqual(ADCP_FLAGS['good'],
+                         self.qaqc.pressure_flags(pressure_max=100)[0])
+        self.assertEqual(ADCP_FLAGS['bad'],
+                         self.qaqc.pressure_flags(pressure_max=99)[0])
+
+        names = [name for name in self.data.VL.dtype.names
+                 if name != 'Pressure']
+        self.data.VL = self.data.VL[names]
+        self.assertTrue((self.qaqc.pressure_flags() ==
+                         ADCP_FLAGS['no_test']).all())
+
+
+class TestProfiler(unittest.TestCase):
+
+    def setUp(self):
+        self.trdi = ProfilerQAQC.from_source(
+            synthetic_ensembles(6, 25, seed=1407), 'trdi', 104.
+        )
+        self.source = synthetic_profile(6, 25, seed=1407)
+
+    def test_synthetic_matches_trdi(self):
+        synthetic = ProfilerQAQC.from_source(self.source, 'synthetic', 104.)
+        for key, values in self.trdi.bottom_stats.items():
+            self.assertTrue(np.allclose(values, synthetic.bottom_stats[key]))
+
+        trdi_flags = self.trdi.flags()
+        flags = synthetic.flags()
+        for name in ('orientation', 'sound_speed', 'correlation_magnitude',
+                     'current_speed', 'vertical_velocity', 'echo_intensity',
+                     'range_drop_off'):
+            self.assertTrue((trdi_flags[name] == flags[name]).all(), name)
+
+        no_test = ADCP_FLAGS['no_test']
+        for name in ('noise_floor', 'signal_strength', 'signal_to_noise'):
+            self.assertTrue((trdi_flags[name] == no_test).all())
+            self.assertFalse((flags[name] == no_test).any())
+        for name in ('bit', 'percent_good'):
+            self.assertTrue((flags[name] == no_test).all())
+
+    def test_native_backends(self):
+        source = dict(self.source)
+        source['velocity'] = source['velocity'][..., :3]
+        del source['correlation']
+        flags = ProfilerQAQC.from_source(source, 'sontek', 104).flags()
+        self.assertTrue(
+            (flags['correlation_magnitude'] == ADCP_FLAGS['no_test']).all()
+        )
+        self.assertTrue(
+            (flags['error_velocity'] == ADCP_FLAGS['missing_data']).all()
+        )
+
+        nortek = get_backend('nortek').to_stack(self.source)
+        velocity = self.source['velocity']
+        self.assertTrue(np.allclose(
+            (velocity[..., 2] - velocity[..., 3]) * 100,
+            nortek['velocity'][..., 3]
+        ))
+        self.assertEqual((6, 25, 4), nortek['snr'].shape)
+        self.assertRaises(ValueError, get_backend, 'aquadopp')
+
+    def test_noise_tests(self):
+        noise_floor = np.array([[20, 30], [20, 45], [70, 20], [np.nan, 1]])
+        self.assertEqual([1, 3, 4, 9],
+                         vectorized.noise_floor_test(noise_floor).tolist())
+        echo = np.array([[[40, 40], [28, 40], [22, 40]]])
+        self.assertEqual(
+            [[1, 3, 4]],
+            vectorized.signal_strength_test(echo, [[20, 30]]).tolist()
+        )
+        snr = np.array([[[10, 8], [10, 4], [1, 10], [np.nan, 10]]])
+        self.assertEqual([[1, 3, 4, 9]],
+                         vectorized.signal_to_noise_test(snr).tolist())
+
+
+class TestInstrumentation(unittest.TestCase):
+
+    def test_records_phases_and_tests(self):
+        stats = QCStats()
+        deployment = TRDIDeploymentQAQC.from_ensembles(
+            synthetic_ensembles(6, 25, seed=1407), 104, stats=stats
+        )
+        deployment.flags()
+        deployment.current_speed_flags()
+        phases = stats.as_dict()
+        self.assertEqual(1, phases['read_velocities']['calls'])
+        self.assertEqual(1, phases['calc_bottom_stats']['calls'])
+        self.assertEqual(2, phases['current_speed_flags']['calls'])
+        self.assertEqual(2 * 6 * 25, phases['current_speed_flags']['bins'])
+        self.assertIn(
+            'adcp_qartod_calls_total{phase="run_all"} 1',
+            stats.to_prometheus().splitlines()
+        )
+
+    def test_merge(self):
+        stats = QCStats()
+        for _ in range(2):
+            other = QCStats()
+            other.record('battery_flag', 0.5, 10)
+            stats.merge(other)
+        self.assertEqual({'calls': 2, 'seconds': 1.0, 'bins': 20},
+                         stats.as_dict()['battery_flag'])
+
+
+class TestQCSession(unittest.TestCase):
+
+    def setUp(self):
+        self.ensembles = list(synthetic_ensembles(12, 25, seed=1407))
+
+    def test_matches_deployment(self):
+        expected = TRDIDeploymentQAQC.from_ensembles(self.ensembles,
+                                                     104).flags()
+        session = QCSession(transducer_depth=104)
+        for i, ensemble in enumerate(self.ensembles):
+            flags = session.update(ensemble)
+            for name in expected:
+                self.assertEqual(expected[name][i].tolist(),
+                                 flags[name][0].tolist())
+        self.assertEqual(1, session.geometry_builds)
+        self.assertEqual(len(self.ensembles), session.stuck_sensor.count)
+        self.assertTrue((flags.worst() == session.worst).all())
+
+    def test_fixed_leader_change_rebuilds_geometry(self):
+        session = QCSession(transducer_depth=104)
+        session.update(self.ensembles[0])
+        self.ensembles[1]['fixed_leader']['depth_cell_length'] = 50
+        session.update(self.ensembles[1])
+        session.update(self.ensembles[1])
+        self.assertEqual(2, session.geometry_builds)
+        self.assertEqual(50, session.geometry.fixed_leader[
+            'depth_cell_length'])
+
+    def test_does_not_modify_ensembles(self):
+        bin_1_distance = self.ensembles[0]['fixed_leader']['bin_1_distance']
+        TRDIQAQC(self.ensembles[0], transducer_depth=104)
+        QCSession().update(self.ensembles[0])
+        self.assertEqual(bin_1_distance,
+                         self.ensembles[0]['fixed_leader']['bin_1_distance'])
+
+
+class TestConfig(unittest.TestCase):
+
+    def setUp(self):
+        self.profile = {
+            'name': 'West Florida Shelf',
+            'order': ['current_speed', 'range_drop_off'],
+            'tests': {
+                'current_speed': {'max_speed': 60},
+                'range_drop_off': {'drop_off_limit': 100},
+                'battery': False,
+                'stuck_sensor': {'tolerance': 2}
+            }
+        }
+        self.deployment = TRDIDeploymentQAQC.from_ensembles(
+            synthetic_ensembles(6, 25, seed=1407), 104
+        )
+
+    def test_compile(self):
+        plan = compile_profile(self.profile)
+        self.assertEqual(('current_speed', 'range_drop_off', 'checksum'),
+                         plan.names[:3])
+        self.assertNotIn('battery', plan.names)
+        self.assertEqual({'max_speed': 60}, plan.kwargs('current_speed'))
+
+        for profile in ({'tests': {'speed': {}}},
+                        {'tests': {'current_speed': {'max': 60}}},
+                        {'order': ['bit', 'bit']}):
+            self.assertRaises(ValueError, compile_profile, profile)
+
+    def test_run_matches_run_all(self):
+        plan = compile_profile(self.profile)
+        flags, worst = plan.run(self.deployment)
+        expected, _ = self.deployment.run_all(
+            dict(self.profile['tests'], battery={})
+        )
+        for name in plan.names:
+            self.assertTrue((expected[name] == flags[name]).all())
+        self.assertTrue((flags.worst() == worst).all())
+
+    def test_load_json(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'wfs.json')
+            with open(path, 'w') as profile_file:
+                json.dump(self.profile, profile_file)
+            plan = load_profile(path)
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual('West Florida Shelf', plan.name)
+        self.assertEqual(18, len(plan.names))
+
+    def test_session_plan(self):
+        plan = compile_profile(self.profile)
+        session = QCSession(transducer_depth=104, plan=plan)
+        flags = session.update_many(synthetic_ensembles(6, 25, seed=1407))
+        self.assertEqual(plan.names, flags.names)
+        self.assertEqual(2, session.stuck_sensor.tolerance)
+
+
+class TestStream(unittest.TestCase):
+
+    def test_iter_chunks(self):
+        chunks = list(iter_chunks(range(7), 3))
+        self.assertEqual([[0, 1, 2], [3, 4, 5], [6]], chunks)
+
+    def test_chunks_are_read_lazily(self):
+        pulled = count()
+
+        def ensembles():
+            for ensemble in synthetic_ensembles(10 ** 6, 10, seed=1):
+                next(pulled)
+                yield ensemble
+
+        blocks = list(islice(stream_flags(ensembles(), chunk_size=4), 2))
+        self.assertEqual([0, 4], [first for first, flags in blocks])
+        self.assertEqual(8, next(pulled))
+
+    def test_stream_matches_deployment(self):
+        deployment = TRDIDeploymentQAQC.from_ensembles(
+            synthetic_ensembles(10, 20, seed=7), transducer_depth=104
+        ).flags()
+        blocks = list(stream_flags(synthetic_ensembles(10, 20, seed=7),
+                                   chunk_size=4, transducer_depth=104))
+        self.assertEqual([0, 4, 8], [first for first, flags in blocks])
+        for name, bin_flags in deployment.items():
+            streamed = np.concatenate([flags[name] for _, flags in blocks])
+            self.assertTrue((bin_flags == streamed).all())
+
+
+class TestPD0Data(unittest.TestCase):
+
+    def setUp(self):
+        self.ensembles = list(synthetic_ensembles(4, 12, seed=11))
+        self.encoded = [encode_pd0(ensemble) for ensemble in self.ensembles]
+        self.pd0 = PD0Data(b''.join(self.encoded))
+
+    def test_decode(self):
+        self.assertEqual((4, 12, 4), self.pd0.velocity.shape)
+        self.assertFalse(self.pd0.velocity.flags['OWNDATA'])
+        for i, ensemble in enumerate(self.ensembles):
+            velocity = np.round(np.array(ensemble['velocity']['data']) * 10)
+            self.assertTrue((velocity == self.pd0.velocity[i]).all())
+            self.assertEqual(ensemble['echo_intensity']['data'],
+                             self.pd0.echo_intensity[i].tolist())
+            self.assertEqual(ensemble['variable_leader']['pitch'],
+                             self.pd0.variable_leader['pitch'][i])
+        self.assertEqual([20] * 4, self.pd0.beam_angle.tolist())
+
+    def test_checksum(self):
+        self.assertTrue(self.pd0.checksum_ok.all())
+        corrupt = bytearray(self.encoded[2])
+        corrupt[100] ^= 0xFF
+        self.encoded[2] = bytes(corrupt)
+        pd0 = PD0Data(b''.join(self.encoded))
+        self.assertEqual([True, True, False, True], pd0.checksum_ok.tolist())
+
+        flags = TRDIDeploymentQAQC.from_pd0(pd0, 104).checksum_flag()
+        self.assertEqual(ADCP_FLAGS['bad'], flags[2, 0])
+        self.assertEqual(ADCP_FLAGS['good'], flags[3, 0])
+
+    def test_resync_after_garbage(self):
+        raw = (b'junk' + self.encoded[0] + b'\x7f\x7fzz' +
+               self.encoded[1] + self.encoded[2][:50] + self.encoded[3])
+        pd0 = PD0Data(raw)
+        self.assertEqual(3, pd0.n_ensembles)
+        self.assertTrue(pd0.checksum_ok.all())
+        self.assertTrue((self.pd0.velocity[[0, 1, 3]] == pd0.velocity).all())
+
+    def test_import_without_external_readers(self):
+        # a None entry in sys.modules makes its import raise ImportError
+        code = '\n'.join((
+            'import importlib, pkgutil, sys',
+            'sys.modules["trdi_adcp_readers"] = None',
+            'sys.modules["pycurrents"] = None',
+            'import adcp_qartod_qaqc',
+            'path = adcp_qartod_qaqc.__path__',
+            'for _, name, _ in pkgutil.iter_modules(path):',
+            '    if name != "ingest" or sys.version_info >= (3, 5):',
+            '        importlib.import_module("adcp_qartod_qaqc." + name)'
+        ))
+        subprocess.check_call([sys.executable, '-c', code],
+                              cwd=os.path.dirname(os.path.abspath(__file__)))
+
+
+class TestIngest(unittest.TestCase):
+
+    def setUp(self):
+        self.ensembles = list(synthetic_ensembles(15, 12, seed=11))
+        self.encoded = [encode_pd0(ensemble) for ensemble in self.ensembles]
+        self.raw = b'junk'.join(self.encoded)
+
+    def test_frame_buffer(self):
+        frames = PD0FrameBuffer()
+        found = []
+        for start in range(0, len(self.raw), 7):
+            found.extend(frames.feed(self.raw[start:start + 7]))
+        self.assertEqual(self.encoded, found)
+        self.assertEqual(4 * 14, frames.n_skipped)
+
+    def ingest(self, raw, batch_size, expected):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            reader = asyncio.StreamReader()
+            reader.feed_data(raw)
+            reader.feed_eof()
+            sink = asyncio.Queue()
+            service = IngestService(sink, QCSession(104), queue_size=2,
+                                    batch_size=batch_size, read_size=50)
+            self.assertEqual(expected.shape[0], loop.run_until_complete(
+                service.run(reader)))
+
+            while not sink.empty():
+                first, timestamps, flags = sink.get_nowait()
+                last = first + len(timestamps)
+                self.assertTrue((expected.flags[:, first:last] ==
+                                 flags.flags).all())
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+        return service
+
+    @unittest.skipIf(sys.version_info < (3, 7), 'requires asyncio')
+    def test_ingest_matches_deployment(self):
+        expected = TRDIDeploymentQAQC.from_pd0(PD0Data(self.raw),
+                                               104).flags()
+        for batch_size in (1, 4, 32):
+            self.ingest(self.raw, batch_size, expected)
+
+    @unittest.skipIf(sys.version_info < (3, 7), 'requires asyncio')
+    def test_ingest_rejects_incomplete_ensembles(self):
+        complete = self.encoded[:6] + self.encoded[7:]
+        expected = TRDIDeploymentQAQC.from_pd0(PD0Data(b''.join(complete)),
+                                               104).flags()
+        del self.ensembles[6]['percent_good']
+        raw = b''.join(self.encoded[:6] + [encode_pd0(self.ensembles[6])] +
+                       self.encoded[7:])
+        self.assertRaises(ValueError, PD0Data(raw).to_stack)
+        for batch_size in (1, 32):
+            with self.assertLogs('adcp_qartod_qaqc.ingest', 'WARNING'):
+                service = self.ingest(raw, batch_size, expected)
+            self.assertEqual(1, service.n_rejected)
+
+
+class TestWriters(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.pd0_path = os.path.join(self.directory, 'deployment.pd0')
+        with open(self.pd0_path, 'wb') as pd0_file:
+            write_pd0(pd0_file, synthetic_ensembles(25, 12, seed=5))
+        with open(self.pd0_path, 'rb') as pd0_file:
+            self.pd0 = PD0Data(pd0_file.read())
+        self.expected = TRDIDeploymentQAQC.from_pd0(self.pd0, 104).flags()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    @unittest.skipIf(writers.netCDF4 is None, 'requires netCDF4')
+    def test_netcdf(self):
+        path = os.path.join(self.directory, 'flags.nc')
+        with writers.NetCDFWriter(path, 12, chunk_size=10) as writer:
+            self.assertEqual(25, writers.export_pd0(self.pd0_path, writer,
+                                                    10, 104))
+
+        dataset = writers.netCDF4.Dataset(path)
+        try:
+            for name in QARTOD_TESTS:
+                self.assertTrue((self.expected[name] ==
+                                 dataset['qartod_' + name][:]).all())
+            self.assertTrue((self.expected.worst() ==
+                             dataset['qartod_rollup'][:]).all())
+            self.assertIn('qartod_rollup',
+                          dataset['u'].ancillary_variables.split())
+            self.assertEqual('good no_test suspect bad missing_data',
+                             dataset['qartod_bit'].flag_meanings)
+        finally:
+            dataset.close()
+
+    @unittest.skipIf(writers.pyarrow is None, 'requires pyarrow')
+    def test_parquet(self):
+        path = os.path.join(self.directory, 'flags.parquet')
+        with writers.ParquetWriter(path) as writer:
+            writers.export_pd0(self.pd0_path, writer, 10, 104)
+
+        parquet = writers.pyarrow.parquet.ParquetFile(path)
+        self.assertEqual(3, parquet.num_row_groups)
+        table = parquet.read()
+        self.assertEqual(25 * 12, table.num_rows)
+        rollup = np.array(table.column('qartod_rollup').to_pylist())
+        self.assertTrue((self.expected.worst().ravel() == rollup).all())
+
+
+class TestCli(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.data = os.path.join(self.directory, 'data')
+        os.makedirs(os.path.join(self.data, 'leg2'))
+        self.paths = [os.path.join(self.data, 'DEP1.000'),
+                      os.path.join(self.data, 'leg2', 'dep2.pd0')]
+        for seed, path in enumerate(self.paths):
+            with open(path, 'wb') as pd0_file:
+                write_pd0(pd0_file, synthetic_ensembles(15, 10, seed=seed))
+        with open(os.path.join(self.data, 'notes.txt'), 'w') as notes:
+            notes.write('not a PD0 file')
+        self.output = os.path.join(self.directory, 'qc')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_scan_inputs(self):
+        self.assertEqual(sorted(self.paths), cli.scan_inputs([self.data]))
+        self.assertEqual(
+            [self.paths[0]],
+            cli.scan_inputs([os.path.join(self.data, '*.000'),
+                             self.paths[0]])
+        )
+        self.assertEqual(os.path.join('qc', 'DEP1_000.nc'),
+                         cli.output_path(self.paths[0], 'qc', 'netcdf'))
+
+    def test_run_state(self):
+        state = cli.RunState(os.path.join(self.directory, 'state.json'))
+        settings = {'chunk_size': 10}
+        path = self.paths[0]
+        self.assertFalse(state.unchanged(path, settings))
+        state.record(path, path, settings)
+        state.save()
+
+        state = cli.RunState(state.path)
+        self.assertTrue(state.unchanged(path, settings))
+        self.assertFalse(state.unchanged(path, {'chunk_size': 20}))
+        os.utime(path, (0, 0))
+        self.assertTrue(state.unchanged(path, settings))
+        with open(path, 'r+b') as pd0_file:
+            pd0_file.seek(100)
+            pd0_file.write(b'\xff')
+        os.utime(path, (1, 1))
+        self.assertFalse(state.unchanged(path, settings))
+
+    @unittest.skipIf(writers.netCDF4 is None, 'requires netCDF4')
+    def test_run(self):
+        plan = compile_profile({'tests': {'battery': False}})
+        arguments = (cli.scan_inputs([self.data]), self.output, 'netcdf', 1,
+                     8, 104, plan)
+        results = cli.run(*arguments, progress=None)
+        self.assertEqual([15, 15], [r['n_ensembles'] for r in results])
+        dataset = writers.netCDF4.Dataset(results[0]['output'])
+        try:
+            self.assertEqual(15, len(dataset['time']))
+            self.assertNotIn('qartod_battery', dataset.variables)
+        finally:
+            dataset.close()
+
+        results = cli.run(*arguments, progress=None)
+        self.assertTrue(all(result['skipped'] for result in results))
+        self.assertIn('unchanged', cli.format_summary(results))
+        results = cli.run(*arguments, force=True, progress=None)
+        self.assertFalse(any(result.get('skipped') for result in results))
+
+    @unittest.skipIf(writers.netCDF4 is None, 'requires netCDF4')
+    def test_run_continues_past_failed_file(self):
+        missing = os.path.join(self.data, 'missing.000')
+        paths = [missing] + self.paths
+        for workers in (1, 2):
+            output = os.path.join(self.output, str(workers))
+            results = cli.run(paths, output, workers=workers, chunk_size=8,
+                              transducer_depth=104, progress=None)
+            self.assertIn('error', results[0])
+            self.assertEqual([15, 15],
+                             [r['n_ensembles'] for r in results[1:]])
+            self.assertIn('failed', cli.format_summary(results))
+
+            state = cli.RunState(os.path.join(output, cli.STATE_FILE))
+            self.assertEqual(sorted(self.paths), sorted(state.files))
+
+
+class TestFlagCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = FlagCache(self.directory)
+        ensembles = synthetic_ensembles(8, 12, seed=3)
+        self.pd0 = PD0Data(b''.join(encode_pd0(e) for e in ensembles))
+        self.qaqc = TRDIDeploymentQAQC.from_pd0(self.pd0, 104)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_only_changed_tests_rerun(self):
+        params = {'current_speed': {'max_speed': 50}}
+        first, worst = run_cached(self.qaqc, self.cache, pd0_key(self.pd0))
+        self.assertEqual((0, 19), (self.cache.hits, self.cache.misses))
+        again, _ = run_cached(self.qaqc, self.cache, pd0_key(self.pd0),
+                              params)
+        self.assertEqual((18, 20), (self.cache.hits, self.cache.misses))
+
+        expected, expected_worst = self.qaqc.run_all()
+        self.assertTrue((expected.flags == first.flags).all())
+        self.assertTrue((expected_worst == worst).all())
+        self.assertTrue((self.qaqc.run_all(params)[0].flags ==
+                         again.flags).all())
+
+    def test_lru_eviction(self):
+        flags = np.ones((10, 10), dtype=np.uint8)
+        entry_size = None
+        for i in range(3):
+            self.cache.put('key%d' % i, flags)
+            os.utime(self.cache.path('key%d' % i), (i, i))
+            entry_size = entry_size or self.cache.size()
+        self.cache.get('key0')
+        self.cache.max_bytes = 2 * entry_size
+        self.cache.evict()
+        self.assertIsNotNone(self.cache.get('key0'))
+        self.assertIsNone(self.cache.get('key1'))
+        self.assertIsNotNone(self.cache.get('key2'))
+
+    def test_overwrite_keeps_size(self):
+        flags = np.ones((10, 10), dtype=np.uint8)
+        self.cache.put('key', flags)
+        entry_size = self.cache.size()
+        for _ in range(3):
+            self.cache.put('key', flags)
+        self.assertEqual(entry_size, self.cache.total_bytes)
+
+
+class TestParallel(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.paths = []
+        for i in range(3):
+            path = os.path.join(self.directory, '%d.000' % i)
+            with open(path, 'wb') as f:
+                write_pd0(f, synthetic_ensembles(20, 10 + i, seed=i))
+            self.paths.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_results_do_not_depend_on_workers(self):
+        serial = run_files(self.paths, workers=1, transducer_depth=104)
+        sharded = run_files(self.paths, workers=2, shard_bytes=2000,
+                            transducer_depth=104)
+        shared = run_files(self.paths, workers=2, transducer_depth=104,
+                           backend='shared')
+
+        self.assertEqual((60, 12), serial['flags']['current_speed'].shape)
+        timestamps = serial['timestamps']
+        self.assertTrue((timestamps[1:] >= timestamps[:-1]).all())
+        for merged in (sharded, shared):
+            self.assertTrue((timestamps == merged['timestamps']).all())
+            for name, flags in serial['flags'].items():
+                self.assertTrue((flags == merged['flags'][name]).all())
+
+        throughput = sharded['throughput'][self.paths[0]]
+        self.assertEqual(20, throughput['n_ensembles'])
+        self.assertEqual(os.path.getsize(self.paths[0]), throughput['bytes'])
+
+
+class TestShared(unittest.TestCase):
+
+    def setUp(self):
+        self.stack = get_backend('trdi').to_stack(
+            synthetic_ensembles(30, 12, seed=3)
+        )
+        # a stuck run crossing the chunk boundaries
+        self.stack['echo_intensity'][8:16] = self.stack['echo_intensity'][8]
+        self.expected = TRDIDeploymentQAQC(self.stack, 104.).flags()
+
+    def check_backend(self, use_shared_memory):
+        for workers, chunk_size in ((1, 7), (2, 5), (2, 30)):
+            flags = run_shared(self.stack, workers, chunk_size, 104.,
+                               use_shared_memory=use_shared_memory)
+            self.assertEqual(self.expected.names, flags.names)
+            self.assertTrue((self.expected.flags == flags.flags).all())
+
+    def test_memmap(self):
+        self.check_backend(False)
+
+    @unittest.skipIf(shared_memory is None, 'requires shared_memory')
+    def test_shared_memory(self):
+        self.check_backend(True)
+
+    def test_shared_arrays(self):
+        shared = SharedArrays.create({'pitch': np.arange(5)},
+                                     use_shared_memory=False)
+        try:
+            attached = SharedArrays.attach(shared.spec)
+            attached['pitch'][0] = 7
+            self.assertEqual([7, 1, 2, 3, 4], shared['pitch'].tolist())
+            attached.close()
+        finally:
+            shared.close()
+            shared.unlink()
+        self.assertFalse(os.path.exists(shared.spec['path']))
+        self.assertRaises(ValueError, SharedArrays.create,
+                          {'bits': np.array([None])})
+
+
 class TestTRDIQAQC(unittest.TestCase):
 
     def setUp(self):
         self.trdi_data = read_PD15_file('./test_data/1407B0B6', header_lines=2)
         self.qaqc = TRDIQAQC(self.trdi_data, transducer_depth=104)
-        print self.trdi_data
+        print(self.trdi_data)
 
     def test_bottom_stats(self):
         self.assertEqual(20, self.qaqc.bottom_stats['last_good_bin'])